@@ -1,6 +1,15 @@
+import json
+import os
+
 from django.contrib import admin
+from django.db.models.expressions import RawSQL
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
 
-from .models import Group, Post, Comment
+from . import profiling, search
+from .models import Comment, Group, Post, RequestProfile
 
 
 class PostAdmin(admin.ModelAdmin):
@@ -9,6 +18,14 @@ class PostAdmin(admin.ModelAdmin):
     list_filter = ("pub_date",)
     empty_value_display = "-пусто-"
 
+    def get_search_results(self, request, queryset, search_term):
+        # Вместо LIKE '%…%' по всей таблице ищем по индексу FTS5.
+        if not search_term or not search.enabled():
+            return super().get_search_results(request, queryset,
+                                              search_term)
+        return queryset.filter(
+            pk__in=RawSQL(*search.matching_ids_sql(search_term))), False
+
 
 class GroupAdmin(admin.ModelAdmin):
     list_display = ("pk", "title", "slug", "description")
@@ -23,6 +40,54 @@ class CommentAdmin(admin.ModelAdmin):
     empty_value_display = "-пусто-"
 
 
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ("created", "method", "path", "view", "status",
+                    "duration", "queries", "sql_duration", "trigger")
+    list_filter = ("view", "trigger", "created")
+    search_fields = ("path",)
+    readonly_fields = ("stacks", "sql_timeline")
+    exclude = ("stacks_file", "sql")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path("<int:pk>/stacks/",
+                 self.admin_site.admin_view(self.download_stacks),
+                 name="posts_requestprofile_stacks"),
+        ] + super().get_urls()
+
+    def download_stacks(self, request, pk):
+        if not self.has_view_permission(request):
+            raise Http404
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        filename = profiling.stacks_path(profile)
+        if not os.path.exists(filename):
+            raise Http404
+        return FileResponse(open(filename, "rb"), as_attachment=True,
+                            content_type="text/plain")
+
+    def stacks(self, obj):
+        url = reverse("admin:posts_requestprofile_stacks", args=[obj.pk])
+        return format_html('<a href="{}">{}</a> ({} выборок)', url,
+                           obj.stacks_file, obj.samples)
+    stacks.short_description = "Стеки (collapsed)"
+
+    def sql_timeline(self, obj):
+        rows = format_html_join(
+            "", "<tr><td>{}</td><td>{}</td><td><code>{}</code></td></tr>",
+            json.loads(obj.sql))
+        return format_html("<table><tr><th>Начало, мс</th>"
+                           "<th>Длительность, мс</th><th>Запрос</th></tr>"
+                           "{}</table>", rows)
+    sql_timeline.short_description = "SQL по времени"
+
+
 admin.site.register(Post, PostAdmin)
 admin.site.register(Group, GroupAdmin)
 admin.site.register(Comment, CommentAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
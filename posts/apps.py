@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class PostsConfig(AppConfig):
     name = "posts"
+
+    def ready(self):
+        from yatube import cache_backends
+
+        from . import metrics, signals  # noqa
+        cache_backends.LOOKUP_OBSERVERS.append(metrics.record_cache_lookup)
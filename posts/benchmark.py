@@ -0,0 +1,392 @@
+"""Нагрузочный прогон: воспроизведение трассы запросов к WSGI-приложению.
+
+Трасса — JSONL, по запросу в строке:
+{"method": "GET", "path": "/leo/2/", "user": "leo", "data": {}}.
+user — имя пользователя, от которого идёт запрос (null — аноним), data —
+поля формы для POST. Трассу можно записать из живого трафика или собрать
+из текущей базы build_trace().
+
+Запросы отправляются в yatube.wsgi.application либо напрямую, без
+сокетов (in-process), либо через локальный HTTP-сервер wsgiref. В обоих
+случаях приложение обёрнуто счётчиком SQL-запросов, так что для каждого
+эндпоинта видны задержки и число запросов к базе.
+
+С concurrency > 1 трасса раздаётся нескольким потокам-клиентам, а
+HTTP-сервер обрабатывает запросы пулом потоков такого же размера, как
+gthread-воркер gunicorn: соединения с базой переживают запрос
+(CONN_MAX_AGE), и чтение конкурирует с записью так же, как в бою.
+
+Записи трассы меняют базу: гонять её нужно на копии или на наборе из
+generate_dataset.
+"""
+import http.client
+import json
+import math
+import random
+import secrets
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from io import BytesIO
+from socketserver import ThreadingMixIn
+from urllib.parse import urlencode, urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY,
+                                 SESSION_KEY)
+from django.db import connection, connections
+from django.urls import Resolver404, resolve
+
+from .models import Group, Post, User
+
+# Адрес клиента для приложения: не из INTERNAL_IPS, чтобы в ответы не
+# попадала панель debug_toolbar.
+CLIENT_ADDR = "192.0.2.1"
+REQUEST_ID_HEADER = "X-Benchmark-Id"
+PERCENTILES = (50, 95, 99)
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as lines:
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+def save_trace(path, trace):
+    with open(path, "w", encoding="utf-8") as output:
+        for entry in trace:
+            output.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def build_trace(count, seed=0):
+    """Смешанная трасса по данным текущей базы.
+
+    Пропорции примерно как у ленты в жизни: в основном чтение главной,
+    постов и профилей, немного поиска и записи.
+    """
+    rng = random.Random(seed)
+    users = list(User.objects.order_by("pk").values_list("username",
+                                                         flat=True)[:1000])
+    posts = list(Post.objects.order_by("-pk").values_list(
+        "author__username", "pk")[:5000])
+    groups = list(Group.objects.values_list("slug", flat=True)[:100])
+    if not users or not posts:
+        raise ValueError("Для трассы нужны пользователи и посты")
+
+    def entry(path, user=None, method="GET", data=None):
+        return {"method": method, "path": path, "user": user,
+                "data": data or {}}
+
+    kinds = [("index", 35), ("post", 20), ("profile", 15), ("group", 8),
+             ("follow", 10), ("search", 5), ("new_post", 4),
+             ("comment", 3)]
+    names, weights = zip(*kinds)
+    trace = []
+    for kind in rng.choices(names, weights, k=count):
+        user = rng.choice(users) if rng.random() < 0.5 else None
+        author, post_id = rng.choice(posts)
+        if kind == "index":
+            trace.append(entry("/", user))
+        elif kind == "post":
+            trace.append(entry(f"/{author}/{post_id}/", user))
+        elif kind == "profile":
+            trace.append(entry(f"/{author}/", user))
+        elif kind == "group" and groups:
+            trace.append(entry(f"/group/{rng.choice(groups)}/", user))
+        elif kind == "follow":
+            trace.append(entry("/follow/", rng.choice(users)))
+        elif kind == "search":
+            word = rng.choice(["кошка", "день", "письмо", "море", "дом"])
+            trace.append(entry("/search/?" + urlencode({"q": word}), user))
+        elif kind == "new_post":
+            trace.append(entry("/new/", rng.choice(users), "POST",
+                               {"text": "Пост из нагрузочного прогона"}))
+        elif kind == "comment":
+            trace.append(entry(f"/{author}/{post_id}/comment",
+                               rng.choice(users), "POST",
+                               {"text": "Комментарий из прогона"}))
+    return trace
+
+
+def endpoint(entry):
+    path = urlsplit(entry["path"]).path
+    try:
+        name = resolve(path).url_name or "?"
+    except Resolver404:
+        name = "404"
+    return f"{entry['method']} {name}"
+
+
+def login_cookie(username):
+    """Cookie сессии вошедшего пользователя, как после django login()."""
+    user = User.objects.get(username=username)
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return f"{settings.SESSION_COOKIE_NAME}={session.session_key}"
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def counting_app(app, queries):
+    """Обёртка WSGI-приложения, записывающая число SQL-запросов.
+
+    Ответ Django формируется целиком внутри вызова приложения, поэтому
+    все его запросы к базе проходят через execute_wrapper.
+    """
+    def wrapper(environ, start_response):
+        environ["REMOTE_ADDR"] = CLIENT_ADDR
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            result = app(environ, start_response)
+        request_id = environ.get("HTTP_" + REQUEST_ID_HEADER.upper()
+                                 .replace("-", "_"))
+        queries[request_id] = counter.count
+        return result
+    return wrapper
+
+
+class Client:
+    """Готовит заголовки запроса: сессию пользователя и CSRF."""
+
+    def __init__(self):
+        self.cookies = {}
+        self.lock = threading.Lock()
+        # Cookie и заголовок с одинаковым токеном проходят проверку CSRF
+        # без предварительного GET формы.
+        self.csrf_token = secrets.token_hex(16)
+
+    def headers(self, entry, request_id):
+        cookies = [f"{settings.CSRF_COOKIE_NAME}={self.csrf_token}"]
+        user = entry.get("user")
+        if user:
+            with self.lock:
+                if user not in self.cookies:
+                    self.cookies[user] = login_cookie(user)
+            cookies.append(self.cookies[user])
+        headers = {"Cookie": "; ".join(cookies),
+                   REQUEST_ID_HEADER: str(request_id)}
+        if entry["method"] == "POST":
+            headers["X-CSRFToken"] = self.csrf_token
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        return headers
+
+
+class InProcessTransport:
+    """Вызывает WSGI-приложение напрямую, без сети."""
+    name = "inprocess"
+
+    def __init__(self, app, workers=1):
+        self.queries = {}
+        self.app = counting_app(app, self.queries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def request(self, method, path, body, headers):
+        url = urlsplit(path)
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": url.path,
+            "QUERY_STRING": url.query,
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": BytesIO(body),
+            "wsgi.errors": BytesIO(),
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            environ[key] = value
+        status = []
+        result = self.app(environ,
+                          lambda line, headers, exc_info=None:
+                          status.append(int(line.split()[0])))
+        try:
+            for _ in result:
+                pass
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return status[0]
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """wsgiref-сервер, обрабатывающий запросы пулом потоков.
+
+    ThreadingMixIn заводит поток на каждое соединение, и соединение с
+    базой умирает вместе с ним; в пуле потоки и их соединения живут.
+    """
+    executor = None
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request,
+                             client_address)
+
+
+def _close_connections(barrier):
+    # Барьер держит поток, пока задачу не возьмут все потоки пула, так
+    # что каждый закрывает именно своё соединение.
+    barrier.wait(timeout=10)
+    connections.close_all()
+
+
+class HTTPTransport:
+    """Поднимает wsgiref-сервер на свободном порту и ходит в него по HTTP."""
+    name = "http"
+
+    def __init__(self, app, workers=1):
+        self.queries = {}
+        self.app = counting_app(app, self.queries)
+        self.workers = workers
+
+    def __enter__(self):
+        self.server = make_server("127.0.0.1", 0, self.app,
+                                  server_class=PooledWSGIServer,
+                                  handler_class=QuietHandler)
+        self.server.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="benchmark-server")
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        executor = self.server.executor
+        barrier = threading.Barrier(self.workers)
+        for _ in range(self.workers):
+            executor.submit(_close_connections, barrier)
+        executor.shutdown(wait=True)
+        self.server.server_close()
+
+    def request(self, method, path, body, headers):
+        conn = http.client.HTTPConnection(*self.server.server_address)
+        try:
+            conn.request(method, path, body=body or None, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+
+def replay(trace, transport, warmup=0, concurrency=1):
+    """Проигрывает трассу; возвращает записи (эндпоинт, статус, с, SQL).
+
+    При concurrency > 1 запросы трассы разбирают по очереди несколько
+    потоков, так что порядок выполнения соседних запросов не задан.
+    """
+    client = Client()
+    records = []
+    entries = enumerate(trace)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                request_id, entry = next(entries, (None, None))
+            if entry is None:
+                return
+            body = urlencode(entry.get("data") or {}).encode()
+            headers = client.headers(entry, request_id)
+            started = time.perf_counter()
+            status = transport.request(entry["method"], entry["path"], body,
+                                       headers)
+            elapsed = time.perf_counter() - started
+            queries = transport.queries.pop(str(request_id), None)
+            if request_id >= warmup:
+                records.append((endpoint(entry), status, elapsed, queries))
+
+    if concurrency == 1:
+        worker()
+        return records
+
+    def run():
+        try:
+            worker()
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+
+def percentile(values, p):
+    """Перцентиль методом ближайшего ранга."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(records, seconds):
+    groups = defaultdict(list)
+    for record in records:
+        groups[record[0]].append(record)
+    endpoints = {}
+    for name, items in sorted(groups.items()):
+        latencies = [elapsed * 1000 for _, _, elapsed, _ in items]
+        queries = [count for _, _, _, count in items if count is not None]
+        endpoints[name] = dict(
+            count=len(items),
+            errors=sum(1 for _, status, _, _ in items if status >= 500),
+            queries=max(queries) if queries else None,
+            **{f"p{p}": round(percentile(latencies, p), 2)
+               for p in PERCENTILES})
+    return {"requests": len(records),
+            "rps": round(len(records) / seconds, 1) if seconds else None,
+            "endpoints": endpoints}
+
+
+def compare(current, baseline, tolerance=0.2):
+    """Список регрессий относительно сохранённого прогона.
+
+    Регрессия — p95 хуже базового больше чем на tolerance или любой
+    рост числа SQL-запросов эндпоинта.
+    """
+    problems = []
+    for name, stats in current["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if base is None:
+            continue
+        if stats["p95"] > base["p95"] * (1 + tolerance):
+            problems.append(f"{name}: p95 {base['p95']} -> "
+                            f"{stats['p95']} мс")
+        if (stats["queries"] is not None and base["queries"] is not None
+                and stats["queries"] > base["queries"]):
+            problems.append(f"{name}: SQL-запросов {base['queries']} -> "
+                            f"{stats['queries']}")
+    if (current["rps"] and baseline.get("rps")
+            and current["rps"] < baseline["rps"] / (1 + tolerance)):
+        problems.append(f"RPS {baseline['rps']} -> {current['rps']}")
+    return problems
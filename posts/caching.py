@@ -0,0 +1,101 @@
+"""Поколенческие ключи для кэша страниц ленты.
+
+У каждой области (главная, группа, профиль) есть номер версии в кэше.
+Ключ закэшированной страницы включает текущие версии её областей, а
+сигналы моделей увеличивают версии при изменениях, поэтому страница
+живёт сколько угодно долго и устаревает сразу после правки данных.
+
+Версия не меньше времени последнего изменения области в миллисекундах:
+по ней replicas.cacheable() видит, дошло ли изменение до реплики.
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = "posts:version:{}"
+
+
+def _now():
+    # После вытеснения ключа версия должна стать новой, а не начаться
+    # снова с единицы и совпасть с уже закэшированными страницами.
+    return int(time.time() * 1000)
+
+
+def get_versions(scopes):
+    keys = [VERSION_KEY.format(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, _now(), None)
+        versions.update(cache.get_many(missing))
+    return [versions[key] for key in keys]
+
+
+def bump(*scopes):
+    """Сдвигает версии областей не ниже текущего времени.
+
+    Внутри транзакции версии сдвигаются ещё раз после коммита: страница,
+    собранная до коммита без изменения, иначе осталась бы в кэше под
+    новой версией.
+    """
+    now = _now()
+    for scope in set(scopes):
+        key = VERSION_KEY.format(scope)
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            cache.set(key, now, None)
+            continue
+        if version < now:
+            cache.incr(key, now - version)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: bump(*scopes))
+
+
+def post_scopes(post, group_slug=None):
+    """Области, в которых виден пост; group_slug — прежняя группа."""
+    scopes = ["index", f"profile:{post.author.username}", f"post:{post.pk}"]
+    if post.group_id is not None:
+        scopes.append(f"group:{post.group.slug}")
+    if group_slug is not None:
+        scopes.append(f"group:{group_slug}")
+    return scopes
+
+
+def card_keys(posts):
+    """Пары (ключ, версии) отрендеренных карточек в кэше фрагментов.
+
+    Версии всех постов и версия групп читаются одним get_many.
+    """
+    *post_versions, groups_version = get_versions(
+        [f"post:{post.pk}" for post in posts] + ["groups"])
+    return [(f"posts:card:{post.pk}:{post.author.username}:"
+             f"{version}.{groups_version}", (version, groups_version))
+            for post, version in zip(posts, post_versions)]
+
+
+def card_key(post):
+    return card_keys([post])[0]
+
+
+def cache_feed(*scopes):
+    """Помечает view для кэширования в PageCacheMiddleware.
+
+    scopes — шаблоны областей, подставляются аргументы view:
+    @cache_feed("group:{slug}", "groups").
+    """
+    def decorator(view):
+        view.page_cache_scopes = scopes
+        return view
+    return decorator
+
+
+def page_key(request, scopes, view_kwargs):
+    """Ключ страницы в кэше и версии, из которых он собран."""
+    names = [scope.format(**view_kwargs) for scope in scopes]
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    versions = get_versions(names)
+    return f"posts:page:{path}:" + ".".join(map(str, versions)), versions
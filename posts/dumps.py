@@ -0,0 +1,329 @@
+"""Потоковая загрузка и выгрузка фикстур в формате dumpdata.
+
+loaddata читает весь JSON в память и сохраняет объекты по одному, что
+на дампах в гигабайты занимает часы. Здесь массив разбирается по одному
+объекту, объекты копятся пачками по модели и вставляются bulk_create,
+каждая пачка в своей транзакции; выгрузка пишет объекты по мере чтения
+queryset.iterator(). Память в обоих направлениях не зависит от размера
+дампа.
+
+bulk_create не вызывает сигналы, поэтому после загрузки производные
+данные (счётчики, ленты, поисковый индекс, кэш) пересобираются целиком.
+
+Посты и комментарии выгружаются со всех шардов, а загружаются на
+основную базу; по шардам авторов их разносит rebuild_derived().
+"""
+import gzip
+import json
+import sys
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from django.apps import apps
+from django.core import serializers
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.utils.encoding import is_protected_type
+
+from . import search, sharding, timeline
+from .models import Comment, ImageReference, UserStats
+
+# Что переносится дампом. Счётчики и ленты подписок не переносятся:
+# они пересчитываются из постов и подписок после загрузки. Профили
+# запросов, отметки репликации и раскладка по шардам относятся к
+# серверу, а не к данным сайта.
+MODELS = ["sites.site", "flatpages.flatpage", "auth.user", "posts.*"]
+DERIVED = {"posts.userstats", "posts.timelineentry", "posts.requestprofile",
+           "posts.replicaheartbeat", "posts.authorshard",
+           "posts.postticket", "posts.imagereference"}
+
+READ_SIZE = 64 * 1024
+
+
+def open_dump(path, mode, std=None):
+    """Файл дампа; .gz распаковывается на лету.
+
+    «-» — поток std, по умолчанию stdin/stdout процесса; он остаётся
+    открытым после выхода из with.
+    """
+    if path == "-":
+        if std is None:
+            std = sys.stdin if mode == "r" else sys.stdout
+        return nullcontext(std)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def iter_objects(stream):
+    """Разбирает JSON-массив из stream по одному элементу."""
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = stream.read(READ_SIZE)
+        eof = not chunk
+        buffer, position = buffer[position:] + chunk, 0
+
+    def next_char():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or eof:
+                return buffer[position:position + 1]
+            fill()
+
+    if next_char() != "[":
+        raise ValueError("Дамп должен быть JSON-массивом")
+    position += 1
+    if next_char() == "]":
+        return
+    while True:
+        next_char()
+        while True:
+            try:
+                obj, position = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+        yield obj
+        char = next_char()
+        position += 1
+        if char == "]":
+            return
+        if char != ",":
+            raise ValueError(f"Неожиданный символ {char!r} в дампе")
+
+
+def selected_models(labels=MODELS):
+    models = []
+    for label in labels:
+        app_label, _, name = label.partition(".")
+        if name == "*":
+            models.extend(
+                model for model in apps.get_app_config(app_label).get_models()
+                if model._meta.label_lower not in DERIVED)
+        else:
+            models.append(apps.get_model(app_label, name))
+    return models
+
+
+def _m2m_fields(model):
+    return [field for field in model._meta.many_to_many
+            if field.remote_field.through._meta.auto_created]
+
+
+def _through_columns(field):
+    through = field.remote_field.through._meta
+    return (through.get_field(field.m2m_field_name()).attname,
+            through.get_field(field.m2m_reverse_field_name()).attname)
+
+
+@contextmanager
+def explicit_dates(model):
+    """Снимает auto_now/auto_now_add с полей модели на время вставки.
+
+    bulk_create проставляет таким полям текущее время, а у загружаемых
+    объектов даты уже есть; loaddata обходит это сохранением с raw=True.
+    """
+    fields = [field for field in model._meta.concrete_fields
+              if getattr(field, "auto_now", False)
+              or getattr(field, "auto_now_add", False)]
+    flags = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, flags):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class BulkLoader:
+    """Копит объекты дампа и вставляет их пачками по batch_size."""
+
+    def __init__(self, batch_size=1000, using="default", models=None):
+        self.batch_size = batch_size
+        self.using = using
+        self.models = set(models or selected_models())
+        self.pending = {}
+        self.loaded = Counter()
+        self.skipped = Counter()
+
+    def add(self, data):
+        try:
+            model = apps.get_model(data["model"])
+        except (LookupError, ValueError):
+            model = None
+        if model not in self.models:
+            self.skipped[data["model"]] += 1
+            return
+        deserialized = next(serializers.python.Deserializer(
+            [data], using=self.using, ignorenonexistent=True))
+        batch = self.pending.setdefault(model, [])
+        batch.append(deserialized)
+        if len(batch) >= self.batch_size:
+            self.flush(model)
+
+    def flush(self, model):
+        """Вставляет пачку; строки с уже занятым pk обновляются.
+
+        Как и loaddata, объект дампа заменяет существующий с тем же pk
+        (например, сайт, созданный миграцией django.contrib.sites).
+        """
+        batch = self.pending.pop(model, [])
+        if not batch:
+            return
+        manager = model._base_manager.using(self.using)
+        objects = [item.object for item in batch]
+        with transaction.atomic(using=self.using), explicit_dates(model):
+            existing = set(manager.filter(
+                pk__in=[obj.pk for obj in objects])
+                .values_list("pk", flat=True))
+            fields = [field.name for field in model._meta.concrete_fields
+                      if not field.primary_key]
+            if existing:
+                manager.bulk_update(
+                    [obj for obj in objects if obj.pk in existing], fields)
+            manager.bulk_create(
+                [obj for obj in objects if obj.pk not in existing])
+            for field in _m2m_fields(model):
+                through = field.remote_field.through
+                source, target = _through_columns(field)
+                if existing:
+                    through._base_manager.using(self.using).filter(
+                        **{f"{source}__in": existing}).delete()
+                rows = [through(**{source: item.object.pk, target: pk})
+                        for item in batch
+                        for pk in item.m2m_data.get(field.name, [])]
+                through._base_manager.using(self.using).bulk_create(rows)
+        self.loaded[model._meta.label_lower] += len(batch)
+
+    def finish(self):
+        for model in list(self.pending):
+            self.flush(model)
+
+    def load(self, stream):
+        """Загружает дамп с отложенной проверкой внешних ключей.
+
+        Пачки коммитятся по мере загрузки, а объекты в дампе могут
+        ссылаться на ещё не загруженные, поэтому ключи проверяются один
+        раз в конце, как это делает loaddata.
+        """
+        connection = connections[self.using]
+        with connection.constraint_checks_disabled():
+            for data in iter_objects(stream):
+                self.add(data)
+            self.finish()
+        tables = [model._meta.db_table for model in self.models]
+        tables += [field.remote_field.through._meta.db_table
+                   for model in self.models for field in _m2m_fields(model)]
+        connection.check_constraints(table_names=tables)
+        statements = connection.ops.sequence_reset_sql(no_style(),
+                                                       list(self.models))
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+
+
+def rebuild_derived():
+    """Пересобирает то, что при обычном сохранении ведут сигналы."""
+    if sharding.enabled():
+        # Как rebalance_shards: копии пользователей и групп на шардах,
+        # счётчик id постов и посты на шардах своих авторов.
+        for alias in sharding.shards()[1:]:
+            sharding.sync_reference(alias)
+        sharding.seed_tickets()
+        sharding.reconcile()
+    with transaction.atomic():
+        UserStats.objects.rebuild()
+        ImageReference.objects.rebuild()
+        timeline.rebuild()
+        search.reindex()
+    cache.clear()
+
+
+def _value(obj, field):
+    value = field.value_from_object(obj)
+    if is_protected_type(value):
+        return value
+    return field.value_to_string(obj)
+
+
+def _sources(model, using):
+    """Базы, с которых выгружается модель: шарды или только using."""
+    if model in sharding.SHARDED_MODELS:
+        return sharding.shards()
+    return [using]
+
+
+def dump(stream, models=None, batch_size=1000, using="default"):
+    """Пишет объекты в stream JSON-массивом в формате dumpdata.
+
+    Комментарии с других шардов выгружаются без pk: их id на разных
+    шардах пересекаются, а ссылок на них нет, как и в copy_posts.
+    """
+    models = serializers.sort_dependencies(
+        [(model._meta.app_config, [model])
+         for model in models or selected_models()])
+    encoder = DjangoJSONEncoder(ensure_ascii=True)
+    counts = Counter()
+    stream.write("[")
+    first = True
+    for model in models:
+        fields = [field for field in model._meta.local_fields
+                  if field.serialize and not field.primary_key]
+        m2m = [field for field in _m2m_fields(model) if field.serialize]
+        for alias in _sources(model, using):
+            keep_pk = model is not Comment or alias == using
+            queryset = model._base_manager.using(alias).order_by("pk")
+            batch = []
+            for obj in queryset.iterator(chunk_size=batch_size):
+                batch.append(obj)
+                if len(batch) < batch_size:
+                    continue
+                first = _write_batch(stream, encoder, model, fields, m2m,
+                                     batch, first, alias, keep_pk)
+                counts[model._meta.label_lower] += len(batch)
+                batch = []
+            if batch:
+                first = _write_batch(stream, encoder, model, fields, m2m,
+                                     batch, first, alias, keep_pk)
+                counts[model._meta.label_lower] += len(batch)
+    stream.write("]\n")
+    return counts
+
+
+def _write_batch(stream, encoder, model, fields, m2m, batch, first, using,
+                 keep_pk=True):
+    # Связи многие-ко-многим выбираются одним запросом на пачку, а не
+    # запросом на объект, как у сериализатора Django.
+    related = {}
+    pks = [obj.pk for obj in batch]
+    for field in m2m:
+        source, target = _through_columns(field)
+        values = {}
+        rows = (field.remote_field.through._base_manager.using(using)
+                .filter(**{f"{source}__in": pks}).order_by(target)
+                .values_list(source, target))
+        for pk, related_pk in rows:
+            values.setdefault(pk, []).append(related_pk)
+        related[field.name] = values
+
+    label = model._meta.label_lower
+    for obj in batch:
+        data = {field.name: _value(obj, field) for field in fields}
+        for field in m2m:
+            data[field.name] = related[field.name].get(obj.pk, [])
+        stream.write(("\n" if first else ",\n") + encoder.encode(
+            {"model": label, "pk": obj.pk if keep_pk else None,
+             "fields": data}))
+        first = False
+    return first
@@ -0,0 +1,73 @@
+"""Персональные фрагменты страниц («дыры» в закэшированном каркасе).
+
+Кэшируемая страница рендерится один раз для всех пользователей: вместо
+фрагментов, зависящих от пользователя, в HTML попадают метки
+<!--hole:имя:аргументы-->. Перед отдачей PageCacheMiddleware заполняет
+метки фрагментами текущего пользователя — по аналогии с ESI.
+"""
+import re
+from urllib.parse import quote, unquote
+
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Follow
+
+HOLE_RE = re.compile(r"<!--hole:(\w+)((?::[^:>]*)*)-->")
+
+renderers = {}
+
+
+def hole(name):
+    def decorator(func):
+        renderers[name] = func
+        return func
+    return decorator
+
+
+def placeholder(name, *args):
+    encoded = "".join(":" + quote(str(arg), safe="") for arg in args)
+    return mark_safe(f"<!--hole:{name}{encoded}-->")
+
+
+def render(name, request, *args):
+    return renderers[name](request, *args)
+
+
+def fill(html, request):
+    """Заменяет метки в каркасе фрагментами для request.user."""
+    def replace(match):
+        args = [unquote(arg) for arg in match.group(2).split(":")[1:]]
+        return render(match.group(1), request, *args)
+    return HOLE_RE.sub(replace, html)
+
+
+@hole("nav_user")
+def nav_user(request):
+    return render_to_string("includes/nav_user.html", {"user": request.user})
+
+
+@hole("menu")
+def menu(request, active):
+    return render_to_string("includes/menu.html", {"user": request.user,
+                                                   active: True})
+
+
+@hole("post_edit_link")
+def post_edit_link(request, username, post_id):
+    if request.user.username != username:
+        return ""
+    return render_to_string("includes/post_edit_link.html",
+                            {"username": username, "post_id": post_id})
+
+
+@hole("follow_button")
+def follow_button(request, username):
+    if request.user.username == username:
+        return ""
+    following = (request.user.is_authenticated
+                 and Follow.objects.filter(user=request.user,
+                                           author__username=username)
+                 .exists())
+    return render_to_string("includes/follow_button.html",
+                            {"username": username, "following": following})
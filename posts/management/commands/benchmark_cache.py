@@ -0,0 +1,56 @@
+import os
+import tempfile
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from yatube.cache_backends import SQLiteCache
+
+
+class Command(BaseCommand):
+    help = ("Сравнивает скорость операций SQLiteCache и LocMemCache "
+            "на типичной для ленты нагрузке")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ops", type=int, default=10000)
+        parser.add_argument("--value-size", type=int, default=20000,
+                            help="размер значения в байтах (~страница)")
+
+    def handle(self, *args, **options):
+        ops, value = options["ops"], "x" * options["value_size"]
+        with tempfile.TemporaryDirectory() as directory:
+            backends = {
+                "locmem": LocMemCache("bench", {"OPTIONS": {
+                    "MAX_ENTRIES": ops * 2}}),
+                "sqlite": SQLiteCache(os.path.join(directory, "cache.db"), {
+                    "OPTIONS": {"MAX_ENTRIES": ops * 2}}),
+                "default": caches["default"],
+            }
+            for name, cache in backends.items():
+                self.run(name, cache, ops, value)
+
+    def run(self, name, cache, ops, value):
+        keys = [f"bench:{i}" for i in range(ops)]
+        cache.set("bench:counter", 0, None)
+        timings = {
+            "set": self.measure(lambda k: cache.set(k, value), keys),
+            "get": self.measure(cache.get, keys),
+            "get_many(10)": self.measure(
+                cache.get_many, [keys[i:i + 10]
+                                 for i in range(0, ops, 10)]),
+            "incr": self.measure(lambda k: cache.incr("bench:counter"),
+                                 keys),
+        }
+        cache.delete_many(keys + ["bench:counter"])
+        line = ", ".join(f"{op}: {rate:,.0f} оп/с"
+                         for op, rate in timings.items())
+        self.stdout.write(f"{name:8} {line}")
+
+    @staticmethod
+    def measure(func, items):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        return len(items) / (time.perf_counter() - start)
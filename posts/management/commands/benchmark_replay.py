@@ -0,0 +1,91 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+
+from posts import benchmark
+
+TRANSPORTS = {"inprocess": benchmark.InProcessTransport,
+              "http": benchmark.HTTPTransport}
+
+
+class Command(BaseCommand):
+    help = ("Проигрывает трассу запросов против WSGI-приложения и печатает "
+            "задержки, RPS и число SQL-запросов по эндпоинтам")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--trace", help="JSONL-файл трассы; по "
+                                            "умолчанию собирается из базы")
+        parser.add_argument("--requests", type=int, default=500,
+                            help="длина собираемой трассы")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--save-trace",
+                            help="сохранить собранную трассу в файл")
+        parser.add_argument("--mode", choices=[*TRANSPORTS, "both"],
+                            default="inprocess")
+        parser.add_argument("--concurrency", type=int, default=1,
+                            help="число одновременных клиентов и потоков "
+                                 "HTTP-сервера")
+        parser.add_argument("--warmup", type=int, default=20,
+                            help="сколько первых запросов не учитывать")
+        parser.add_argument("--save-baseline",
+                            help="сохранить результат как базовый")
+        parser.add_argument("--baseline",
+                            help="сравнить с базовым результатом")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="допустимое ухудшение p95 и RPS")
+
+    def handle(self, *args, **options):
+        if options["trace"]:
+            trace = benchmark.load_trace(options["trace"])
+        else:
+            try:
+                trace = benchmark.build_trace(options["requests"],
+                                              options["seed"])
+            except ValueError as error:
+                raise CommandError(error)
+        if options["save_trace"]:
+            benchmark.save_trace(options["save_trace"], trace)
+
+        app = get_wsgi_application()
+        modes = list(TRANSPORTS) if options["mode"] == "both" \
+            else [options["mode"]]
+        results = {}
+        for mode in modes:
+            concurrency = options["concurrency"]
+            with TRANSPORTS[mode](app, concurrency) as transport:
+                started = time.perf_counter()
+                records = benchmark.replay(trace, transport,
+                                           options["warmup"], concurrency)
+                results[mode] = benchmark.summarize(
+                    records, time.perf_counter() - started)
+            self.report(mode, results[mode])
+
+        if options["save_baseline"]:
+            with open(options["save_baseline"], "w") as output:
+                json.dump(results, output, ensure_ascii=False, indent=2)
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)
+            problems = [f"{mode}: {problem}"
+                        for mode, result in results.items()
+                        if mode in baseline
+                        for problem in benchmark.compare(
+                            result, baseline[mode], options["tolerance"])]
+            if problems:
+                raise CommandError("Регрессия относительно базового "
+                                   "прогона:\n" + "\n".join(problems))
+            self.stdout.write(self.style.SUCCESS("Регрессий нет"))
+
+    def report(self, mode, result):
+        self.stdout.write(f"{mode}: запросов {result['requests']}, "
+                          f"RPS {result['rps']}")
+        self.stdout.write(f"  {'эндпоинт':28} {'n':>5} {'p50':>8} "
+                          f"{'p95':>8} {'p99':>8} {'SQL':>4} {'5xx':>4}")
+        for name, stats in result["endpoints"].items():
+            queries = "-" if stats["queries"] is None else stats["queries"]
+            self.stdout.write(
+                f"  {name:28} {stats['count']:>5} {stats['p50']:>8} "
+                f"{stats['p95']:>8} {stats['p99']:>8} {queries:>4} "
+                f"{stats['errors']:>4}")
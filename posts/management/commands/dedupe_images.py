@@ -0,0 +1,66 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile
+
+from posts import caching, sharding, thumbnails
+from posts.models import ImageReference, Post
+from posts.storage import is_content_addressed
+
+
+class Command(BaseCommand):
+    help = ("Переносит картинки постов в хранилище с именами по "
+            "содержимому и удаляет дубликаты")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Только показать, что будет перенесено")
+
+    def handle(self, *args, **options):
+        moved = freed = 0
+        for alias in sharding.shards():
+            shard_moved, shard_freed = self.process(alias, options)
+            moved += shard_moved
+            freed += shard_freed
+        self.stdout.write(self.style.SUCCESS(
+            f"Перенесено картинок: {moved}, освобождено байт: {freed}"))
+
+    def process(self, alias, options):
+        """Переносит картинки постов одного шарда.
+
+        Возвращает число перенесённых картинок и освобождённых байт.
+        """
+        storage = Post._meta.get_field("image").storage
+        posts = (Post.objects.using(alias)
+                 .exclude(image="").exclude(image=None)
+                 .select_related("author", "group"))
+        moved = freed = 0
+        for post in posts.iterator():
+            old_name = post.image.name
+            if is_content_addressed(old_name):
+                continue
+            if not storage.exists(old_name):
+                self.stderr.write(f"Нет файла {old_name} у поста {post.pk}")
+                continue
+            if options["dry_run"]:
+                self.stdout.write(f"{post.pk}: {old_name}")
+                continue
+            # Как в Post.save: файл и счётчик ссылок под одной
+            # блокировкой, чтобы thumbnails.release() их не разделил.
+            with transaction.atomic():
+                with storage.open(old_name) as content:
+                    new_name = storage.save(
+                        "posts/" + os.path.basename(old_name), content)
+                posts.filter(pk=post.pk).update(image=new_name)
+                ImageReference.objects.shift(new_name, 1)
+            moved += 1
+            if not any(Post.objects.using(shard).filter(image=old_name)
+                       .exists() for shard in sharding.shards()):
+                default.kvstore.delete(ImageFile(old_name, storage))
+                freed += storage.size(old_name)
+                storage.delete(old_name)
+            caching.bump(*caching.post_scopes(post))
+            thumbnails.generate(post.pk, alias)
+        return moved, freed
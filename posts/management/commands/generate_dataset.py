@@ -0,0 +1,149 @@
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from posts import dumps
+from posts.models import Comment, Follow, Group, Post, User
+
+WORDS = (
+    "кошка собака день утро вечер город дорога письмо книга дневник "
+    "сегодня вчера снова долго тихо весело грустно думать писать читать "
+    "гулять работать море лес поле дом сад река зима лето осень весна "
+    "друг брат сестра отец мать время жизнь работа дело слово мысль"
+).split()
+
+
+class Command(BaseCommand):
+    help = ("Генерирует набор данных заданного размера: пользователей, "
+            "группы, посты, комментарии и подписки")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--groups", type=int, default=20)
+        parser.add_argument("--posts", type=int, default=20000)
+        parser.add_argument("--comments", type=int, default=50000)
+        parser.add_argument("--follows", type=int, default=20,
+                            help="среднее число подписок пользователя")
+        parser.add_argument("--alpha", type=float, default=1.1,
+                            help="показатель степенного распределения "
+                                 "активности и популярности авторов")
+        parser.add_argument("--days", type=int, default=365,
+                            help="за сколько дней распределить посты")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        self.now = timezone.now()
+        self.start = self.now - timedelta(days=options["days"])
+
+        users = self.create_users(options["users"], options["seed"])
+        groups = self.create_groups(options["groups"], options["seed"])
+        # Вес i-го автора ~ 1 / i^alpha: немногие пишут и собирают
+        # подписчиков больше всех остальных вместе взятых.
+        weights = list(accumulate(1 / rank ** options["alpha"]
+                                  for rank in range(1, len(users) + 1)))
+        posts = self.create_posts(options["posts"], users, groups, weights)
+        self.create_comments(options["comments"], users, posts)
+        self.create_follows(options["follows"], users, weights)
+
+        dumps.rebuild_derived()
+        self.stdout.write(self.style.SUCCESS(
+            f"Создано: пользователей {len(users)}, групп {len(groups)}, "
+            f"постов {posts[1]}, комментариев {options['comments']}"))
+
+    def insert(self, model, objects):
+        with transaction.atomic(), dumps.explicit_dates(model):
+            model.objects.bulk_create(objects)
+
+    def insert_batched(self, model, objects):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                self.insert(model, batch)
+                batch = []
+        self.insert(model, batch)
+
+    @staticmethod
+    def next_pk(model):
+        return (model.objects.aggregate(pk=Max("pk"))["pk"] or 0) + 1
+
+    def create_users(self, count, seed):
+        # Id задаются явно: bulk_create в SQLite не возвращает их.
+        first = self.next_pk(User)
+        password = make_password(None)
+        self.insert_batched(User, (
+            User(pk=first + i, username=f"gen{seed}_{first + i}",
+                 password=password, date_joined=self.start)
+            for i in range(count)))
+        return list(range(first, first + count))
+
+    def create_groups(self, count, seed):
+        first = self.next_pk(Group)
+        self.insert(Group, [
+            Group(pk=first + i, title=f"Группа {first + i}",
+                  slug=f"gen{seed}-{first + i}",
+                  description=self.text(5))
+            for i in range(count)])
+        return list(range(first, first + count))
+
+    def text(self, words):
+        return " ".join(self.random.choices(WORDS, k=words)).capitalize()
+
+    def date(self, start, end):
+        return start + (end - start) * self.random.random()
+
+    def create_posts(self, count, users, groups, weights):
+        """Посты по возрастанию даты; возвращает (первый id, число)."""
+        first = self.next_pk(Post)
+        step = (self.now - self.start) / max(count, 1)
+        authors = self.random.choices(users, cum_weights=weights, k=count)
+
+        def posts():
+            for i, author in enumerate(authors):
+                group = None
+                if groups and self.random.random() < 0.5:
+                    group = self.random.choice(groups)
+                yield Post(pk=first + i, author_id=author, group_id=group,
+                           text=self.text(self.random.randint(5, 60)),
+                           pub_date=self.start + step * i)
+        self.insert_batched(Post, posts())
+        return first, count
+
+    def create_comments(self, count, users, posts):
+        first_post, post_count = posts
+        if not post_count:
+            return
+        step = (self.now - self.start) / post_count
+
+        def comments():
+            for _ in range(count):
+                index = self.random.randrange(post_count)
+                posted = self.start + step * index
+                yield Comment(post_id=first_post + index,
+                              author_id=self.random.choice(users),
+                              text=self.text(self.random.randint(2, 20)),
+                              created=self.date(posted, self.now))
+        self.insert_batched(Comment, comments())
+
+    def create_follows(self, average, users, weights):
+        # На популярных авторов подписываются чаще, в той же пропорции,
+        # в какой они пишут.
+        def follows():
+            for user in users:
+                count = min(int(self.random.expovariate(1 / average)),
+                            len(users) - 1) if average else 0
+                authors = set(self.random.choices(users, cum_weights=weights,
+                                                  k=count))
+                authors.discard(user)
+                for author in sorted(authors):
+                    yield Follow(user_id=user, author_id=author)
+        self.insert_batched(Follow, follows())
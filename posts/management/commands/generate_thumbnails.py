@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from posts import sharding, thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = "Строит миниатюры для уже загруженных картинок постов"
+
+    def handle(self, *args, **options):
+        count = 0
+        for alias in sharding.shards():
+            count += self.process(alias)
+        self.stdout.write(self.style.SUCCESS(f"Обработано постов: {count}"))
+
+    def process(self, alias):
+        """Обрабатывает посты одного шарда и возвращает их число."""
+        posts = (Post.objects.using(alias)
+                 .exclude(image="").exclude(image=None))
+        for post in posts.filter(image_width=None).iterator():
+            width, height = thumbnails.dimensions(post.image)
+            if width is None:
+                self.stderr.write(f"Не читается картинка поста {post.pk}")
+                continue
+            posts.filter(pk=post.pk).update(image_width=width,
+                                            image_height=height)
+        count = 0
+        for post_id in posts.values_list("pk", flat=True).iterator():
+            thumbnails.generate(post_id, alias)
+            count += 1
+        return count
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import profiling
+from posts.models import User
+
+
+class Command(BaseCommand):
+    help = ("Выдаёт сотруднику токен для профилирования его запросов: "
+            "заголовок X-Profile")
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="сотрудник сайта")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options["username"],
+                                   is_staff=True).first()
+        if user is None:
+            raise CommandError(f"Нет сотрудника {options['username']}")
+        hours = settings.PROFILING_TOKEN_MAX_AGE // 3600
+        self.stderr.write(f"Токен действует {hours} ч.")
+        self.stdout.write(profiling.make_token(user))
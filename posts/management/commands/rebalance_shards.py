@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from posts import sharding
+
+
+class Command(BaseCommand):
+    help = ("Копирует пользователей и группы на шарды и переносит авторов "
+            "между шардами, выравнивая число постов")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tolerance", type=float, default=0.1,
+                            help="допустимый разрыв между шардами, доля "
+                                 "от среднего числа постов")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="только показать переносы")
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError("Шардов нет: DATABASE_SHARDS содержит "
+                               "только основную базу")
+        for alias in sharding.shards():
+            vendor = connections[alias].vendor
+            if vendor != "sqlite":
+                raise CommandError(f"Шарды поддерживаются только на SQLite, "
+                                   f"а {alias} — {vendor}")
+
+        if not options["dry_run"]:
+            for alias in sharding.shards():
+                if alias != DEFAULT_DB_ALIAS:
+                    sharding.sync_reference(alias)
+            self.stdout.write("Пользователи и группы скопированы на шарды")
+            sharding.seed_tickets()
+            moved = sharding.reconcile()
+            if moved:
+                self.stdout.write(f"Возвращено на свои шарды постов: "
+                                  f"{moved}")
+
+        loads = sharding.loads()
+        moves = sharding.plan(loads, options["tolerance"])
+        for author_id, source, target in moves:
+            count = loads[source][author_id]
+            self.stdout.write(f"Автор {author_id}: {source} -> {target}, "
+                              f"постов: {count}")
+            if not options["dry_run"]:
+                sharding.move_author(author_id, source, target)
+            loads[target][author_id] = loads[source].pop(author_id)
+
+        for alias in settings.DATABASE_SHARDS:
+            self.stdout.write(f"{alias}: авторов {len(loads[alias])}, "
+                              f"постов {sum(loads[alias].values())}")
+        if options["dry_run"]:
+            self.stdout.write(f"Будет перенесено авторов: {len(moves)}")
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Перенесено авторов: {len(moves)}"))
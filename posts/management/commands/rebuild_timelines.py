@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from posts import timeline
+from posts.models import TimelineEntry
+
+
+class Command(BaseCommand):
+    help = "Заново заполняет ленты подписок из таблиц Follow и Post"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--settle", action="store_true",
+                            help="только перевести авторов между push и "
+                                 "pull, не пересобирая ленты; запускать "
+                                 "по расписанию")
+
+    def handle(self, *args, **options):
+        if options["settle"]:
+            pushed = timeline.settle()
+            self.stdout.write(self.style.SUCCESS(
+                f"Возвращено на раскладку авторов: {pushed}"))
+            return
+        with transaction.atomic():
+            timeline.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Записей в лентах: {TimelineEntry.objects.count()}"))
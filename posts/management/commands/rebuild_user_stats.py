@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from posts.models import UserStats
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает счётчики записей и подписок пользователей"
+
+    def add_arguments(self, parser):
+        parser.add_argument("user_ids", nargs="*", type=int,
+                            help="id пользователей; по умолчанию все")
+
+    def handle(self, *args, **options):
+        stats = UserStats.objects.rebuild(options["user_ids"] or None)
+        self.stdout.write(self.style.SUCCESS(
+            f"Пересчитано пользователей: {len(stats)}"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from posts import search
+
+
+class Command(BaseCommand):
+    help = "Заново заполняет полнотекстовый индекс постов"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = search.reindex()
+        self.stdout.write(self.style.SUCCESS(f"Постов в индексе: {count}"))
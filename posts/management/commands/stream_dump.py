@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from posts import dumps
+
+
+class Command(BaseCommand):
+    help = ("Выгружает сайты, страницы, пользователей и посты в формате "
+            "dumpdata, не держа данные в памяти")
+
+    def add_arguments(self, parser):
+        parser.add_argument("-o", "--output", default="-",
+                            help="файл .json или .json.gz; по умолчанию "
+                                 "stdout")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # Дамп пишется кусками, так что перевод строки после каждого
+        # не нужен, как и в dumpdata.
+        self.stdout.ending = None
+        with dumps.open_dump(options["output"], "w",
+                             self.stdout) as stream:
+            counts = dumps.dump(stream, batch_size=options["batch_size"])
+        self.stderr.write(self.style.SUCCESS(
+            f"Выгружено объектов: {sum(counts.values())}"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from posts import dumps
+
+
+class Command(BaseCommand):
+    help = ("Загружает дамп в формате dumpdata потоково, пачками "
+            "bulk_create, и пересобирает производные данные")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="файл .json или .json.gz; - — stdin")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        loader = dumps.BulkLoader(options["batch_size"])
+        with dumps.open_dump(options["path"], "r") as stream:
+            loader.load(stream)
+        for label, count in sorted(loader.loaded.items()):
+            self.stdout.write(f"{label}: {count}")
+        if loader.skipped:
+            skipped = ", ".join(f"{label} ({count})" for label, count
+                                in sorted(loader.skipped.items()))
+            self.stdout.write(f"Пропущено: {skipped}")
+
+        dumps.rebuild_derived()
+        self.stdout.write(self.style.SUCCESS(
+            f"Загружено объектов: {sum(loader.loaded.values())}"))
@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from posts import replicas
+
+
+class Command(BaseCommand):
+    help = ("Отмечает время на основной базе и копирует её в реплики "
+            "SQLite из DATABASE_REPLICAS")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float,
+                            help="повторять каждые N секунд")
+        parser.add_argument("--heartbeat-only", action="store_true",
+                            help="только отметка времени: данные "
+                                 "реплицирует сама СУБД")
+
+    def handle(self, *args, **options):
+        if not options["heartbeat_only"]:
+            for alias in settings.DATABASE_REPLICAS:
+                vendor = connections[alias].vendor
+                if vendor != "sqlite":
+                    raise CommandError(f"Копировать можно только SQLite, "
+                                       f"а {alias} — {vendor}")
+        while True:
+            replicas.beat()
+            if not options["heartbeat_only"]:
+                for alias in settings.DATABASE_REPLICAS:
+                    self.copy(alias)
+            self.stdout.write(f"Реплики обновлены: "
+                              f"{', '.join(settings.DATABASE_REPLICAS)}")
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
+
+    def copy(self, alias):
+        """Копирует основную базу в реплику через backup API SQLite.
+
+        Читатели реплики видят её либо целиком старой, либо целиком
+        новой: backup пишет страницы под блокировкой базы-приёмника.
+        """
+        source, target = connections[DEFAULT_DB_ALIAS], connections[alias]
+        source.ensure_connection()
+        target.ensure_connection()
+        source.connection.backup(target.connection)
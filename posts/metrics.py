@@ -0,0 +1,261 @@
+"""Метрики запросов: заголовок Server-Timing и /metrics для Prometheus.
+
+MetricsMiddleware меряет каждый запрос: общее время, число и время
+SQL-запросов, время рендера шаблонов, попадания и промахи кэша. Итоги
+запроса отдаются в заголовке Server-Timing (их видно во вкладке Network
+браузера) и копятся в гистограммах по имени view, которые /metrics
+отдаёт в текстовом формате Prometheus.
+
+Сбор стоит пары вызовов perf_counter() на SQL-запрос и шаблон и одной
+блокировки на запрос, так что его можно не выключать под нагрузкой.
+Гистограммы живут в памяти процесса: при нескольких WSGI-процессах
+каждый отдаёт свои, как prometheus_client без multiprocess-режима.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+from django.utils.crypto import constant_time_compare
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class RequestMetrics:
+    """Счётчики одного запроса; сам объект — обёртка execute_wrapper."""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_seconds += time.perf_counter() - started
+
+
+def current():
+    """Метрики запроса, который обрабатывает этот поток, или None."""
+    return getattr(_local, "metrics", None)
+
+
+def record_cache_lookup(hits, misses):
+    metrics = current()
+    if metrics is not None:
+        metrics.cache_hits += hits
+        metrics.cache_misses += misses
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = current()
+        # Вложенные шаблоны (карточки постов внутри ленты) уже входят во
+        # время внешнего.
+        if metrics is None or metrics.template_depth:
+            return super().render(context, request)
+        metrics.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_seconds += time.perf_counter() - started
+            metrics.template_depth -= 1
+
+
+class TimedTemplates(DjangoTemplates):
+    """Шаблоны Django, время рендера которых попадает в метрики."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name),
+                                 self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+def _labels(names, values):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"')
+               .replace("\n", "\\n") for value in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels):
+        self.name, self.documentation = name, documentation
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, values, amount=1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+    def samples(self):
+        for values, total in sorted(self.series.items()):
+            yield f"{self.name}{{{_labels(self.labels, values)}}} {total}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name, self.documentation = name, documentation
+        self.labels, self.buckets = labels, buckets
+        # Значения ряда: число попаданий в каждую корзину (последняя —
+        # +Inf), сумма и количество наблюдений.
+        self.series = {}
+
+    def observe(self, values, value):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [[0] * (len(self.buckets) + 1),
+                                            0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for values, (counts, total, count) in sorted(self.series.items()):
+            labels = _labels(self.labels, values)
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                yield (f'{self.name}_bucket{{{labels},le="{bound}"}} '
+                       f"{cumulative}")
+            yield f"{self.name}_sum{{{labels}}} {total}"
+            yield f"{self.name}_count{{{labels}}} {count}"
+
+
+REQUESTS = Counter("yatube_requests_total", "Обработанные запросы",
+                   ("view", "method", "status"))
+DURATION = Histogram("yatube_request_duration_seconds",
+                     "Время обработки запроса", ("view",), DURATION_BUCKETS)
+SQL_DURATION = Histogram("yatube_request_sql_seconds",
+                         "Время SQL-запросов за запрос", ("view",),
+                         DURATION_BUCKETS)
+SQL_QUERIES = Histogram("yatube_request_sql_queries",
+                        "Число SQL-запросов за запрос", ("view",),
+                        QUERY_BUCKETS)
+TEMPLATE_DURATION = Histogram("yatube_request_template_seconds",
+                              "Время рендера шаблонов за запрос", ("view",),
+                              DURATION_BUCKETS)
+CACHE_LOOKUPS = Counter("yatube_cache_lookups_total",
+                        "Чтения ключей кэша", ("view", "result"))
+METRICS = (REQUESTS, DURATION, SQL_DURATION, SQL_QUERIES, TEMPLATE_DURATION,
+           CACHE_LOOKUPS)
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    return match.view_name if match is not None else "unresolved"
+
+
+def record(request, response, metrics, duration):
+    view = view_name(request)
+    with _lock:
+        REQUESTS.inc((view, request.method, response.status_code))
+        DURATION.observe((view,), duration)
+        SQL_DURATION.observe((view,), metrics.sql_seconds)
+        SQL_QUERIES.observe((view,), metrics.queries)
+        TEMPLATE_DURATION.observe((view,), metrics.template_seconds)
+        if metrics.cache_hits:
+            CACHE_LOOKUPS.inc((view, "hit"), metrics.cache_hits)
+        if metrics.cache_misses:
+            CACHE_LOOKUPS.inc((view, "miss"), metrics.cache_misses)
+
+
+def server_timing(metrics, duration):
+    return ", ".join([
+        f"total;dur={duration * 1000:.1f}",
+        f'db;desc="{metrics.queries} queries";'
+        f"dur={metrics.sql_seconds * 1000:.1f}",
+        f"tpl;dur={metrics.template_seconds * 1000:.1f}",
+        f'cache;desc="{metrics.cache_hits} hits, '
+        f'{metrics.cache_misses} misses"',
+    ])
+
+
+def render():
+    lines = []
+    with _lock:
+        for metric in METRICS:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        for metric in METRICS:
+            metric.series.clear()
+
+
+class MetricsMiddleware:
+    """Меряет запрос целиком, поэтому стоит первым в MIDDLEWARE."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        previous, metrics = current(), RequestMetrics()
+        _local.metrics = metrics
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _local.metrics = previous
+        duration = time.perf_counter() - started
+        record(request, response, metrics, duration)
+        if settings.METRICS_SERVER_TIMING:
+            response["Server-Timing"] = server_timing(metrics, duration)
+        return response
+
+
+def allowed(request):
+    """Можно ли отдать метрики.
+
+    Нужен адрес из METRICS_ALLOWED_IPS и, кроме него, сотрудник сайта
+    или токен METRICS_TOKEN в заголовке «Authorization: Bearer». За
+    обратным прокси на том же сервере все запросы приходят с 127.0.0.1,
+    так что одного адреса недостаточно.
+    """
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        return False
+    if request.user.is_staff:
+        return True
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    scheme, _, token = header.partition(" ")
+    return bool(settings.METRICS_TOKEN and scheme.lower() == "bearer"
+                and constant_time_compare(token, settings.METRICS_TOKEN))
+
+
+def export(request):
+    """Метрики в формате Prometheus, если их можно отдать (allowed)."""
+    if not allowed(request):
+        raise Http404
+    return HttpResponse(render(),
+                        content_type="text/plain; version=0.0.4; "
+                                     "charset=utf-8")
@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from . import caching, holes, replicas
+
+
+class PageCacheMiddleware:
+    """Полностраничный кэш для view, помеченных caching.cache_feed.
+
+    Страница рендерится один раз как общий для всех каркас, в котором
+    персональные фрагменты заменены метками (см. posts/holes.py).
+    Анонимный посетитель без сессионной cookie получает готовый HTML
+    из кэша, не затрагивая ни сессию, ни ORM. Вошедшему пользователю
+    отдаётся тот же каркас с заполненными под него фрагментами.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        scopes = getattr(view_func, "page_cache_scopes", None)
+        if scopes is None or request.method != "GET":
+            return None
+        has_session = settings.SESSION_COOKIE_NAME in request.COOKIES
+        if has_session and replicas.pinned(request):
+            # Только что записавший видит страницу с основной базы, а не
+            # из кэша, куда её могли положить до его записи.
+            return None
+
+        key, versions = caching.page_key(request, scopes, view_kwargs)
+        anonymous = not has_session or not request.user.is_authenticated
+        if anonymous:
+            html = cache.get(f"{key}:anonymous")
+            if html is not None:
+                return self.respond(html)
+
+        skeleton = cache.get(key)
+        cacheable = True
+        if skeleton is None:
+            request.page_skeleton = True
+            try:
+                response = view_func(request, *view_args, **view_kwargs)
+            finally:
+                request.page_skeleton = False
+            if response.status_code != 200 or response.streaming:
+                return response
+            skeleton = response.content.decode(response.charset)
+            cacheable = replicas.cacheable(versions)
+            if cacheable:
+                cache.set(key, skeleton, settings.FEED_CACHE_TIMEOUT)
+
+        html = holes.fill(skeleton, request)
+        if anonymous and cacheable:
+            cache.set(f"{key}:anonymous", html, settings.FEED_CACHE_TIMEOUT)
+        return self.respond(html)
+
+    def respond(self, html):
+        response = HttpResponse(html)
+        patch_vary_headers(response, ("Cookie",))
+        return response
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.9 on 2026-10-18 04:35
+
+from django.core.exceptions import SuspiciousOperation
+from django.db import migrations, models
+
+
+def fill_dimensions(apps, schema_editor):
+    Post = apps.get_model("posts", "Post")
+    for post in Post.objects.exclude(image="").exclude(image=None).iterator():
+        try:
+            post.image_width, post.image_height = (post.image.width,
+                                                   post.image.height)
+        except (OSError, ValueError, SuspiciousOperation):
+            # Файла нет или он не читается: размеры останутся пустыми.
+            continue
+        post.save(update_fields=["image_width", "image_height"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0012_post_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_dimensions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.9 on 2026-10-18 04:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0013_post_image_dimensions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostImage',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='image_meta', serialize=False, to='posts.Post')),
+                ('source', models.CharField(max_length=100, verbose_name='Исходный файл')),
+                ('sha256', models.CharField(db_index=True, max_length=64, verbose_name='SHA-256')),
+                ('picture', models.TextField(help_text='JSON для includes/post_picture.html', verbose_name='Варианты')),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.2.9 on 2026-10-18 04:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('posts', '0015_post_image_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Снят')),
+                ('method', models.CharField(max_length=10, verbose_name='Метод')),
+                ('path', models.TextField(verbose_name='Адрес')),
+                ('view', models.CharField(max_length=200, verbose_name='View')),
+                ('status', models.PositiveSmallIntegerField(verbose_name='Статус')),
+                ('duration', models.FloatField(verbose_name='Время, мс')),
+                ('queries', models.PositiveIntegerField(verbose_name='SQL-запросов')),
+                ('sql_duration', models.FloatField(verbose_name='Время SQL, мс')),
+                ('samples', models.PositiveIntegerField(verbose_name='Выборок стека')),
+                ('trigger', models.CharField(choices=[('token', 'Подписанный токен'), ('sample', 'Выборка')], max_length=10, verbose_name='Причина')),
+                ('stacks_file', models.CharField(max_length=255, verbose_name='Файл стеков')),
+                ('sql', models.TextField(help_text='JSON: [начало, длительность в мс, запрос] по порядку выполнения', verbose_name='SQL')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Профиль запроса',
+                'verbose_name_plural': 'Профили запросов',
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 2.2.9 on 2026-10-18 04:58
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min
+import posts.storage
+
+
+def remove_duplicate_follows(apps, schema_editor):
+    """Оставляет по одной подписке на пару (user, author).
+
+    Дубли появлялись при гонке двух profile_follow; каждый из них учтён
+    в UserStats, поэтому счётчики уменьшаются на число удалённых.
+    """
+    Follow = apps.get_model("posts", "Follow")
+    UserStats = apps.get_model("posts", "UserStats")
+    duplicates = (Follow.objects.order_by().values("user", "author")
+                  .annotate(count=Count("id"), keep=Min("id"))
+                  .filter(count__gt=1))
+    for row in duplicates:
+        extra = row["count"] - 1
+        Follow.objects.filter(user=row["user"], author=row["author"]).exclude(
+            id=row["keep"]).delete()
+        UserStats.objects.filter(user=row["author"]).update(
+            followers_count=F("followers_count") - extra)
+        UserStats.objects.filter(user=row["user"]).update(
+            following_count=F("following_count") - extra)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0016_requestprofile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, null=True, storage=posts.storage.ContentAddressedStorage(), upload_to='posts/', verbose_name='Изображение'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', '-created'], name='comment_post_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-pub_date', '-id'], name='post_pub_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['author', '-pub_date', '-id'], name='post_author_pub_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['group', '-pub_date', '-id'], name='post_group_pub_date_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_follows,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='follow',
+            constraint=models.UniqueConstraint(fields=('user', 'author'), name='follow_user_author_unique'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.9 on 2026-10-18 05:33
+
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+from django.db.models import Count
+
+from posts.storage import is_content_addressed
+
+
+def count_references(apps, schema_editor):
+    # Счётчики живут на основной базе; посты на других шардах
+    # досчитывает ImageReference.objects.rebuild().
+    if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+        return
+    Post = apps.get_model("posts", "Post")
+    ImageReference = apps.get_model("posts", "ImageReference")
+    images = (Post.objects.order_by().values_list("image")
+              .annotate(n=Count("id")))
+    ImageReference.objects.bulk_create(
+        [ImageReference(name=name, references=count)
+         for name, count in images if is_content_addressed(name)],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0019_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageReference',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='Файл')),
+                ('references', models.PositiveIntegerField(default=0, verbose_name='Постов')),
+            ],
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.9 on 2026-10-18 05:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_pulled(apps, schema_editor):
+    # До этой миграции режим автора определялся порогом на лету.
+    UserStats = apps.get_model("posts", "UserStats")
+    UserStats.objects.using(schema_editor.connection.alias).filter(
+        followers_count__gte=settings.FEED_PULL_THRESHOLD,
+    ).update(pulled=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0020_imagereference'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstats',
+            name='pulled',
+            field=models.BooleanField(default=False, help_text='Посты не раскладываются по лентам подписчиков, а подмешиваются при чтении (posts/timeline.py)', verbose_name='Лента по запросу'),
+        ),
+        migrations.RunPython(mark_pulled, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,11 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .storage import ContentAddressedStorage, is_content_addressed
 
 User = get_user_model()
 
@@ -13,6 +19,46 @@ class Group(models.Model):
         return self.title
 
 
+class PostQuerySet(models.QuerySet):
+    def for_feed(self):
+        """Посты вместе со всем, что выводит карточка post_card.html.
+
+        Число комментариев считается коррелированным подзапросом, а не
+        JOIN + GROUP BY, чтобы не группировать ленту по всем колонкам.
+        """
+        comments = (Comment.objects.filter(post=OuterRef("pk")).order_by()
+                    .values("post").annotate(n=Count("id")).values("n"))
+        return (self.select_related("author", "group", "image_meta")
+                .annotate(comments_count=Coalesce(
+                    Subquery(comments, output_field=models.IntegerField()),
+                    0)))
+
+    def create(self, **kwargs):
+        """Как QuerySet.create, но база по умолчанию выбирается по посту.
+
+        QuerySet.create сохраняет в базу запроса, а без подсказок
+        роутер шардов не знает автора; save() без using передаёт ему
+        сам пост.
+        """
+        if self._db is not None:
+            return super().create(**kwargs)
+        post = self.model(**kwargs)
+        self._for_write = True
+        post.save(force_insert=True)
+        return post
+
+
+class PostManager(models.Manager.from_queryset(PostQuerySet)):
+    def for_author(self, author_id):
+        """Посты автора.
+
+        Подсказка author_id нужна роутеру шардов (posts/sharding.py):
+        запрос уходит на шард автора, как и author.posts.
+        """
+        return (self.db_manager(hints={"author_id": author_id})
+                .filter(author=author_id))
+
+
 class Post(models.Model):
     text = models.TextField("Текст")
     pub_date = models.DateTimeField("Дата публикации", auto_now_add=True)
@@ -22,14 +68,97 @@ class Post(models.Model):
                               blank=True, null=True, related_name="posts",
                               verbose_name="Группа")
     image = models.ImageField(upload_to="posts/", blank=True, null=True,
-                              verbose_name="Изображение")
+                              storage=ContentAddressedStorage(),
+                              db_index=True, verbose_name="Изображение")
+    # Размеры исходной картинки; заполняются сигналом pre_save, а не
+    # width_field, чтобы загрузка поста не открывала файл с диска.
+    image_width = models.PositiveIntegerField(blank=True, null=True,
+                                              editable=False)
+    image_height = models.PositiveIntegerField(blank=True, null=True,
+                                               editable=False)
+
+    objects = PostManager()
 
     class Meta:
         ordering = ["-pub_date"]
+        # Ленты листаются курсором по (pub_date, id): главная, профиль и
+        # группа читают страницу диапазоном по индексу, без сортировки.
+        indexes = [
+            models.Index(fields=["-pub_date", "-id"],
+                         name="post_pub_date_idx"),
+            models.Index(fields=["author", "-pub_date", "-id"],
+                         name="post_author_pub_date_idx"),
+            models.Index(fields=["group", "-pub_date", "-id"],
+                         name="post_group_pub_date_idx"),
+        ]
 
     def __str__(self):
         return self.text
 
+    def save(self, *args, **kwargs):
+        # Файл картинки пишется в хранилище в транзакции основной базы,
+        # где лежат счётчики ссылок на файлы: thumbnails.release()
+        # удаляет файл под той же блокировкой записи и не может удалить
+        # только что загруженную копию.
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            super().save(*args, **kwargs)
+
+
+class ImageReferenceManager(models.Manager):
+    def shift(self, name, delta):
+        """Сдвигает число постов с картинкой name на delta."""
+        if not is_content_addressed(name):
+            return
+        updated = (self.filter(pk=name)
+                   .update(references=F("references") + delta))
+        if not updated and delta > 0:
+            self.create(name=name, references=delta)
+
+    def rebuild(self):
+        """Пересчитывает ссылки по постам всех шардов."""
+        counts = {}
+        for alias in settings.DATABASE_SHARDS:
+            images = (Post.objects.using(alias).order_by()
+                      .values_list("image").annotate(n=Count("id")))
+            for name, count in images:
+                if is_content_addressed(name):
+                    counts[name] = counts.get(name, 0) + count
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create([ImageReference(name=name, references=count)
+                              for name, count in counts.items()],
+                             batch_size=500)
+
+
+class ImageReference(models.Model):
+    """Число постов, ссылающихся на файл с именем по содержимому.
+
+    Ведётся сигналами Post в транзакции сохранения; по нулю
+    thumbnails.release() удаляет файл.
+    """
+    name = models.CharField("Файл", max_length=100, primary_key=True)
+    references = models.PositiveIntegerField("Постов", default=0)
+
+    objects = ImageReferenceManager()
+
+
+class PostImage(models.Model):
+    """Сведения о картинке поста, собранные при её обработке.
+
+    Хранит хэш исходного файла и готовые адреса вариантов для srcset,
+    чтобы карточка в ленте рендерилась без обращений к хранилищу
+    ключей sorl-thumbnail и к файлам в media/.
+    """
+    post = models.OneToOneField(Post, on_delete=models.CASCADE,
+                                primary_key=True, related_name="image_meta")
+    source = models.CharField("Исходный файл", max_length=100)
+    sha256 = models.CharField("SHA-256", max_length=64, db_index=True)
+    picture = models.TextField("Варианты", help_text="JSON для "
+                               "includes/post_picture.html")
+
+    def __str__(self):
+        return self.source
+
 
 class Comment(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE,
@@ -41,6 +170,10 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ["-created"]
+        indexes = [
+            models.Index(fields=["post", "-created"],
+                         name="comment_post_created_idx"),
+        ]
 
 
 class Follow(models.Model):
@@ -48,3 +181,176 @@ class Follow(models.Model):
                              related_name="follower", null=True)
     author = models.ForeignKey(User, on_delete=models.CASCADE,
                                related_name="following", null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "author"],
+                                    name="follow_user_author_unique"),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """Запись материализованной ленты подписок пользователя.
+
+    Заполняется при публикации поста для всех подписчиков автора,
+    поэтому лента follow_index читается одним диапазоном по индексу
+    (user, pub_date, post) без JOIN с Follow.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name="timeline")
+    # Без ограничения в базе: пост может лежать на другом шарде.
+    post = models.ForeignKey(Post, on_delete=models.CASCADE,
+                             related_name="timeline_entries",
+                             db_constraint=False)
+    author = models.ForeignKey(User, on_delete=models.CASCADE,
+                               related_name="+")
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "post"],
+                                    name="timeline_user_post_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "-pub_date", "-post"],
+                         name="timeline_user_pub_date_idx"),
+            models.Index(fields=["user", "author"],
+                         name="timeline_user_author_idx"),
+        ]
+
+
+class UserStatsManager(models.Manager):
+    def for_user(self, user):
+        """Счётчики автора; если записи ещё нет, она пересчитывается."""
+        try:
+            return user.stats
+        except ObjectDoesNotExist:
+            return self.rebuild([user.pk])[0]
+
+    def bump(self, user_id, field, delta):
+        """Атомарно сдвигает счётчик field пользователя на delta."""
+        if user_id is None:
+            return
+        updated = self.filter(pk=user_id).update(**{field: F(field) + delta})
+        if not updated and delta > 0:
+            self.rebuild([user_id])
+
+    def rebuild(self, user_ids=None):
+        """Пересчитывает счётчики по таблицам Post и Follow.
+
+        Без user_ids пересчитываются все пользователи.
+        """
+        users = User.objects.all()
+        if user_ids is not None:
+            users = users.filter(pk__in=user_ids)
+        # order_by() убирает Meta.ordering из GROUP BY, иначе посты
+        # сгруппируются ещё и по pub_date. Посты автора лежат на одном
+        # шарде, так что счётчики шардов просто объединяются.
+        posts = {}
+        for alias in settings.DATABASE_SHARDS:
+            counts = (Post.objects.using(alias).order_by()
+                      .values_list("author").annotate(n=Count("id")))
+            if user_ids is not None:
+                counts = counts.filter(author__in=user_ids)
+            posts.update(counts)
+        followers = (Follow.objects.order_by().values_list("author")
+                     .annotate(n=Count("id")))
+        following = (Follow.objects.order_by().values_list("user")
+                     .annotate(n=Count("id")))
+        if user_ids is not None:
+            followers = followers.filter(author__in=user_ids)
+            following = following.filter(user__in=user_ids)
+        followers, following = dict(followers), dict(following)
+        with transaction.atomic():
+            existing = self.all() if user_ids is None else self.filter(
+                pk__in=user_ids)
+            # Режим ленты не счётчик: его меняет только posts/timeline.py.
+            pulled = set(existing.filter(pulled=True)
+                         .values_list("pk", flat=True))
+            stats = [
+                UserStats(user_id=pk,
+                          posts_count=posts.get(pk, 0),
+                          followers_count=followers.get(pk, 0),
+                          following_count=following.get(pk, 0),
+                          pulled=pk in pulled)
+                for pk in users.values_list("pk", flat=True).iterator()
+            ]
+            existing.delete()
+            self.bulk_create(stats, batch_size=500)
+        return stats
+
+
+class UserStats(models.Model):
+    """Денормализованные счётчики для карточки автора."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+                                primary_key=True, related_name="stats",
+                                verbose_name="Пользователь")
+    posts_count = models.PositiveIntegerField("Записей", default=0)
+    followers_count = models.PositiveIntegerField("Подписчиков", default=0)
+    following_count = models.PositiveIntegerField("Подписок", default=0)
+    pulled = models.BooleanField(
+        "Лента по запросу", default=False,
+        help_text="Посты не раскладываются по лентам подписчиков, а "
+                  "подмешиваются при чтении (posts/timeline.py)")
+
+    objects = UserStatsManager()
+
+
+class RequestProfile(models.Model):
+    """Снятый профиль одного запроса (posts/profiling.py).
+
+    Стеки лежат в файле в PROFILING_DIR в collapsed-формате, который
+    понимают flamegraph.pl и speedscope; здесь — сводка и SQL запроса.
+    """
+    TRIGGERS = (("token", "Подписанный токен"), ("sample", "Выборка"))
+
+    created = models.DateTimeField("Снят", auto_now_add=True, db_index=True)
+    method = models.CharField("Метод", max_length=10)
+    path = models.TextField("Адрес")
+    view = models.CharField("View", max_length=200)
+    status = models.PositiveSmallIntegerField("Статус")
+    duration = models.FloatField("Время, мс")
+    queries = models.PositiveIntegerField("SQL-запросов")
+    sql_duration = models.FloatField("Время SQL, мс")
+    samples = models.PositiveIntegerField("Выборок стека")
+    trigger = models.CharField("Причина", max_length=10, choices=TRIGGERS)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True,
+                             blank=True, related_name="+",
+                             verbose_name="Пользователь")
+    stacks_file = models.CharField("Файл стеков", max_length=255)
+    sql = models.TextField("SQL", help_text="JSON: [начало, длительность "
+                           "в мс, запрос] по порядку выполнения")
+
+    class Meta:
+        ordering = ["-created"]
+        verbose_name = "Профиль запроса"
+        verbose_name_plural = "Профили запросов"
+
+    def __str__(self):
+        return f"{self.method} {self.path}"
+
+
+class ReplicaHeartbeat(models.Model):
+    """Время последней отметки на основной базе (posts/replicas.py).
+
+    Строка реплицируется вместе с остальными данными, и по её возрасту
+    на реплике видно, насколько та отстаёт.
+    """
+    updated = models.DateTimeField("Обновлено")
+
+
+class AuthorShard(models.Model):
+    """Шард с постами автора (posts/sharding.py).
+
+    Хранится на основной базе. Автор без записи живёт на основной базе:
+    она же нулевой шард, и посты, написанные до шардирования, остаются
+    на месте.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+                                primary_key=True, related_name="+",
+                                verbose_name="Автор")
+    shard = models.CharField("Шард", max_length=100)
+
+
+class PostTicket(models.Model):
+    """Выдаёт id постов, общие для всех шардов (posts/sharding.py)."""
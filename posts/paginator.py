@@ -0,0 +1,177 @@
+import base64
+import binascii
+import datetime as dt
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _encode_value(value):
+    if isinstance(value, dt.datetime):
+        return {"$dt": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "$dt" in value:
+        parsed = parse_datetime(value["$dt"])
+        if parsed is None:
+            raise InvalidCursor(value["$dt"])
+        return parsed
+    return value
+
+
+def encode_cursor(direction, values):
+    """Упаковывает направление и значения ключа в непрозрачный токен."""
+    payload = json.dumps([direction, [_encode_value(v) for v in values]],
+                         separators=(",", ":"))
+    token = base64.urlsafe_b64encode(payload.encode())
+    return token.decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        direction, values = json.loads(raw.decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError) as exc:
+        raise InvalidCursor(token) from exc
+    if direction not in ("n", "p") or not isinstance(values, list):
+        raise InvalidCursor(token)
+    return direction, [_decode_value(v) for v in values]
+
+
+def parse_ordering(ordering):
+    """("-pub_date", "-id") -> [("pub_date", True), ("id", True)]"""
+    return [(name.lstrip("-"), name.startswith("-")) for name in ordering]
+
+
+def keyset_filter(fields, values, backwards=False):
+    """Условие «строго после ключа values» для сортировки fields.
+
+    Для (pub_date DESC, id DESC) это
+    pub_date < v1 OR (pub_date = v1 AND id < v2).
+    """
+    condition = Q()
+    equal = {}
+    for (name, descending), value in zip(fields, values):
+        lookup = "lt" if descending != backwards else "gt"
+        condition |= Q(**equal, **{f"{name}__{lookup}": value})
+        equal[name] = value
+    return condition
+
+
+def order_by(fields, backwards=False):
+    return [name if descending == backwards else f"-{name}"
+            for name, descending in fields]
+
+
+class CursorPage:
+    def __init__(self, object_list, paginator, next_cursor=None,
+                 previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f"<CursorPage of {len(self)} items>"
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """Keyset-пагинация по (pub_date, id).
+
+    В отличие от django.core.paginator.Paginator не выполняет COUNT(*)
+    и не использует OFFSET: каждая страница — это выборка из
+    per_page + 1 строк, начиная строго после ключа из курсора, поэтому
+    страница N стоит столько же, сколько первая.
+
+    transform, если задан, превращает выбранные строки в объекты
+    страницы (например, записи ленты в посты); курсоры при этом
+    строятся по исходным строкам.
+    """
+
+    def __init__(self, object_list, per_page, ordering=("-pub_date", "-id"),
+                 transform=None):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.fields = parse_ordering(self.ordering)
+        self.transform = transform
+
+    def key(self, obj):
+        return [getattr(obj, name) for name, _ in self.fields]
+
+    def fetch(self, values, backwards, limit):
+        """Возвращает до limit объектов, идущих после ключа values.
+
+        При backwards=True объекты идут в обратном порядке, начиная
+        с ближайшего к ключу. Источник, не являющийся QuerySet, должен
+        сам реализовать fetch(fields, values, backwards, limit).
+        """
+        if not isinstance(self.object_list, QuerySet):
+            return self.object_list.fetch(self.fields, values, backwards,
+                                          limit)
+        queryset = self.object_list
+        if values is not None:
+            queryset = queryset.filter(
+                keyset_filter(self.fields, values, backwards))
+        return list(queryset.order_by(*order_by(self.fields, backwards))
+                    [:limit])
+
+    def page(self, cursor=None):
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            if len(values) != len(self.fields):
+                raise InvalidCursor(cursor)
+        else:
+            direction, values = "n", None
+
+        backwards = direction == "p"
+        items = self.fetch(values, backwards, self.per_page + 1)
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if backwards:
+            items.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        next_cursor = previous_cursor = None
+        if items and has_next:
+            next_cursor = encode_cursor("n", self.key(items[-1]))
+        if items and has_previous:
+            previous_cursor = encode_cursor("p", self.key(items[0]))
+        if self.transform is not None:
+            items = self.transform(items)
+        return CursorPage(items, self, next_cursor, previous_cursor)
+
+    def get_page(self, cursor=None):
+        """Как page(), но при испорченном курсоре отдаёт первую страницу."""
+        try:
+            return self.page(cursor)
+        except (ValueError, TypeError, ValidationError):
+            return self.page()
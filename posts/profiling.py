@@ -0,0 +1,201 @@
+"""Профилирование отдельных запросов на боевом сервере.
+
+Запрос профилируется, если в заголовке X-Profile пришёл подписанный
+токен сотрудника сайта (его выдаёт команда profile_token) и запрос
+сделан им самим, либо если запрос попал в случайную выборку один из
+PROFILING_SAMPLE_RATE. Остальные запросы проходят без накладных
+расходов: проверка заголовка и одно случайное число.
+
+Токен — только заголовок: параметр в адресе остался бы в логах прокси
+и в Referer. Middleware стоит после AuthenticationMiddleware, чтобы
+сверить токен с пользователем, поэтому чтение сессии в профиль не
+попадает.
+
+Во время профилируемого запроса отдельный поток раз в
+PROFILING_INTERVAL секунд снимает стек потока запроса. Это
+статистический профиль: сам запрос почти не замедляется, в отличие от
+cProfile, который перехватывает каждый вызов функции. Стеки пишутся в
+PROFILING_DIR в collapsed-формате («a;b;c 12») — его принимают
+flamegraph.pl и speedscope. Рядом с профилем сохраняется
+последовательность SQL-запросов со временем начала и длительностью;
+список профилей — в админке.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core import signing
+from django.db import connections
+from django.utils import timezone
+
+from .models import RequestProfile
+
+logger = logging.getLogger(__name__)
+
+HEADER = "HTTP_X_PROFILE"
+SALT = "posts.profiling"
+
+
+def make_token(user):
+    """Токен профилирования для сотрудника user."""
+    return signing.TimestampSigner(salt=SALT).sign(str(user.pk))
+
+
+def check_token(token, user):
+    """Токен подписан для user, не истёк, и user — сотрудник."""
+    if not (user.is_authenticated and user.is_staff):
+        return False
+    try:
+        user_id = signing.TimestampSigner(salt=SALT).unsign(
+            token, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return user_id == str(user.pk)
+
+
+def trigger(request):
+    """Причина профилировать запрос или None."""
+    token = request.META.get(HEADER)
+    if token and check_token(token, request.user):
+        return "token"
+    rate = settings.PROFILING_SAMPLE_RATE
+    if rate and random.randrange(rate) == 0:
+        return "sample"
+    return None
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    filename = code.co_filename
+    for prefix in (settings.BASE_DIR, sys.prefix, sys.base_prefix):
+        if filename.startswith(prefix):
+            filename = os.path.relpath(filename, prefix)
+            break
+    # «;» разделяет кадры в collapsed-формате.
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(
+        ";", ":")
+
+
+class Sampler(threading.Thread):
+    """Снимает стек потока thread_id, пока не вызван stop()."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self.stacks.most_common())
+
+
+class SQLTimeline:
+    """Обёртка execute_wrapper, записывающая начало и длительность SQL."""
+
+    def __init__(self, started):
+        self.started = started
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((
+                round((started - self.started) * 1000, 2),
+                round((time.perf_counter() - started) * 1000, 2), sql))
+
+
+def save(request, response, reason, duration, sampler, timeline):
+    directory = settings.PROFILING_DIR
+    os.makedirs(directory, exist_ok=True)
+    name = (f"{timezone.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+            ".collapsed")
+    with open(os.path.join(directory, name), "w") as output:
+        output.write(sampler.collapsed())
+    user = getattr(request, "user", None)
+    match = getattr(request, "resolver_match", None)
+    RequestProfile.objects.create(
+        method=request.method, path=request.get_full_path(),
+        view=match.view_name if match is not None else "",
+        status=response.status_code, duration=round(duration * 1000, 2),
+        queries=len(timeline.queries),
+        sql_duration=round(sum(q[1] for q in timeline.queries), 2),
+        samples=sum(sampler.stacks.values()), trigger=reason,
+        user=user if user is not None and user.is_authenticated else None,
+        stacks_file=name, sql=json.dumps(timeline.queries))
+    prune(settings.PROFILING_KEEP)
+
+
+def prune(keep):
+    """Удаляет профили старше последних keep вместе с файлами."""
+    stale = RequestProfile.objects.order_by("-created", "-pk")[keep:]
+    for profile in stale:
+        profile.delete()
+
+
+def stacks_path(profile):
+    return os.path.join(settings.PROFILING_DIR,
+                        os.path.basename(profile.stacks_file))
+
+
+def delete_stacks(profile):
+    try:
+        os.remove(stacks_path(profile))
+    except FileNotFoundError:
+        pass
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reason = trigger(request)
+        if reason is None:
+            return self.get_response(request)
+
+        sampler = Sampler(threading.get_ident(),
+                          settings.PROFILING_INTERVAL)
+        started = time.perf_counter()
+        timeline = SQLTimeline(started)
+        sampler.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timeline))
+                response = self.get_response(request)
+        finally:
+            sampler.stop()
+        duration = time.perf_counter() - started
+        try:
+            save(request, response, reason, duration, sampler, timeline)
+        except Exception:
+            # Профиль не должен ронять запрос, ради которого снимался.
+            logger.exception("Не удалось сохранить профиль %s",
+                             request.path)
+        return response
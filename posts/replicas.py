@@ -0,0 +1,181 @@
+"""Чтение лент с реплик базы.
+
+View, помеченные @replica_reads, на GET читают с одной из реплик из
+DATABASE_REPLICAS; всё остальное, как и любая запись, идёт на основную
+базу default. Реплика выбирается на весь запрос в ReplicaMiddleware.
+
+Реплика отстаёт, поэтому:
+
+* после успешного POST (пост, комментарий, подписка, вход) сессия на
+  REPLICA_PIN_SECONDS читает только с основной базы — автор сразу
+  видит то, что написал;
+* сессии и чтения внутри транзакции всегда идут на основную базу;
+* отставание реплики меряется по ReplicaHeartbeat: sync_replicas
+  обновляет её на основной базе, и на реплике видно, когда её данные
+  были свежими. Реплика старше REPLICA_MAX_LAG не используется;
+  проверка кэшируется в процессе на REPLICA_CHECK_INTERVAL секунд;
+* страница или карточка, собранная с реплики, кладётся в кэш, только
+  если реплика уже содержит все изменения, учтённые версиями ключа
+  (cacheable): иначе устаревший HTML лёг бы под текущую версию;
+* закреплённая сессия не читает и не пишет кэш страниц и карточек.
+
+Локально реплики изображают копии файла SQLite (YATUBE_REPLICAS в
+настройках), которые обновляет sync_replicas.
+"""
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils import timezone
+
+from .models import ReplicaHeartbeat
+
+logger = logging.getLogger(__name__)
+
+PIN_SESSION_KEY = "_replica_pin_until"
+SAFE_METHODS = ("GET", "HEAD")
+# Модели, которые читаются только с основной базы: свежая сессия после
+# входа ещё не доехала до реплики.
+PRIMARY_MODELS = {"sessions.session"}
+
+_local = threading.local()
+_health = {}
+_health_lock = threading.Lock()
+
+
+def replica_reads(view):
+    """Помечает view, которому можно читать с реплики."""
+    view.replica_reads = True
+    return view
+
+
+def current():
+    """Реплика, с которой читает текущий запрос, или None."""
+    return getattr(_local, "alias", None)
+
+
+def cacheable(versions):
+    """Можно ли положить в кэш данные, прочитанные в текущем запросе,
+    под ключом с версиями versions (posts/caching.py).
+
+    Версия не меньше времени изменения, а отметка на реплике — время,
+    по которое та содержит данные основной базы.
+    """
+    if current() is None:
+        return True
+    synced = getattr(_local, "synced", None)
+    return (synced is not None
+            and max(versions) <= synced.timestamp() * 1000)
+
+
+def beat():
+    ReplicaHeartbeat.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        pk=1, defaults={"updated": timezone.now()})
+
+
+def heartbeat(alias):
+    """Отметка времени на реплике или None, если её не узнать."""
+    try:
+        return (ReplicaHeartbeat.objects.using(alias)
+                .values_list("updated", flat=True).first())
+    except DatabaseError:
+        logger.exception("Реплика %s недоступна", alias)
+        return None
+
+
+def synced(alias):
+    """Отметка реплики на момент последней проверки или None.
+
+    Реплика только догоняет основную базу, так что данные, прочитанные
+    после проверки, не старше этой отметки.
+    """
+    now = time.monotonic()
+    with _health_lock:
+        checked = _health.get(alias)
+    if checked is not None and now - checked[0] < \
+            settings.REPLICA_CHECK_INTERVAL:
+        return checked[1]
+    updated = heartbeat(alias)
+    seconds = (None if updated is None
+               else (timezone.now() - updated).total_seconds())
+    if seconds is None or seconds > settings.REPLICA_MAX_LAG:
+        logger.warning("Реплика %s отстаёт на %s с, чтение с основной базы",
+                       alias, seconds)
+        updated = None
+    with _health_lock:
+        _health[alias] = (now, updated)
+    return updated
+
+
+def healthy(alias):
+    return synced(alias) is not None
+
+
+def choose():
+    candidates = [alias for alias in settings.DATABASE_REPLICAS
+                  if healthy(alias)]
+    return random.choice(candidates) if candidates else None
+
+
+def pinned(request):
+    session = getattr(request, "session", None)
+    return (session is not None
+            and session.get(PIN_SESSION_KEY, 0) > time.time())
+
+
+def pin(request):
+    request.session[PIN_SESSION_KEY] = (time.time()
+                                        + settings.REPLICA_PIN_SECONDS)
+
+
+class ReplicaMiddleware:
+    """Выбирает реплику для запроса; стоит после SessionMiddleware и
+    до PageCacheMiddleware, которая сама вызывает view."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.alias = _local.synced = None
+        if (settings.DATABASE_REPLICAS
+                and request.method not in SAFE_METHODS
+                and response.status_code < 400
+                and hasattr(request, "session")):
+            pin(request)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (not settings.DATABASE_REPLICAS
+                or not getattr(view_func, "replica_reads", False)
+                or request.method not in SAFE_METHODS
+                or pinned(request)):
+            return None
+        _local.alias = choose()
+        _local.synced = synced(_local.alias) if _local.alias else None
+        return None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = current()
+        if (alias is None or model._meta.label_lower in PRIMARY_MODELS
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же строки, что и основная база.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема реплик приходит вместе с данными.
+        return db == DEFAULT_DB_ALIAS
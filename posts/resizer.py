@@ -0,0 +1,153 @@
+"""Варианты картинок по запросу: /img/<sha256>/<ширина>x<высота>/.
+
+Вариант строится один раз и кладётся в дисковый кэш
+<IMAGE_CACHE_DIR>/<ab>/<cd>/<sha256>_<w>x<h>.<ext>; следующие запросы
+отдаются прямо с диска. Адрес однозначно определяет содержимое (хэш
+исходника и размер), поэтому ответ можно кэшировать навсегда.
+
+Размеры ограничены списком IMAGE_RESIZE_SIZES, иначе перебор геометрий
+забил бы диск и процессор. Кэш ограничен IMAGE_CACHE_MAX_BYTES:
+при переполнении удаляются давно не запрошенные варианты (время
+запроса хранится в mtime файла).
+"""
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from . import sharding
+from .models import Post, PostImage
+from .thumbnails import ASPECT_RATIO, WIDTHS
+
+FORMATS = {
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+QUALITY = 80
+
+# Время доступа обновляется не чаще раза в час: чтение не должно
+# превращаться в запись на каждом запросе.
+TOUCH_RESOLUTION = 60 * 60
+CULL_CHECK_EVERY = 50
+
+_lock = threading.Lock()
+_writes = 0
+
+
+def allowed_sizes():
+    sizes = {(width, round(width * ASPECT_RATIO)) for width in WIDTHS}
+    return sizes | {tuple(size) for size in settings.IMAGE_RESIZE_SIZES}
+
+
+def cache_path(digest, width, height, extension):
+    return os.path.join(settings.IMAGE_CACHE_DIR, digest[:2], digest[2:4],
+                        f"{digest}_{width}x{height}.{extension}")
+
+
+def source_name(digest):
+    """Имя исходного файла в хранилище постов по его SHA-256.
+
+    Файлы с одним хэшем одинаковы, поэтому подходит любой, и запросы
+    не сортируются: оба идут диапазоном по индексу. Шарды опрашиваются
+    по очереди до первой находки.
+    """
+    # Имя — posts/ab/<sha256>.<ext>; «/» следует за «.» в ASCII, так что
+    # диапазон [prefix., prefix/) покрывает все расширения.
+    prefix = f"posts/{digest[:2]}/{digest}"
+    for alias in sharding.shards():
+        names = (Post.objects.using(alias)
+                 .filter(image__gte=prefix + ".", image__lt=prefix + "/")
+                 .order_by().values_list("image", flat=True)[:1])
+        if not names:
+            names = (PostImage.objects.using(alias).filter(sha256=digest)
+                     .order_by().values_list("source", flat=True)[:1])
+        if names:
+            return names[0]
+    return None
+
+
+def render(name, width, height, image_format, path):
+    storage = Post._meta.get_field("image").storage
+    with storage.open(name) as source:
+        image = Image.open(source)
+        image = ImageOps.fit(image.convert("RGB"), (width, height),
+                             Image.LANCZOS)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as output:
+            image.save(output, image_format, quality=QUALITY)
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    _count_write()
+
+
+def touch(path):
+    """Отмечает вариант как недавно запрошенный для LRU."""
+    if os.stat(path).st_mtime < time.time() - TOUCH_RESOLUTION:
+        os.utime(path)
+
+
+def get(digest, width, height, extension):
+    """Путь к готовому варианту или None, если исходника нет.
+
+    Размер и формат должны быть проверены заранее.
+    """
+    path = cache_path(digest, width, height, extension)
+    if os.path.exists(path):
+        touch(path)
+        return path
+    name = source_name(digest)
+    if name is None:
+        return None
+    render(name, width, height, FORMATS[extension][0], path)
+    return path
+
+
+def _count_write():
+    global _writes
+    with _lock:
+        _writes += 1
+        if _writes < CULL_CHECK_EVERY:
+            return
+        _writes = 0
+    cull()
+
+
+def cull(max_bytes=None):
+    """Удаляет давно не запрошенные варианты, пока кэш больше лимита.
+
+    Чистит до 90% лимита, чтобы не запускаться на каждой записи.
+    """
+    if max_bytes is None:
+        max_bytes = settings.IMAGE_CACHE_MAX_BYTES
+    files, total = [], 0
+    for root, _, names in os.walk(settings.IMAGE_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return
+    files.sort()
+    target = max_bytes * 0.9
+    for _, size, path in files:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
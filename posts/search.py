@@ -0,0 +1,129 @@
+"""Полнотекстовый поиск по постам на SQLite FTS5.
+
+Текст постов копируется в виртуальную таблицу posts_post_fts (rowid
+совпадает с id поста) сигналами post_save/post_delete. Поиск ранжирует
+совпадения по bm25 и листается курсором по (rank, id), как и ленты.
+На других СУБД индекс не ведётся и поиск ничего не находит.
+"""
+import re
+from collections import namedtuple
+from itertools import islice
+
+from django.db import DEFAULT_DB_ALIAS, connection
+from django.utils.html import escape
+
+from . import sharding
+from .models import Post
+
+TABLE = "posts_post_fts"
+
+# Управляющие символы не встречаются в тексте поста и переживают escape().
+MARK_START, MARK_END = "\x02", "\x03"
+
+WORD_RE = re.compile(r"\w+")
+
+SearchHit = namedtuple("SearchHit", ["rank", "id", "highlight"])
+
+
+def enabled():
+    return connection.vendor == "sqlite"
+
+
+def match_expression(query):
+    """Превращает ввод пользователя в безопасный запрос FTS5.
+
+    Каждое слово ищется как префикс, все слова должны встретиться:
+    «кош спит» -> "кош"* "спит"*.
+    """
+    return " ".join(f'"{word}"*' for word in WORD_RE.findall(query))
+
+
+def index_post(post):
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [post.pk])
+        cursor.execute(f"INSERT INTO {TABLE} (rowid, text) VALUES (%s, %s)",
+                       [post.pk, post.text])
+
+
+def remove_post(post_id):
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [post_id])
+
+
+def reindex():
+    if not enabled():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+        cursor.execute(f"INSERT INTO {TABLE} (rowid, text) "
+                       f"SELECT id, text FROM {Post._meta.db_table}")
+        # Индекс общий и лежит на основной базе; посты остальных шардов
+        # копируются в него пачками.
+        for alias in sharding.shards():
+            if alias == DEFAULT_DB_ALIAS:
+                continue
+            rows = (Post.objects.using(alias).order_by()
+                    .values_list("id", "text").iterator())
+            while True:
+                batch = list(islice(rows, sharding.BATCH_SIZE))
+                if not batch:
+                    break
+                cursor.executemany(f"INSERT INTO {TABLE} (rowid, text) "
+                                   f"VALUES (%s, %s)", batch)
+        cursor.execute(f"SELECT COUNT(*) FROM {TABLE}")
+        return cursor.fetchone()[0]
+
+
+def matching_ids_sql(query):
+    """Подзапрос с id найденных постов, например для фильтра в админке."""
+    return (f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s",
+            [match_expression(query)])
+
+
+def _highlight(text):
+    return (escape(text).replace(MARK_START, "<mark>")
+            .replace(MARK_END, "</mark>").replace("\n", "<br>"))
+
+
+class SearchResults:
+    """Источник для CursorPaginator с ordering=("rank", "-id")."""
+
+    def __init__(self, query):
+        self.expression = match_expression(query)
+
+    def fetch(self, fields, values, backwards, limit):
+        if not enabled() or not self.expression:
+            return []
+        rank = f"bm25({TABLE})"
+        params = [self.expression]
+        sql = (f"SELECT rowid, {rank}, highlight({TABLE}, 0, %s, %s) "
+               f"FROM {TABLE} WHERE {TABLE} MATCH %s")
+        if values is not None:
+            after, before = (">", "<") if not backwards else ("<", ">")
+            sql += (f" AND ({rank} {after} %s OR "
+                    f"({rank} = %s AND rowid {before} %s))")
+            params += [values[0], values[0], values[1]]
+        sql += (" ORDER BY 2 DESC, 1 ASC" if backwards
+                else " ORDER BY 2 ASC, 1 DESC")
+        sql += " LIMIT %s"
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [MARK_START, MARK_END] + params)
+            return [SearchHit(rank, post_id, _highlight(text))
+                    for post_id, rank, text in cursor.fetchall()]
+
+
+def load_posts(hits):
+    posts = sharding.in_bulk(Post.objects.for_feed(),
+                             [hit.id for hit in hits])
+    result = []
+    for hit in hits:
+        if hit.id in posts:
+            post = posts[hit.id]
+            post.highlight = hit.highlight
+            result.append(post)
+    return result
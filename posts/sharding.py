@@ -0,0 +1,424 @@
+"""Шардирование постов и комментариев по автору.
+
+Посты автора вместе с их картинками (PostImage) и комментариями лежат
+на одном шарде из DATABASE_SHARDS; остальные таблицы — на основной
+базе, она же нулевой шард. Шард автора записан в AuthorShard; автор без
+записи живёт на основной базе, так что включение шардов не трогает уже
+написанные посты, а долю новых шардов им отдаёт rebalance_shards.
+
+* ShardRouter отправляет запрос на шард по подсказкам: author.posts,
+  Post.objects.for_author(id), post.comments, сохранение поста или
+  комментария. Запрос без подсказки читает основную базу.
+* Ленты по всем авторам (главная, группа) собираются с каждого шарда
+  параллельно и сливаются по (pub_date, id): feed() и in_bulk().
+* Пользователи и группы копируются на каждый шард, чтобы посты
+  ссылались на них внешними ключами и select_related работал внутри
+  шарда.
+* id постов выдаёт таблица PostTicket на основной базе, поэтому они не
+  пересекаются между шардами и пост можно перенести, не меняя адреса.
+
+Реплики (posts/replicas.py) есть только у основной базы: посты и
+комментарии читаются с самих шардов.
+"""
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import (DEFAULT_DB_ALIAS, close_old_connections, connection,
+                       connections, transaction)
+from django.db.models import Count, Max
+
+from . import dumps
+from .models import (AuthorShard, Comment, Group, Post, PostImage,
+                     PostTicket, User)
+from .paginator import keyset_filter, order_by
+
+SHARDED_MODELS = (Post, PostImage, Comment)
+REFERENCE_MODELS = (User, Group)
+
+CACHE_KEY = "posts:shard:{}"
+CACHE_TIMEOUT = 60 * 60
+BATCH_SIZE = 500
+# Выданные номера не нужны, кроме последнего; чистятся раз в столько
+# номеров.
+TICKET_CLEANUP_EVERY = 1000
+
+_executor = None
+
+
+def enabled():
+    return len(settings.DATABASE_SHARDS) > 1
+
+
+def shards():
+    return settings.DATABASE_SHARDS
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.SHARD_WORKERS,
+                                       thread_name_prefix="shards")
+    return _executor
+
+
+def _evaluate(queryset):
+    # Соединения потока пула живут, как у потока запроса: до
+    # CONN_MAX_AGE или первой ошибки.
+    close_old_connections()
+    return list(queryset)
+
+
+def evaluate(querysets):
+    """Выполняет запросы параллельно и возвращает списки их строк.
+
+    База каждого запроса выбирается здесь, в потоке запроса: только
+    в нём известны реплика (posts/replicas.py) и подсказки роутерам.
+    """
+    querysets = [queryset.using(queryset.db) for queryset in querysets]
+    # Базу SQLite в памяти потоки делят через shared cache и не видят
+    # незакоммиченного, поэтому с ней работаем в потоке запроса.
+    in_memory = (connection.vendor == "sqlite"
+                 and connection.is_in_memory_db())
+    if len(querysets) < 2 or not settings.SHARD_WORKERS or in_memory:
+        return [list(queryset) for queryset in querysets]
+    return list(executor().map(_evaluate, querysets))
+
+
+def shard_for(author_id):
+    """Шард с постами автора."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    key = CACHE_KEY.format(author_id)
+    alias = cache.get(key)
+    if alias is None:
+        alias = (AuthorShard.objects.using(DEFAULT_DB_ALIAS)
+                 .filter(pk=author_id).values_list("shard", flat=True)
+                 .first()) or DEFAULT_DB_ALIAS
+        cache.set(key, alias, CACHE_TIMEOUT)
+    return alias
+
+
+def place(author_id, alias):
+    """Записывает шард автора; данные переносит move_author()."""
+    entries = AuthorShard.objects.using(DEFAULT_DB_ALIAS)
+    if alias == DEFAULT_DB_ALIAS:
+        entries.filter(pk=author_id).delete()
+    else:
+        entries.update_or_create(pk=author_id, defaults={"shard": alias})
+    cache.set(CACHE_KEY.format(author_id), alias, CACHE_TIMEOUT)
+
+
+def assign(user):
+    """Выбирает шард новому пользователю."""
+    if enabled():
+        place(user.pk, shards()[user.pk % len(shards())])
+
+
+def next_post_id():
+    """Номер нового поста или None, если шардов нет.
+
+    Номер больше всех выданных и всех id на основной базе: туда пишутся
+    посты, пока шардирование выключено. Уже разнесённые по шардам id
+    учитывает seed_tickets().
+    """
+    if not enabled():
+        return None
+    tickets = PostTicket._meta.db_table
+    posts = Post._meta.db_table
+    with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {tickets} (id) SELECT MAX("
+            f"(SELECT COALESCE(MAX(id), 0) FROM {tickets}), "
+            f"(SELECT COALESCE(MAX(id), 0) FROM {posts})) + 1")
+        ticket = cursor.lastrowid
+        if ticket % TICKET_CLEANUP_EVERY == 0:
+            cursor.execute(f"DELETE FROM {tickets} WHERE id < %s", [ticket])
+    return ticket
+
+
+def seed_tickets():
+    """Поднимает счётчик PostTicket до наибольшего id постов на шардах.
+
+    Нужен перед переносом с основной базы: иначе после него наибольший
+    id там станет меньше, и next_post_id() выдаст занятый номер.
+    """
+    top = max(Post._base_manager.using(alias).aggregate(top=Max("id"))["top"]
+              or 0 for alias in shards())
+    tickets = PostTicket.objects.using(DEFAULT_DB_ALIAS)
+    if not tickets.filter(pk__gte=top).exists():
+        tickets.create(pk=top)
+
+
+def _other_shards():
+    return [alias for alias in shards() if alias != DEFAULT_DB_ALIAS]
+
+
+def _values(instance):
+    return {field.attname: getattr(instance, field.attname)
+            for field in instance._meta.concrete_fields}
+
+
+def replicate(instance):
+    """Копирует пользователя или группу с основной базы на шарды.
+
+    Пишет запросами без сигналов, иначе копия снова попала бы в
+    обработчики post_save.
+    """
+    model, values = type(instance), _values(instance)
+    for alias in _other_shards():
+        rows = model._base_manager.using(alias)
+        if not rows.filter(pk=instance.pk).update(**values):
+            rows.bulk_create([model(**values)])
+
+
+def unreplicate(instance):
+    """Удаляет копии пользователя или группы вместе с их постами."""
+    model = type(instance)
+    for alias in _other_shards():
+        model._base_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+def sync_reference(alias):
+    """Приводит копии пользователей и групп на шарде к основной базе."""
+    for model in REFERENCE_MODELS:
+        rows = model._base_manager.using(alias)
+        existing = set(rows.values_list("pk", flat=True))
+        fields = [field.name for field in model._meta.concrete_fields
+                  if not field.primary_key]
+        source = model._base_manager.using(DEFAULT_DB_ALIAS).order_by("pk")
+        batch = []
+        for instance in source.iterator():
+            batch.append(instance)
+            if len(batch) == BATCH_SIZE:
+                _upsert(rows, batch, existing, fields)
+                batch = []
+        _upsert(rows, batch, existing, fields)
+
+
+def _upsert(rows, batch, existing, fields):
+    rows.bulk_update([obj for obj in batch if obj.pk in existing], fields)
+    rows.bulk_create([obj for obj in batch if obj.pk not in existing])
+
+
+class ShardedFeed:
+    """Источник для CursorPaginator: один QuerySet на всех шардах.
+
+    Каждый шард отдаёт не больше limit строк после курсора по своему
+    индексу; списки сливаются k-way merge'ем, поэтому страница стоит
+    по одному короткому запросу на шард, и шарды опрашиваются
+    параллельно.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def fetch(self, fields, values, backwards, limit):
+        queryset = self.queryset
+        if values is not None:
+            queryset = queryset.filter(
+                keyset_filter(fields, values, backwards))
+        queryset = queryset.order_by(*order_by(fields, backwards))[:limit]
+        rows = evaluate([queryset.using(alias) for alias in shards()])
+        # Все поля ключа сортируются в одну сторону, как в лентах.
+        descending = fields[0][1] != backwards
+        key = attrgetter(*[name for name, _ in fields])
+        merged = heapq.merge(*rows, key=key, reverse=descending)
+        return list(islice(merged, limit))
+
+
+def feed(queryset):
+    """Источник ленты для CursorPaginator с учётом шардов."""
+    return ShardedFeed(queryset) if enabled() else queryset
+
+
+def in_bulk(queryset, ids):
+    """Как queryset.in_bulk(ids), но по всем шардам."""
+    if not enabled():
+        return queryset.in_bulk(ids)
+    if not ids:
+        return {}
+    queryset = queryset.filter(pk__in=ids).order_by()
+    return {obj.pk: obj
+            for rows in evaluate([queryset.using(alias)
+                                  for alias in shards()])
+            for obj in rows}
+
+
+def copy_posts(author_id, source, target):
+    """Копирует на target посты автора, которых там ещё нет.
+
+    Картинки постов переносятся как есть, комментарии получают новые
+    id: на них никто не ссылается.
+    """
+    present = set(Post._base_manager.using(target).filter(author=author_id)
+                  .values_list("pk", flat=True))
+    posts = [post for post in
+             Post._base_manager.using(source).filter(author=author_id)
+             if post.pk not in present]
+    ids = {post.pk for post in posts}
+    images = [image for image in PostImage._base_manager.using(source)
+              .filter(post__author=author_id) if image.pk in ids]
+    comments = [comment for comment in Comment._base_manager.using(source)
+                .filter(post__author=author_id) if comment.post_id in ids]
+    for comment in comments:
+        comment.pk = None
+    with transaction.atomic(using=target):
+        for model, rows in ((Post, posts), (PostImage, images),
+                            (Comment, comments)):
+            with dumps.explicit_dates(model):
+                model._base_manager.using(target).bulk_create(
+                    rows, batch_size=BATCH_SIZE)
+    return len(posts)
+
+
+def delete_posts(author_id, alias):
+    """Удаляет посты автора с шарда без сигналов.
+
+    Файлы картинок, счётчики и ленты остаются: пост не удалён, а
+    перенесён.
+    """
+    posts = Post._meta.db_table
+    selected = f"SELECT id FROM {posts} WHERE author_id = %s"
+    with connections[alias].cursor() as cursor:
+        for model in (Comment, PostImage):
+            cursor.execute(f"DELETE FROM {model._meta.db_table} "
+                           f"WHERE post_id IN ({selected})", [author_id])
+        cursor.execute(f"DELETE FROM {posts} WHERE author_id = %s",
+                       [author_id])
+
+
+def move_author(author_id, source, target):
+    """Переносит посты автора на другой шард.
+
+    Пока идёт перенос, транзакция держит запись на source, и новые
+    посты с этого шарда ждут. Сначала коммитится копия на target, затем
+    меняется AuthorShard и только потом удаляется оригинал: прерванный
+    перенос оставляет дубликаты, но не теряет постов.
+    """
+    with transaction.atomic(using=source):
+        moved = copy_posts(author_id, source, target)
+        place(author_id, target)
+        delete_posts(author_id, source)
+    return moved
+
+
+def strays():
+    """Тройки (автор, шард, шард автора) для постов не на своём шарде.
+
+    Остаются от прерванного переноса или от поста, записанного на
+    старый шард во время переноса.
+    """
+    homes = dict(AuthorShard.objects.using(DEFAULT_DB_ALIAS)
+                 .values_list("user", "shard"))
+    for alias in shards():
+        authors = (Post._base_manager.using(alias).order_by()
+                   .values_list("author", flat=True).distinct())
+        for author_id in authors:
+            home = homes.get(author_id, DEFAULT_DB_ALIAS)
+            if home != alias:
+                yield author_id, alias, home
+
+
+def reconcile():
+    """Возвращает на шард автора посты, оставшиеся на других шардах."""
+    moved = 0
+    for author_id, alias, home in list(strays()):
+        with transaction.atomic(using=alias):
+            moved += copy_posts(author_id, alias, home)
+            delete_posts(author_id, alias)
+    return moved
+
+
+def loads():
+    """Число постов каждого автора по шардам: {шард: {автор: постов}}."""
+    return {alias: dict(Post._base_manager.using(alias).order_by()
+                        .values_list("author").annotate(n=Count("id")))
+            for alias in shards()}
+
+
+def plan(loads, tolerance=0.1):
+    """Переносы (автор, откуда, куда), выравнивающие шарды по постам.
+
+    Из пар шардов с разрывом больше доли tolerance от среднего берётся
+    пара с наибольшим разрывом, где есть кого перенести, и с полного
+    шарда на пустой уходит автор, чьё число постов ближе всего к
+    половине разрыва. Каждый перенос уменьшает сумму квадратов
+    загрузок, так что цикл конечен.
+    """
+    loads = {alias: dict(authors) for alias, authors in loads.items()}
+    totals = {alias: sum(authors.values()) for alias, authors in loads.items()}
+    threshold = sum(totals.values()) / len(totals) * tolerance
+    moves = []
+    while True:
+        pairs = sorted(((totals[heavy] - totals[light], heavy, light)
+                        for heavy in totals for light in totals),
+                       reverse=True)
+        for gap, heavy, light in pairs:
+            if gap <= threshold:
+                return moves
+            candidates = [(count, author_id)
+                          for author_id, count in loads[heavy].items()
+                          if count < gap]
+            if candidates:
+                break
+        else:
+            return moves
+        count, author_id = min(candidates,
+                               key=lambda item: abs(gap / 2 - item[0]))
+        moves.append((author_id, heavy, light))
+        loads[light][author_id] = loads[heavy].pop(author_id)
+        totals[heavy] -= count
+        totals[light] += count
+
+
+def _cached_post(instance):
+    if isinstance(instance, Post):
+        return instance
+    field = type(instance)._meta.get_field("post")
+    return instance.post if field.is_cached(instance) else None
+
+
+class ShardRouter:
+    """Выбирает шард для постов, их картинок и комментариев.
+
+    Для остальных моделей и запросов без подсказки ничего не решает:
+    их разбирает ReplicaRouter.
+    """
+
+    def _shard(self, model, hints):
+        if not enabled() or model not in SHARDED_MODELS:
+            return None
+        if "author_id" in hints:
+            return shard_for(hints["author_id"])
+        instance = hints.get("instance")
+        if isinstance(instance, User):
+            # user.comments — комментарии автора на чужих постах, они
+            # на разных шардах.
+            return shard_for(instance.pk) if model is Post else None
+        if not isinstance(instance, SHARDED_MODELS):
+            return None
+        if not instance._state.adding:
+            return instance._state.db
+        post = _cached_post(instance)
+        if post is None:
+            return None
+        if not post._state.adding:
+            return post._state.db
+        return shard_for(post.author_id)
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # На шардах полная схема: посты ссылаются на копии пользователей
+        # и групп, а остальные таблицы там просто пустые.
+        if db in _other_shards():
+            return True
+        return None
@@ -0,0 +1,123 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
+from django.dispatch import receiver
+
+from . import caching, profiling, search, sharding, thumbnails, timeline
+from .models import (Comment, Follow, Group, ImageReference, Post,
+                     RequestProfile, User, UserStats)
+
+
+@receiver(pre_save, sender=Post)
+def post_saving(sender, instance, using, **kwargs):
+    instance._previous_group_slug = instance._previous_image = None
+    if instance.pk is None:
+        instance.pk = sharding.next_post_id()
+    else:
+        previous = (Post.objects.using(using).filter(pk=instance.pk)
+                    .values_list("group__slug", "image").first())
+        if previous is not None:
+            (instance._previous_group_slug,
+             instance._previous_image) = previous
+    if instance.image.name != instance._previous_image:
+        # Размеры читаются из ещё не сохранённого файла, пока он в памяти.
+        instance.image_width = instance.image_height = None
+        if instance.image:
+            (instance.image_width,
+             instance.image_height) = thumbnails.dimensions(instance.image)
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    if created:
+        UserStats.objects.bump(instance.author_id, "posts_count", 1)
+        timeline.fan_out(instance)
+    search.index_post(instance)
+    previous_image = getattr(instance, "_previous_image", None)
+    if instance.image.name != previous_image:
+        ImageReference.objects.shift(instance.image.name, 1)
+        ImageReference.objects.shift(previous_image, -1)
+        thumbnails.schedule(instance)
+        thumbnails.schedule_release(previous_image)
+    caching.bump(*caching.post_scopes(
+        instance, getattr(instance, "_previous_group_slug", None)))
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, using, **kwargs):
+    UserStats.objects.bump(instance.author_id, "posts_count", -1)
+    if using != DEFAULT_DB_ALIAS:
+        # Ленты на основной базе, каскад шарда до них не дотягивается.
+        timeline.remove_post(instance.pk)
+    search.remove_post(instance.pk)
+    ImageReference.objects.shift(instance.image.name, -1)
+    thumbnails.schedule_release(instance.image.name)
+    caching.bump(*caching.post_scopes(instance))
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def comment_changed(sender, instance, **kwargs):
+    caching.bump(*caching.post_scopes(instance.post))
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, instance, **kwargs):
+    caching.bump("groups", f"group:{instance.slug}")
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Group)
+def reference_saved(sender, instance, created, using, **kwargs):
+    if not sharding.enabled() or using != DEFAULT_DB_ALIAS:
+        return
+    sharding.replicate(instance)
+    if created and sender is User:
+        sharding.assign(instance)
+
+
+@receiver(pre_delete, sender=User)
+@receiver(pre_delete, sender=Group)
+def reference_deleting(sender, instance, using, **kwargs):
+    # До удаления с основной базы: сигналы удаляемых на шардах постов
+    # ещё находят их автора.
+    if sharding.enabled() and using == DEFAULT_DB_ALIAS:
+        sharding.unreplicate(instance)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) == {"last_login"}:
+        return
+    caching.bump(f"profile:{instance.username}")
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if created:
+        UserStats.objects.bump(instance.author_id, "followers_count", 1)
+        UserStats.objects.bump(instance.user_id, "following_count", 1)
+        if instance.user_id and instance.author_id:
+            timeline.followers_changed(instance.author_id)
+            timeline.backfill(instance.user_id, instance.author_id)
+        caching.bump(*follow_scopes(instance))
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    UserStats.objects.bump(instance.author_id, "followers_count", -1)
+    UserStats.objects.bump(instance.user_id, "following_count", -1)
+    timeline.prune(instance.user_id, instance.author_id)
+    caching.bump(*follow_scopes(instance))
+
+
+def follow_scopes(follow):
+    return [f"profile:{user.username}"
+            for user in User.objects.filter(pk__in=[follow.user_id,
+                                                    follow.author_id])]
+
+
+@receiver(post_delete, sender=RequestProfile)
+def request_profile_deleted(sender, instance, **kwargs):
+    profiling.delete_stacks(instance)
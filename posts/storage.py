@@ -0,0 +1,72 @@
+"""Хранилище картинок постов с именами по содержимому.
+
+Файл сохраняется под именем <каталог>/<2 символа хэша>/<sha256>.<расширение>:
+одинаковые картинки, загруженные к разным постам, лежат на диске одним
+файлом, а sorl-thumbnail строит для них одни и те же миниатюры. Загрузка
+пишется во временный файл по частям и хэшируется на лету, так что
+большая картинка не читается в память целиком.
+
+Удалять файлы хранилище само не умеет: на файл может ссылаться
+несколько постов, поэтому удаление идёт через thumbnails.release(),
+которая проверяет счётчик ссылок ImageReference.
+"""
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+HASHED_NAME_RE = re.compile(
+    r"(^|/)[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})(\.\w+)?$")
+
+
+def is_content_addressed(name):
+    return bool(name and HASHED_NAME_RE.search(name))
+
+
+def content_digest(name):
+    """SHA-256 файла из его имени или None для имён не по содержимому."""
+    match = HASHED_NAME_RE.search(name or "")
+    return match.group("digest") if match else None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # Имя определяется содержимым в _save(): одинаковое имя значит
+        # одинаковый файл, и суффиксы _AbCdEf не нужны.
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        full_directory = self.path(directory)
+        os.makedirs(full_directory, exist_ok=True)
+
+        digest = hashlib.sha256()
+        fd, temporary = tempfile.mkstemp(dir=full_directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as output:
+                if hasattr(content, "seek") and content.seekable():
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    output.write(chunk)
+            hexdigest = digest.hexdigest()
+            name = posixpath.join(directory, hexdigest[:2],
+                                  hexdigest + extension)
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                os.remove(temporary)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.chmod(temporary, self.file_permissions_mode or 0o644)
+                os.replace(temporary, full_path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return name
@@ -0,0 +1,17 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from posts import holes
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def hole(context, name, *args):
+    """Персональный фрагмент: метка в каркасе кэша или готовый HTML."""
+    request = context.get("request")
+    if request is None:
+        return ""
+    if context.get("skeleton") or getattr(request, "page_skeleton", False):
+        return holes.placeholder(name, *args)
+    return mark_safe(holes.render(name, request, *args))
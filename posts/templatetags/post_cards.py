@@ -0,0 +1,58 @@
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from posts import caching, holes, replicas
+
+register = template.Library()
+
+PREFETCHED = "post_cards"
+
+
+@register.simple_tag(takes_context=True)
+def prefetch_post_cards(context, posts):
+    """Читает карточки страницы из кэша одним get_many.
+
+    Ставится перед циклом с post_card: без него каждая карточка стоит
+    отдельного чтения версий и самой карточки.
+    """
+    request = context.get("request")
+    if request is not None and replicas.pinned(request):
+        return ""
+    posts = list(posts)
+    keys = caching.card_keys(posts)
+    cached = cache.get_many([key for key, versions in keys])
+    context.render_context[PREFETCHED] = {
+        post.pk: (key, versions, cached.get(key))
+        for post, (key, versions) in zip(posts, keys)}
+    return ""
+
+
+@register.simple_tag(takes_context=True)
+def post_card(context, post):
+    """Карточка поста из кэша фрагментов.
+
+    В кэше карточка хранится с метками вместо персональных фрагментов
+    и сбрасывается, когда меняется пост, его комментарии или группы.
+    Закреплённая за основной базой сессия кэш не читает и не пишет.
+    """
+    request = context.get("request")
+    pinned = request is not None and replicas.pinned(request)
+    prefetched = context.render_context.get(PREFETCHED, {})
+    html = None
+    if not pinned:
+        if post.pk in prefetched:
+            key, versions, html = prefetched[post.pk]
+        else:
+            key, versions = caching.card_key(post)
+            html = cache.get(key)
+    if html is None:
+        html = get_template("includes/post_card.html").render(
+            {"post": post, "request": request, "skeleton": True})
+        if not pinned and replicas.cacheable(versions):
+            cache.set(key, html, settings.FEED_CACHE_TIMEOUT)
+    if request is not None and not getattr(request, "page_skeleton", False):
+        html = holes.fill(html, request)
+    return mark_safe(html)
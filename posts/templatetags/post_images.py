@@ -0,0 +1,13 @@
+from django import template
+
+from posts import thumbnails
+
+register = template.Library()
+
+
+@register.inclusion_tag("includes/post_picture.html")
+def post_picture(post):
+    """Картинка поста: WebP и JPEG в нескольких ширинах с srcset."""
+    if not post.image:
+        return {}
+    return thumbnails.picture(post)
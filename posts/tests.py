@@ -1,9 +1,53 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sessions.models import Session
+from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import Client, TestCase
+from django.core.management import CommandError, call_command
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.db.models import Count
+from django.template import Context, Template
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from posts import (benchmark, caching, dumps, metrics, profiling, replicas,
+                   resizer, search, sharding, thumbnails, timeline)
+from posts.models import (AuthorShard, Comment, Follow, Group, ImageReference,
+                          Post, PostImage, ReplicaHeartbeat, RequestProfile,
+                          TimelineEntry, User, UserStats)
+from posts.paginator import CursorPaginator
+from posts.urls import QUERY_BUDGETS, urlpatterns
+from posts.storage import is_content_addressed
+from yatube.cache_backends import SQLiteCache
+from yatube.db_backends.sqlite3.base import DatabaseWrapper
+
+# Число комментариев карточки (PostQuerySet.for_feed) считается
+# коррелированным подзапросом; других COUNT в лентах быть не должно.
+COMMENTS_COUNT = re.compile(
+    r'\(SELECT COUNT\(U0\."id"\) AS "n" FROM "posts_comment" U0 '
+    r'WHERE U0\."post_id" = \("posts_post"\."id"\) '
+    r'GROUP BY U0\."post_id"\)')
 
-from posts.models import Comment, Follow, Group, Post, User
+
+def without_comments_count(sql):
+    return COMMENTS_COUNT.sub("", sql)
 
 
 class PostsTest(TestCase):
@@ -99,6 +143,11 @@ class PostsTest(TestCase):
 class ImageTest(TestCase):
     """Тесты картинок"""
     def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
         self.client = Client()
         self.user = User.objects.create_user(username="sarah")
         self.client.force_login(self.user)
@@ -239,3 +288,1626 @@ class FollowTest(TestCase):
         self.client.force_login(self.user)
         response = self.client.get(follow_index_url)
         self.assertNotContains(response, self.post.text)
+
+
+class CursorPaginatorTest(TestCase):
+    """Тесты курсорной пагинации"""
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+        self.posts = [Post.objects.create(text=f"Пост {i}", author=self.user)
+                      for i in range(25)]
+        self.posts.reverse()
+
+    def test_walk_forward_and_back(self):
+        """Курсоры next/prev обходят ленту без пропусков и повторов"""
+        paginator = CursorPaginator(Post.objects.all(), 10)
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([post for page in pages for post in page],
+                         self.posts)
+        self.assertFalse(pages[0].has_previous())
+
+        back = paginator.get_page(pages[2].previous_cursor)
+        self.assertEqual(list(back), list(pages[1]))
+        back = paginator.get_page(back.previous_cursor)
+        self.assertEqual(list(back), list(pages[0]))
+        self.assertFalse(back.has_previous())
+
+    def test_broken_cursor(self):
+        """Испорченный курсор открывает первую страницу"""
+        paginator = CursorPaginator(Post.objects.all(), 10)
+        for cursor in ("garbage", "W10", "WyJuIixbImEiLDFdXQ"):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(list(paginator.get_page(cursor)),
+                                 self.posts[:10])
+
+    def test_no_count_query(self):
+        """Лента не считает общее количество постов и не использует OFFSET"""
+        group = Group.objects.create(title="Тестовая", slug="test",
+                                     description="Тестовая группа")
+        Post.objects.update(group=group)
+        url = reverse("groups", args=[group.slug])
+        cursor = self.client.get(url).context["page"].next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"cursor": cursor})
+        self.assertEqual(list(response.context["page"]), self.posts[10:20])
+        for query in queries:
+            self.assertNotIn("COUNT(", without_comments_count(query["sql"]))
+            self.assertNotIn("OFFSET", query["sql"])
+
+
+class UserStatsTest(TestCase):
+    """Тесты денормализованных счётчиков автора"""
+    def setUp(self):
+        self.client = Client()
+        self.author = User.objects.create_user(username="sarah")
+        self.reader = User.objects.create_user(username="terminator")
+        self.client.force_login(self.reader)
+
+    def assertStats(self, user, posts, followers, following):
+        stats = UserStats.objects.get(user=user)
+        self.assertEqual(
+            (stats.posts_count, stats.followers_count, stats.following_count),
+            (posts, followers, following))
+
+    def test_counters_follow_writes(self):
+        """Счётчики меняются вместе с постами и подписками"""
+        post = Post.objects.create(text="Пост", author=self.author)
+        Post.objects.create(text="Ещё пост", author=self.author)
+        self.client.get(reverse("profile_follow", args=["sarah"]))
+        self.assertStats(self.author, 2, 1, 0)
+        self.assertStats(self.reader, 0, 0, 1)
+
+        post.delete()
+        self.client.get(reverse("profile_unfollow", args=["sarah"]))
+        self.assertStats(self.author, 1, 0, 0)
+        self.assertStats(self.reader, 0, 0, 0)
+
+    def test_rebuild_command(self):
+        """Команда rebuild_user_stats исправляет рассинхронизацию"""
+        # Несколько постов: с Meta.ordering в GROUP BY каждый пост
+        # считался бы отдельно.
+        for number in range(3):
+            Post.objects.create(text=f"Пост {number}", author=self.author)
+        Follow.objects.create(user=self.reader, author=self.author)
+        UserStats.objects.update(posts_count=42, followers_count=42)
+        call_command("rebuild_user_stats", stdout=StringIO())
+        self.assertStats(self.author, 3, 1, 0)
+        self.assertStats(self.reader, 0, 0, 1)
+
+    def test_profile_renders_without_counts(self):
+        """Карточка автора не выполняет COUNT-запросов"""
+        Post.objects.create(text="Пост", author=self.author)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("profile", args=["sarah"]))
+        self.assertContains(response, "Записей: 1")
+        for query in queries:
+            self.assertNotIn("COUNT(", without_comments_count(query["sql"]))
+
+
+class FeedQueriesTest(TestCase):
+    """Число запросов ленты не зависит от числа постов на странице"""
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+        self.reader = User.objects.create_user(username="terminator")
+        self.group = Group.objects.create(title="Тестовая", slug="test",
+                                          description="Тестовая группа")
+        Follow.objects.create(user=self.reader, author=self.user)
+        self.client.force_login(self.reader)
+        self.urls = [
+            reverse("index"),
+            reverse("groups", args=[self.group.slug]),
+            reverse("profile", args=[self.user.username]),
+            reverse("follow_index"),
+        ]
+
+    def add_posts(self, count):
+        for i in range(count):
+            post = Post.objects.create(text=f"Пост {i}", author=self.user,
+                                       group=self.group)
+            Comment.objects.create(post=post, author=self.reader,
+                                   text="Комментарий")
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return len(queries)
+
+    def test_constant_queries(self):
+        self.add_posts(1)
+        single = {url: self.count_queries(url) for url in self.urls}
+        self.add_posts(9)
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.count_queries(url), single[url])
+
+    def test_comments_count(self):
+        """Карточка показывает число комментариев из аннотации"""
+        self.add_posts(1)
+        cache.clear()
+        response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["page"][0].comments_count, 1)
+        self.assertContains(response, "1 комментариев")
+
+
+class TimelineTest(TestCase):
+    """Тесты материализованной ленты подписок"""
+    def setUp(self):
+        self.client = Client()
+        self.author = User.objects.create_user(username="sarah")
+        self.reader = User.objects.create_user(username="terminator")
+        self.client.force_login(self.reader)
+
+    def feed(self):
+        response = self.client.get(reverse("follow_index"))
+        return [post.text for post in response.context["page"]]
+
+    def test_fan_out_backfill_prune(self):
+        """Лента заполняется при подписке и публикации и чистится при отписке"""
+        Post.objects.create(text="До подписки", author=self.author)
+        self.client.get(reverse("profile_follow", args=["sarah"]))
+        Post.objects.create(text="После подписки", author=self.author)
+        self.assertEqual(self.feed(), ["После подписки", "До подписки"])
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader)
+                         .count(), 2)
+
+        self.client.get(reverse("profile_unfollow", args=["sarah"]))
+        self.assertEqual(self.feed(), [])
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_rebuild_command(self):
+        Follow.objects.create(user=self.reader, author=self.author)
+        Post.objects.create(text="Пост", author=self.author)
+        TimelineEntry.objects.all().delete()
+        call_command("rebuild_timelines", stdout=StringIO())
+        self.assertEqual(self.feed(), ["Пост"])
+
+    def test_no_follow_join(self):
+        """Лента не соединяет посты с таблицей подписок"""
+        Follow.objects.create(user=self.reader, author=self.author)
+        Post.objects.create(text="Пост", author=self.author)
+        with CaptureQueriesContext(connection) as queries:
+            self.feed()
+        follows = [query["sql"] for query in queries
+                   if "posts_follow" in query["sql"]]
+        # Подписки читает только выбор популярных авторов для pull-части.
+        self.assertEqual(len(follows), 1)
+        self.assertIn('FROM "posts_userstats"', follows[0])
+        self.assertNotIn("posts_post", follows[0])
+
+
+@override_settings(FEED_PULL_THRESHOLD=2, FEED_PUSH_THRESHOLD=1)
+class HybridFeedTest(TestCase):
+    """Тесты смешанной push/pull ленты"""
+    def setUp(self):
+        self.client = Client()
+        self.reader = User.objects.create_user(username="terminator")
+        self.fan = User.objects.create_user(username="john")
+        self.author = User.objects.create_user(username="sarah")
+        self.star = User.objects.create_user(username="star")
+        for user in (self.reader, self.fan):
+            Follow.objects.create(user=user, author=self.star)
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.client.force_login(self.reader)
+
+    def test_merge_push_and_pull(self):
+        """Посты популярного автора читаются при открытии ленты"""
+        expected = []
+        for i in range(12):
+            author = self.star if i % 3 else self.author
+            expected.append(Post.objects.create(text=f"Пост {i}",
+                                                author=author))
+        expected.reverse()
+        self.assertFalse(TimelineEntry.objects.filter(author=self.star)
+                         .exists())
+
+        first = self.client.get(reverse("follow_index")).context["page"]
+        second = self.client.get(reverse("follow_index"),
+                                 {"cursor": first.next_cursor})
+        second = second.context["page"]
+        self.assertEqual(list(first) + list(second), expected)
+        back = self.client.get(reverse("follow_index"),
+                               {"cursor": second.previous_cursor})
+        self.assertEqual(list(back.context["page"]), list(first))
+
+    def test_pushed_entries_are_not_duplicated(self):
+        """Пост, разложенный до достижения порога, не дублируется"""
+        post = Post.objects.create(text="Пост", author=self.star)
+        TimelineEntry.objects.create(user=self.reader, post=post,
+                                     author=self.star, pub_date=post.pub_date)
+        page = self.client.get(reverse("follow_index")).context["page"]
+        self.assertEqual(list(page), [post])
+
+    def test_author_in_band_stays_pulled(self):
+        """Отписка у порога не раскладывает посты автора заново"""
+        post = Post.objects.create(text="Пост", author=self.star)
+        for _ in range(3):
+            Follow.objects.get(user=self.fan, author=self.star).delete()
+            Follow.objects.create(user=self.fan, author=self.star)
+        Follow.objects.get(user=self.fan, author=self.star).delete()
+        self.assertTrue(timeline.is_pulled(self.star.pk))
+        self.assertFalse(TimelineEntry.objects.filter(author=self.star)
+                         .exists())
+        page = self.client.get(reverse("follow_index")).context["page"]
+        self.assertEqual(list(page), [post])
+
+    @override_settings(FEED_PUSH_THRESHOLD=2)
+    def test_settle_returns_author_to_push(self):
+        """Автор ниже FEED_PUSH_THRESHOLD раскладывается вне запроса"""
+        post = Post.objects.create(text="Пост", author=self.star)
+        Follow.objects.get(user=self.fan, author=self.star).delete()
+        self.assertTrue(timeline.is_pulled(self.star.pk))
+        call_command("rebuild_timelines", "--settle", stdout=StringIO())
+        self.assertFalse(timeline.is_pulled(self.star.pk))
+        self.assertTrue(TimelineEntry.objects.filter(
+            user=self.reader, post=post).exists())
+        page = self.client.get(reverse("follow_index")).context["page"]
+        self.assertEqual(list(page), [post])
+
+    def test_author_reaching_threshold_is_pulled(self):
+        """Разложенные посты автора, достигшего порога, убирает settle"""
+        post = Post.objects.create(text="Пост", author=self.author)
+        Follow.objects.create(user=self.fan, author=self.author)
+        self.assertTrue(timeline.is_pulled(self.author.pk))
+        page = self.client.get(reverse("follow_index")).context["page"]
+        self.assertEqual(list(page), [post])
+        timeline.settle()
+        self.assertFalse(TimelineEntry.objects.filter(author=self.author)
+                         .exists())
+        page = self.client.get(reverse("follow_index")).context["page"]
+        self.assertEqual(list(page), [post])
+
+
+class FeedCacheVersionTest(TestCase):
+    """Тесты поколенческого кэша страниц ленты"""
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+        self.group = Group.objects.create(title="Тестовая", slug="test",
+                                          description="Тестовая группа")
+        self.post = Post.objects.create(text="Первый", author=self.user,
+                                        group=self.group)
+        self.urls = [reverse("index"),
+                     reverse("groups", args=[self.group.slug]),
+                     reverse("profile", args=[self.user.username])]
+
+    def test_cached_page_hits_no_db(self):
+        for url in self.urls:
+            self.client.get(url)
+            with self.subTest(url=url), self.assertNumQueries(0):
+                self.client.get(url)
+
+    def test_invalidated_on_writes(self):
+        """Изменения видны сразу, без ожидания истечения кэша"""
+        for url in self.urls:
+            self.client.get(url)
+        Post.objects.create(text="Второй", author=self.user, group=self.group)
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertContains(self.client.get(url), "Второй")
+
+        Comment.objects.create(post=self.post, author=self.user, text="Ок")
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertContains(self.client.get(url), "1 комментариев")
+
+        self.group.title = "Переименованная"
+        self.group.save()
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertContains(self.client.get(url), "Переименованная")
+
+    def test_group_change_on_edit(self):
+        """Пост, перенесённый в другую группу, исчезает из старой"""
+        other = Group.objects.create(title="Другая", slug="other",
+                                     description="Другая группа")
+        url = reverse("groups", args=[self.group.slug])
+        self.assertContains(self.client.get(url), "Первый")
+        self.post.group = other
+        self.post.save()
+        self.assertNotContains(self.client.get(url), "Первый")
+
+
+class PageCacheHolesTest(TestCase):
+    """Тесты общего кэша страниц с персональными фрагментами"""
+    def setUp(self):
+        cache.clear()
+        self.anonymous = Client()
+        self.author = Client()
+        self.reader = Client()
+        self.user = User.objects.create_user(username="sarah")
+        self.other = User.objects.create_user(username="terminator")
+        self.author.force_login(self.user)
+        self.reader.force_login(self.other)
+        self.post = Post.objects.create(text="Пост", author=self.user)
+        self.edit_url = reverse("post_edit", args=["sarah", self.post.id])
+
+    def test_fragments_do_not_leak(self):
+        """Ссылка «Редактировать» видна только автору"""
+        for url in (reverse("index"), reverse("profile", args=["sarah"])):
+            with self.subTest(url=url):
+                self.assertContains(self.author.get(url), self.edit_url)
+                self.assertNotContains(self.reader.get(url), self.edit_url)
+                self.assertNotContains(self.anonymous.get(url),
+                                       self.edit_url)
+                self.assertContains(self.author.get(url), self.edit_url)
+
+    def test_user_menu(self):
+        self.assertContains(self.anonymous.get(reverse("index")), "Войти")
+        response = self.reader.get(reverse("index"))
+        self.assertContains(response, "Пользователь: terminator")
+        self.assertContains(response, reverse("follow_index"))
+        self.assertNotContains(response, "<!--hole:")
+
+    def test_follow_button(self):
+        url = reverse("profile", args=["sarah"])
+        self.assertContains(self.reader.get(url), "Подписаться")
+        Follow.objects.create(user=self.other, author=self.user)
+        self.assertContains(self.reader.get(url), "Отписаться")
+        self.assertNotContains(self.author.get(url), "Подписаться")
+
+    def test_skeleton_is_shared(self):
+        """Вошедший пользователь получает страницу из общего каркаса"""
+        self.anonymous.get(reverse("index"))
+        with CaptureQueriesContext(connection) as queries:
+            self.reader.get(reverse("index"))
+        for query in queries:
+            self.assertNotIn("posts_post", query["sql"])
+
+
+class PostCardCacheTest(TestCase):
+    """Тесты кэша отрендеренных карточек постов"""
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+        self.client.force_login(self.user)
+        self.group = Group.objects.create(title="Тестовая", slug="test",
+                                          description="Тестовая группа")
+        self.post = Post.objects.create(text="Пост", author=self.user,
+                                        group=self.group)
+
+    def cached_card(self):
+        post = Post.objects.for_feed().get(pk=self.post.pk)
+        key, versions = caching.card_key(post)
+        return cache.get(key)
+
+    def test_card_is_cached_without_user_fragments(self):
+        self.client.get(reverse("index"))
+        card = self.cached_card()
+        self.assertIn("Пост", card)
+        self.assertIn("<!--hole:post_edit_link:sarah:", card)
+        self.assertNotIn("Редактировать", card)
+
+    def test_card_invalidation(self):
+        """Карточка обновляется после правки, комментария и смены группы"""
+        self.client.get(reverse("index"))
+        self.client.post(reverse("post_edit", args=["sarah", self.post.id]),
+                         {"text": "Исправленный пост",
+                          "group": self.group.id})
+        self.assertIsNone(self.cached_card())
+        self.assertContains(self.client.get(reverse("index")),
+                            "Исправленный пост")
+
+        self.client.post(reverse("add_comment", args=["sarah", self.post.id]),
+                         {"text": "Комментарий"})
+        self.assertIsNone(self.cached_card())
+        self.assertContains(self.client.get(reverse("index")),
+                            "1 комментариев")
+
+        self.group.title = "Переименованная"
+        self.group.save()
+        self.assertIsNone(self.cached_card())
+        self.assertContains(self.client.get(reverse("index")),
+                            "#Переименованная")
+
+    def test_page_reads_cards_in_one_batch(self):
+        """Карточки страницы читаются из кэша одним get_many"""
+        for i in range(4):
+            Post.objects.create(text=f"Пост {i}", author=self.user)
+        page = Template("{% load post_cards %}"
+                        "{% prefetch_post_cards posts %}"
+                        "{% for post in posts %}{% post_card post %}"
+                        "{% endfor %}")
+        posts = list(Post.objects.for_feed())
+        page.render(Context({"posts": posts}))
+        with mock.patch.object(cache, "get", wraps=cache.get) as get, \
+                mock.patch.object(cache, "get_many",
+                                  wraps=cache.get_many) as get_many:
+            html = page.render(Context({"posts": posts}))
+        self.assertEqual(html.count('class="card-body'), 5)
+        self.assertEqual(get.call_count, 0)
+        # Версии постов и групп, затем сами карточки.
+        self.assertEqual(get_many.call_count, 2)
+
+
+class SQLiteCacheTest(TestCase):
+    """Тесты общего кэша в файле SQLite"""
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cache.db")
+        self.cache = self.open()
+
+    def open(self, **options):
+        return SQLiteCache(self.path, {"OPTIONS": options})
+
+    def test_tests_use_temporary_cache(self):
+        """Тесты не пишут в кэш разработчика в корне проекта"""
+        location = settings.CACHES["default"]["LOCATION"]
+        self.assertNotEqual(os.path.dirname(location), settings.BASE_DIR)
+
+    def test_basic_operations(self):
+        self.cache.set("a", {"text": "Пост"})
+        self.assertEqual(self.cache.get("a"), {"text": "Пост"})
+        self.assertFalse(self.cache.add("a", 1))
+        self.assertTrue(self.cache.add("b", 1))
+        self.assertEqual(self.cache.incr("b", 5), 6)
+        with self.assertRaises(ValueError):
+            self.cache.incr("missing")
+        self.cache.set_many({"c": True, "d": b"bytes"})
+        self.assertEqual(self.cache.get_many(["a", "b", "c", "d", "e"]),
+                         {"a": {"text": "Пост"}, "b": 6, "c": True,
+                          "d": b"bytes"})
+        self.cache.delete_many(["a", "b"])
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_expiry(self):
+        self.cache.set("a", 1, timeout=-1)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertTrue(self.cache.add("a", 2))
+        self.assertEqual(self.cache.get("a"), 2)
+
+    def test_shared_between_instances(self):
+        """Запись и incr видны другому экземпляру, как другому процессу"""
+        other = self.open()
+        self.cache.set("version", 1)
+        other.incr("version")
+        self.assertEqual(self.cache.get("version"), 2)
+        other.delete("version")
+        self.assertIsNone(self.cache.get("version"))
+
+    def test_lru_cull(self):
+        cache = self.open(MAX_ENTRIES=10, CULL_CHECK_EVERY=1,
+                          ACCESS_RESOLUTION=0)
+        for i in range(10):
+            cache.set(f"k{i}", i)
+        cache.get("k0")
+        cache.set("k10", 10)
+        self.assertEqual(cache.get("k0"), 0)
+        self.assertIsNone(cache.get("k1"))
+        self.assertEqual(cache.get("k10"), 10)
+
+
+class SearchTest(TestCase):
+    """Тесты полнотекстового поиска"""
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+        self.cat = Post.objects.create(text="Кошка спит на диване",
+                                       author=self.user)
+        self.cats = Post.objects.create(text="Кошки и собаки. Кошка <b>",
+                                        author=self.user)
+        self.dog = Post.objects.create(text="Собака гуляет", author=self.user)
+
+    def search(self, query, **params):
+        return self.client.get(reverse("search"), {"q": query, **params})
+
+    def test_ranked_and_highlighted(self):
+        response = self.search("кошк")
+        self.assertEqual(list(response.context["page"]),
+                         [self.cats, self.cat])
+        self.assertContains(response, "<mark>Кошки</mark>")
+        self.assertContains(response, "&lt;b&gt;")
+        self.assertNotContains(response, "Собака гуляет")
+
+    def test_index_follows_edits_and_deletes(self):
+        self.dog.text = "Кошка гуляет"
+        self.dog.save()
+        self.assertIn(self.dog, self.search("гуляет").context["page"])
+        self.dog.delete()
+        self.assertEqual(list(self.search("гуляет").context["page"]), [])
+
+    def test_query_syntax_is_escaped(self):
+        for query in ('"', "кошка OR", "NEAR(", "*", ""):
+            with self.subTest(query=query):
+                self.assertEqual(self.search(query).status_code, 200)
+
+    def test_cursor_pagination(self):
+        for i in range(12):
+            Post.objects.create(text=f"Кошка номер {i}", author=self.user)
+        first = self.search("кошка").context["page"]
+        self.assertTrue(first.has_next())
+        response = self.search("кошка", cursor=first.next_cursor)
+        second = list(response.context["page"])
+        self.assertEqual(len(first) + len(second), 14)
+        self.assertFalse(set(first) & set(second))
+        self.assertContains(response, "q=%D0%BA%D0%BE%D1%88%D0%BA%D0%B0")
+
+    def test_reindex_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {search.TABLE}")
+        call_command("search_reindex", stdout=StringIO())
+        self.assertEqual(list(self.search("диване").context["page"]),
+                         [self.cat])
+
+    def test_admin_uses_index(self):
+        admin = User.objects.create_superuser("admin", "a@a.ru", "pass")
+        self.client.force_login(admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/admin/posts/post/", {"q": "диван"})
+        self.assertContains(response, "Кошка спит на диване")
+        self.assertNotContains(response, "Собака гуляет")
+        sql = " ".join(query["sql"] for query in queries)
+        self.assertIn("MATCH", sql)
+        self.assertNotIn("LIKE", sql)
+
+
+class ThumbnailPregenerationTest(TestCase):
+    """Тесты построения миниатюр после сохранения поста"""
+    small_gif = (
+        b'\x47\x49\x46\x38\x39\x61\x01\x00\x01\x00\x00\x00\x00\x21\xf9\x04'
+        b'\x01\x0a\x00\x01\x00\x2c\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02'
+        b'\x02\x4c\x01\x00\x3b'
+    )
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+        self.client.force_login(self.user)
+
+    def run_on_commit(self):
+        # TestCase не коммитит транзакцию, поэтому колбэки вызываем сами.
+        callbacks = [func for _, func in connection.run_on_commit]
+        connection.run_on_commit = []
+        for func in callbacks:
+            func()
+
+    def upload(self):
+        return SimpleUploadedFile("some.gif", self.small_gif,
+                                  content_type="image/gif")
+
+    @override_settings(THUMBNAIL_WORKERS=0)
+    def test_new_post_thumbnail_is_ready_for_template(self):
+        self.client.post(reverse("new_post"),
+                         {"text": "Пост", "image": self.upload()})
+        with mock.patch.object(thumbnails, "generate",
+                               wraps=thumbnails.generate) as generate:
+            self.run_on_commit()
+        post = Post.objects.get()
+        generate.assert_called_once_with(post.pk, "default")
+
+        with mock.patch("sorl.thumbnail.base.ThumbnailBackend."
+                        "_create_thumbnail") as create:
+            response = self.client.get(reverse("index"))
+        self.assertContains(response, "<img")
+        create.assert_not_called()
+
+    def test_scheduled_only_when_image_changes(self):
+        with mock.patch.object(thumbnails, "schedule") as schedule:
+            post = Post.objects.create(text="Пост", author=self.user)
+            schedule.assert_not_called()
+            post.image = self.upload()
+            post.save()
+            self.assertEqual(schedule.call_count, 1)
+            post.text = "Исправленный пост"
+            post.save()
+            self.assertEqual(schedule.call_count, 1)
+
+    def test_worker_errors_are_logged(self):
+        post = Post.objects.create(text="Пост", author=self.user,
+                                   image=self.upload())
+        with mock.patch("posts.thumbnails.get_thumbnail",
+                        side_effect=OSError("диск полон")):
+            with self.assertLogs("posts.thumbnails", "ERROR"):
+                thumbnails.generate(post.pk)
+
+
+class ResponsiveImageTest(TestCase):
+    """Тесты вариантов картинки поста для srcset"""
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+
+    def upload(self, width, height):
+        content = BytesIO()
+        Image.new("RGB", (width, height), "red").save(content, "JPEG")
+        return SimpleUploadedFile("photo.jpg", content.getvalue(),
+                                  content_type="image/jpeg")
+
+    def test_srcset_with_webp_and_dimensions(self):
+        post = Post.objects.create(text="Пост", author=self.user,
+                                   image=self.upload(1200, 800))
+        self.assertEqual((post.image_width, post.image_height), (1200, 800))
+        response = self.client.get(reverse("index"))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, 'loading="lazy"')
+        self.assertContains(response, 'width="960" height="339"')
+        html = response.content.decode()
+        for width in (480, 720, 960):
+            self.assertIn(f".webp {width}w", html)
+            self.assertIn(f".jpg {width}w", html)
+
+    def test_no_upscaled_variants(self):
+        post = Post.objects.create(text="Пост", author=self.user,
+                                   image=self.upload(600, 400))
+        response = self.client.get(reverse("post", args=["sarah", post.id]))
+        self.assertContains(response, "480w")
+        self.assertNotContains(response, "720w")
+        self.assertContains(response, 'width="480" height="170"')
+
+    def test_dimensions_follow_image_changes(self):
+        post = Post.objects.create(text="Пост", author=self.user,
+                                   image=self.upload(1200, 800))
+        post.image = self.upload(800, 600)
+        post.save()
+        post.refresh_from_db()
+        self.assertEqual((post.image_width, post.image_height), (800, 600))
+        post.image = None
+        post.save()
+        post.refresh_from_db()
+        self.assertIsNone(post.image_width)
+
+
+class PostImageMetaTest(TestCase):
+    """Тесты сохранённых сведений о картинке поста"""
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah")
+        content = BytesIO()
+        Image.new("RGB", (1200, 800), "red").save(content, "JPEG")
+        self.content = content.getvalue()
+        self.post = Post.objects.create(
+            text="Пост", author=self.user,
+            image=SimpleUploadedFile("photo.jpg", self.content,
+                                     content_type="image/jpeg"))
+
+    def test_feed_renders_without_sorl(self):
+        thumbnails.generate(self.post.pk)
+        meta = PostImage.objects.get(post=self.post)
+        self.assertEqual(meta.sha256, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(meta.source, self.post.image.name)
+
+        with mock.patch("posts.thumbnails.get_thumbnail",
+                        side_effect=AssertionError) as get_thumbnail:
+            response = self.client.get(reverse("index"))
+        get_thumbnail.assert_not_called()
+        self.assertContains(response, ".webp 960w")
+        self.assertContains(response, 'width="960" height="339"')
+
+    def test_feed_without_meta_links_resized_variants(self):
+        """Без PostImage карточка ссылается на /img/ и не спрашивает sorl"""
+        digest = hashlib.sha256(self.content).hexdigest()
+        with mock.patch("posts.thumbnails.get_thumbnail",
+                        side_effect=AssertionError) as get_thumbnail:
+            response = self.client.get(reverse("index"))
+        get_thumbnail.assert_not_called()
+        url = reverse("resized_image", args=[digest, 960, 339, "webp"])
+        self.assertContains(response, f"{url} 960w")
+
+    def test_stale_meta_is_ignored(self):
+        thumbnails.generate(self.post.pk)
+        PostImage.objects.filter(post=self.post).update(source="old.jpg",
+                                                        picture="{}")
+        response = self.client.get(reverse("index"))
+        self.assertContains(response, ".webp 960w")
+
+
+class ContentAddressedStorageTest(TestCase):
+    """Тесты хранилища картинок с именами по содержимому"""
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.storage = Post._meta.get_field("image").storage
+        self.user = User.objects.create_user(username="sarah")
+        content = BytesIO()
+        Image.new("RGB", (100, 100), "red").save(content, "PNG")
+        self.content = content.getvalue()
+
+    def upload(self, name="photo.png", content=None):
+        return SimpleUploadedFile(name, content or self.content,
+                                  content_type="image/png")
+
+    def references(self, name):
+        return (ImageReference.objects.filter(pk=name)
+                .values_list("references", flat=True).first())
+
+    def run_on_commit(self):
+        callbacks = [func for _, func in connection.run_on_commit]
+        connection.run_on_commit = []
+        for func in callbacks:
+            func()
+
+    def test_same_content_is_stored_once(self):
+        first = Post.objects.create(text="Пост", author=self.user,
+                                    image=self.upload("a.PNG"))
+        second = Post.objects.create(text="Пост", author=self.user,
+                                     image=self.upload("b.png"))
+        digest = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(first.image.name,
+                         f"posts/{digest[:2]}/{digest}.png")
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(os.listdir(self.storage.path("posts/" + digest[:2])),
+                         [f"{digest}.png"])
+
+    def test_file_removed_with_last_reference(self):
+        first = Post.objects.create(text="Пост", author=self.user,
+                                    image=self.upload())
+        second = Post.objects.create(text="Пост", author=self.user,
+                                     image=self.upload())
+        name = first.image.name
+        self.assertEqual(self.references(name), 2)
+        first.delete()
+        self.run_on_commit()
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.references(name), 1)
+        second.image = self.upload(content=b"GIF89a" + self.content)
+        second.save()
+        self.run_on_commit()
+        self.assertFalse(self.storage.exists(name))
+        self.assertIsNone(self.references(name))
+
+    def test_file_uploaded_again_is_kept(self):
+        """Файл, снова загруженный до release(), не удаляется"""
+        first = Post.objects.create(text="Пост", author=self.user,
+                                    image=self.upload())
+        name = first.image.name
+        first.delete()
+        Post.objects.create(text="Пост", author=self.user,
+                            image=self.upload())
+        self.run_on_commit()
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.references(name), 1)
+
+    def test_rebuild_references(self):
+        post = Post.objects.create(text="Пост", author=self.user,
+                                   image=self.upload())
+        ImageReference.objects.all().delete()
+        ImageReference.objects.rebuild()
+        self.assertEqual(self.references(post.image.name), 1)
+
+    def test_dedupe_command(self):
+        legacy = [self.storage.path(f"posts/legacy_{i}.png") for i in (1, 2)]
+        os.makedirs(os.path.dirname(legacy[0]))
+        posts = []
+        for path in legacy:
+            with open(path, "wb") as output:
+                output.write(self.content)
+            post = Post.objects.create(text="Пост", author=self.user)
+            Post.objects.filter(pk=post.pk).update(
+                image="posts/" + os.path.basename(path))
+            posts.append(post)
+        call_command("dedupe_images", stdout=StringIO())
+        names = {Post.objects.get(pk=post.pk).image.name for post in posts}
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertTrue(is_content_addressed(name))
+        self.assertEqual(self.references(name), 2)
+        for path in legacy:
+            self.assertFalse(os.path.exists(path))
+
+
+class ResizedImageTest(TestCase):
+    """Тесты эндпоинта вариантов картинки /img/<sha256>/<w>x<h>/"""
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = os.path.join(directory.name, "resized")
+        media = override_settings(MEDIA_ROOT=directory.name,
+                                  IMAGE_CACHE_DIR=self.cache_dir)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.client = Client()
+        user = User.objects.create_user(username="sarah")
+        content = BytesIO()
+        Image.new("RGB", (1200, 800), "red").save(content, "JPEG")
+        self.digest = hashlib.sha256(content.getvalue()).hexdigest()
+        Post.objects.create(text="Пост", author=user, image=SimpleUploadedFile(
+            "photo.jpg", content.getvalue(), content_type="image/jpeg"))
+
+    def url(self, size="480x170", extension=None):
+        url = f"/img/{self.digest}/{size}"
+        return f"{url}.{extension}" if extension else f"{url}/"
+
+    def test_render_once_then_serve_from_disk(self):
+        response = self.client.get(self.url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("immutable", response["Cache-Control"])
+        image = Image.open(BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(image.size, (480, 170))
+
+        with mock.patch.object(resizer, "render") as render:
+            again = self.client.get(self.url())
+        render.assert_not_called()
+        self.assertEqual(again["ETag"], response["ETag"])
+
+        not_modified = self.client.get(
+            self.url(), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_webp(self):
+        response = self.client.get(self.url("960x339", "webp"))
+        self.assertEqual(response["Content-Type"], "image/webp")
+
+    def test_unknown_geometry_and_source(self):
+        for url in (self.url("481x170"), self.url("480x170", "gif"),
+                    f"/img/{'0' * 64}/480x170/"):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_matching_etag_does_not_hide_404(self):
+        Post.objects.all().delete()
+        for digest, size, extension in ((self.digest, "481x170", "jpg"),
+                                        (self.digest, "480x170", "gif"),
+                                        (self.digest, "480x170", "jpg")):
+            url = f"/img/{digest}/{size}.{extension}"
+            with self.subTest(url=url):
+                response = self.client.get(
+                    url, HTTP_IF_NONE_MATCH=f'"{digest}-{size}.{extension}"')
+                self.assertEqual(response.status_code, 404)
+
+    def test_lru_cull(self):
+        for size in ("480x170", "720x254", "960x339"):
+            self.client.get(self.url(size))
+        paths = [resizer.cache_path(self.digest, w, h, "jpg")
+                 for w, h in ((480, 170), (720, 254), (960, 339))]
+        os.utime(paths[0], (0, 0))
+        sizes = [os.path.getsize(path) for path in paths]
+        resizer.cull(max_bytes=sum(sizes) - 1)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[2]))
+
+
+class StreamDumpTest(TestCase):
+    """Тесты потоковой выгрузки и загрузки дампа"""
+    def setUp(self):
+        self.author = User.objects.create_user(username="leo")
+        self.reader = User.objects.create_user(username="sarah")
+        group = Group.objects.create(title="Кошки", slug="cats",
+                                     description="Группа про кошек")
+        self.post = Post.objects.create(text="Кошка спит", author=self.author,
+                                        group=group)
+        Post.objects.filter(pk=self.post.pk).update(
+            pub_date="1854-03-14T00:00:00Z")
+        Comment.objects.create(post=self.post, author=self.reader,
+                               text="Комментарий")
+        Follow.objects.create(user=self.reader, author=self.author)
+        page = FlatPage.objects.create(url="/terms/", title="Условия")
+        page.sites.add(Site.objects.get_current())
+
+    def test_iter_objects_across_chunks(self):
+        text = '[ {"a": "x]y,z"} ,\n{"b": [1, {"c": 2}]}, {}]'
+        with mock.patch.object(dumps, "READ_SIZE", 3):
+            self.assertEqual(list(dumps.iter_objects(StringIO(text))),
+                             [{"a": "x]y,z"}, {"b": [1, {"c": 2}]}, {}])
+        self.assertEqual(list(dumps.iter_objects(StringIO(" [ ] "))), [])
+
+    def test_standard_streams(self):
+        """«-» пишет в stdout команды и не закрывает потоки процесса"""
+        output = StringIO()
+        call_command("stream_dump", stdout=output, stderr=StringIO())
+        labels = [obj["model"] for obj in
+                  dumps.iter_objects(StringIO(output.getvalue()))]
+        self.assertIn("posts.post", labels)
+        self.assertFalse(output.closed)
+        with mock.patch("sys.stdin", StringIO(output.getvalue())) as stdin:
+            call_command("stream_load", "-", stdout=StringIO())
+        self.assertFalse(stdin.closed)
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_round_trip(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "dump.json.gz")
+        call_command("stream_dump", "-o", path, "--batch-size", "2",
+                     stderr=StringIO())
+        with dumps.open_dump(path, "r") as stream:
+            labels = [obj["model"] for obj in dumps.iter_objects(stream)]
+        self.assertIn("posts.post", labels)
+        self.assertNotIn("posts.userstats", labels)
+
+        Post.objects.all().delete()
+        FlatPage.objects.all().delete()
+        Follow.objects.all().delete()
+        User.objects.all().delete()
+        call_command("stream_load", path, "--batch-size", "2",
+                     stdout=StringIO())
+
+        post = Post.objects.get()
+        self.assertEqual(post.pub_date.year, 1854)
+        self.assertEqual(post.comments.get().text, "Комментарий")
+        self.assertEqual(FlatPage.objects.get().sites.count(), 1)
+        self.assertEqual(UserStats.objects.for_user(self.author)
+                         .followers_count, 1)
+        self.assertEqual(TimelineEntry.objects.get().post, post)
+        self.assertEqual(search.SearchResults("кошка")
+                         .fetch(None, None, False, 10)[0].id, post.pk)
+
+
+class GenerateDatasetTest(TestCase):
+    """Тесты генератора набора данных"""
+    def generate(self, seed=7):
+        first = (User.objects.order_by("-pk").values_list("pk", flat=True)
+                 .first() or 0) + 1
+        call_command("generate_dataset", "--users", "30", "--groups", "3",
+                     "--posts", "300", "--comments", "100", "--follows", "5",
+                     "--seed", str(seed), stdout=StringIO())
+        return first, [(post.author_id - first, post.text)
+                       for post in Post.objects.filter(author__gte=first)
+                       .order_by("pk")]
+
+    def test_seeded_and_consistent(self):
+        first, posts = self.generate()
+        self.assertEqual(len(posts), 300)
+        self.assertEqual(self.generate()[1], posts)
+        self.assertNotEqual(self.generate(seed=8)[1], posts)
+
+        counts = [sum(1 for author, _ in posts if author == i)
+                  for i in range(30)]
+        self.assertGreater(max(counts), 10 * min(counts) + 10)
+        self.assertEqual(Comment.objects.count(), 300)
+        top = counts.index(max(counts))
+        self.assertEqual(UserStats.objects.get(pk=first + top).posts_count,
+                         max(counts))
+        self.assertTrue(TimelineEntry.objects.exists())
+
+
+class BenchmarkReplayTest(TestCase):
+    """Тесты воспроизведения трассы запросов"""
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f"reader{i}")
+                      for i in range(3)]
+        group = Group.objects.create(title="Группа", slug="bench")
+        for i in range(10):
+            Post.objects.create(text=f"Пост {i} про кошку",
+                                author=self.users[i % 3], group=group)
+
+    def test_replay_in_process(self):
+        trace = benchmark.build_trace(80, seed=1)
+        self.assertEqual(trace, benchmark.build_trace(80, seed=1))
+        posts_before = Post.objects.count()
+        transport = benchmark.InProcessTransport(get_wsgi_application())
+        records = benchmark.replay(trace, transport, warmup=5)
+        self.assertEqual(len(records), 75)
+        self.assertFalse([r for r in records if r[1] >= 500])
+
+        result = benchmark.summarize(records, 1.0)
+        self.assertEqual(result["requests"], 75)
+        follow = result["endpoints"]["GET follow_index"]
+        self.assertGreater(follow["queries"], 0)
+        self.assertLessEqual(follow["p50"], follow["p99"])
+        new_posts = sum(1 for entry in trace if entry["path"] == "/new/")
+        self.assertEqual(Post.objects.count(), posts_before + new_posts)
+
+    def test_compare_with_baseline(self):
+        baseline = {"rps": 100, "endpoints": {
+            "GET index": {"p95": 10.0, "queries": 3}}}
+        same = {"rps": 95, "endpoints": {
+            "GET index": {"p95": 11.0, "queries": 3}}}
+        worse = {"rps": 50, "endpoints": {
+            "GET index": {"p95": 30.0, "queries": 4}}}
+        self.assertEqual(benchmark.compare(same, baseline), [])
+        self.assertEqual(len(benchmark.compare(worse, baseline)), 3)
+
+
+class SeededViewsMixin:
+    """Набор из generate_dataset и запросы ко всем страницам posts"""
+    def seed(self, size, seed):
+        first = (User.objects.order_by("-pk").values_list("pk", flat=True)
+                 .first() or 0) + 1
+        first_post = (Post.objects.order_by("-pk")
+                      .values_list("pk", flat=True).first() or 0) + 1
+        call_command("generate_dataset", "--users", str(size // 4),
+                     "--groups", "3", "--posts", str(size),
+                     "--comments", str(size * 2), "--follows", "5",
+                     "--seed", str(seed), stdout=StringIO())
+        posts = Post.objects.filter(pk__gte=first_post).order_by("pk")
+        for number, post_id in enumerate(posts.values_list("pk", flat=True)):
+            if number % 3 == 0:
+                self.add_image(post_id, with_meta=number % 2 == 0)
+        users = User.objects.filter(pk__gte=first)
+        author = (users.annotate(posts_count=Count("posts"))
+                  .order_by("-posts_count", "pk").first())
+        reader = (users.exclude(pk=author.pk)
+                  .annotate(follows=Count("follower"))
+                  .order_by("-follows", "pk").first())
+        Follow.objects.get_or_create(user=reader, author=author)
+        post = (Post.objects.filter(author=author)
+                .annotate(comments_count=Count("comments"))
+                .order_by("-comments_count", "pk").first())
+        PostImage.objects.filter(post=post).delete()
+        self.add_image(post.pk, with_meta=False)
+        return author, reader, post
+
+    def add_image(self, post_id, with_meta):
+        """Картинка поста; без PostImage — как до построения миниатюр"""
+        digest = hashlib.sha256(str(post_id).encode()).hexdigest()
+        name = f"posts/{digest[:2]}/{digest}.jpg"
+        Post.objects.filter(pk=post_id).update(
+            image=name, image_width=1200, image_height=800)
+        if with_meta:
+            PostImage.objects.create(
+                post_id=post_id, source=name, sha256=digest,
+                picture=json.dumps({
+                    "sources": [["image/jpeg", "/media/a.jpg 960w"]],
+                    "src": "/media/a.jpg", "width": 960, "height": 339}))
+
+    def requests(self, author, reader, post):
+        """Имя URL -> (пользователь, аргументы) для каждой страницы"""
+        post_args = [author.username, post.pk]
+        return {
+            "index": (reader, []),
+            "groups": (reader, [post.group.slug if post.group
+                                else Group.objects.first().slug]),
+            "new_post": (reader, []),
+            "follow_index": (reader, []),
+            "search": (reader, []),
+            "resized_image": (None, ["0" * 64, 960, 339]),
+            "profile_follow": (reader, [author.username]),
+            "profile_unfollow": (reader, [author.username]),
+            "profile": (reader, [author.username]),
+            "post": (reader, post_args),
+            "post_edit": (author, post_args),
+            "add_comment": (reader, post_args),
+        }
+
+    def client_for(self, user, name, args):
+        """Клиент и адрес страницы; кэш сбрасывается перед запросом"""
+        client = Client()
+        if user is not None:
+            client.force_login(user)
+        url = reverse(name, args=args)
+        if name == "search":
+            url += "?q=кошка"
+        cache.clear()
+        return client, url
+
+
+class QueryBudgetTest(SeededViewsMixin, TestCase):
+    """Число запросов каждой страницы постоянно и не выше бюджета"""
+    SIZES = (20, 200)
+
+    def count_queries(self, user, name, args):
+        client, url = self.client_for(user, name, args)
+        with CaptureQueriesContext(connection) as queries:
+            client.get(url)
+        return [query["sql"] for query in queries.captured_queries]
+
+    def test_budgets(self):
+        self.assertEqual({pattern.name for pattern in urlpatterns},
+                         set(QUERY_BUDGETS))
+        measured = {}
+        for seed, size in enumerate(self.SIZES):
+            requests = self.requests(*self.seed(size, seed))
+            self.assertEqual(set(requests), set(QUERY_BUDGETS))
+            for name, (user, args) in requests.items():
+                measured.setdefault(name, []).append(
+                    self.count_queries(user, name, args))
+        for name, runs in measured.items():
+            with self.subTest(name=name):
+                self.assertQueryBudget(name, runs)
+
+    def assertQueryBudget(self, name, runs):
+        counts = [len(queries) for queries in runs]
+        budget = QUERY_BUDGETS[name]
+        if len(set(counts)) == 1 and counts[0] <= budget:
+            return
+        worst = max(runs, key=len)
+        self.fail(f"{name}: запросов {counts} на наборах {self.SIZES}, "
+                  f"бюджет {budget}:\n" + "\n".join(
+                      f"{i}. {sql}" for i, sql in enumerate(worst, 1)))
+
+
+class MetricsTest(TestCase):
+    """Тесты Server-Timing и /metrics"""
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.user = User.objects.create_user(username="sarah")
+        Post.objects.create(text="Пост", author=self.user)
+
+    def test_server_timing(self):
+        response = self.client.get(reverse("index"))
+        timing = response["Server-Timing"]
+        self.assertIn("total;dur=", timing)
+        self.assertIn("tpl;dur=", timing)
+        self.assertRegex(timing, r'db;desc="[1-9]\d* queries"')
+        self.assertRegex(timing, r'cache;desc="\d+ hits, [1-9]\d* misses"')
+
+    def test_export(self):
+        self.client.get(reverse("index"))
+        self.client.get(reverse("index"))
+        self.client.get("/no/such/page/")
+        with override_settings(METRICS_TOKEN="secret"):
+            text = self.client.get(reverse("metrics"),
+                                   HTTP_AUTHORIZATION="Bearer secret")
+        text = text.content.decode()
+        self.assertIn('yatube_requests_total{view="index",method="GET",'
+                      'status="200"} 2', text)
+        self.assertIn('yatube_request_duration_seconds_count{view="index"} 2',
+                      text)
+        self.assertIn('yatube_request_sql_queries_bucket{view="index",'
+                      'le="+Inf"} 2', text)
+        self.assertIn('yatube_cache_lookups_total{view="index",'
+                      'result="hit"}', text)
+        self.assertIn('status="404"', text)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_export_access(self):
+        """С разрешённого адреса нужен ещё токен или сотрудник сайта"""
+        url = reverse("metrics")
+        for headers in ({}, {"HTTP_AUTHORIZATION": "Bearer wrong"},
+                        {"HTTP_AUTHORIZATION": "Bearer secret",
+                         "REMOTE_ADDR": "203.0.113.5"}):
+            with self.subTest(headers=headers):
+                self.assertEqual(
+                    self.client.get(url, **headers).status_code, 404)
+        self.assertEqual(self.client.get(
+            url, HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram("h", "", ("view",), (1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(("a",), value)
+        self.assertEqual(list(histogram.samples()), [
+            'h_bucket{view="a",le="1"} 2',
+            'h_bucket{view="a",le="5"} 3',
+            'h_bucket{view="a",le="+Inf"} 4',
+            'h_sum{view="a"} 14.5',
+            'h_count{view="a"} 4',
+        ])
+
+
+class ProfilingTest(TestCase):
+    """Тесты профилирования отдельных запросов"""
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(PROFILING_DIR=self.directory.name,
+                                          PROFILING_INTERVAL=0.001)
+        self.settings.enable()
+        self.user = User.objects.create_user(username="sarah")
+        self.post = Post.objects.create(text="Пост", author=self.user)
+        self.url = reverse("post", args=[self.user.username, self.post.pk])
+
+    def tearDown(self):
+        self.settings.disable()
+        self.directory.cleanup()
+
+    def test_token(self):
+        staff = User.objects.create_user(username="admin", is_staff=True)
+        token = profiling.make_token(staff)
+        self.client.get(self.url)
+        self.client.get(self.url, HTTP_X_PROFILE="profile:bad:token")
+        # Без входа токен сотрудника не действует.
+        self.client.get(self.url, HTTP_X_PROFILE=token)
+        self.assertFalse(RequestProfile.objects.exists())
+
+        self.client.force_login(staff)
+        self.client.get(self.url, HTTP_X_PROFILE=token)
+        self.client.get(self.url, {"_profile": token})
+        self.assertEqual(RequestProfile.objects.count(), 1)
+        profile = RequestProfile.objects.first()
+        self.assertEqual((profile.view, profile.status, profile.trigger),
+                         ("post", 200, "token"))
+        self.assertGreater(profile.queries, 0)
+        self.assertIn("posts_post", profile.sql)
+        self.assertTrue(os.path.exists(profiling.stacks_path(profile)))
+
+        profile.delete()
+        self.assertFalse(os.path.exists(profiling.stacks_path(profile)))
+
+    def test_token_is_bound_to_staff_user(self):
+        staff = User.objects.create_user(username="admin", is_staff=True)
+        other = User.objects.create_user(username="other", is_staff=True)
+        token = profiling.make_token(staff)
+        self.client.force_login(other)
+        self.client.get(self.url, HTTP_X_PROFILE=token)
+        staff.is_staff = False
+        staff.save()
+        self.client.force_login(staff)
+        self.client.get(self.url, HTTP_X_PROFILE=token)
+        self.assertFalse(RequestProfile.objects.exists())
+        with self.assertRaises(CommandError):
+            call_command("profile_token", "admin", stdout=StringIO(),
+                         stderr=StringIO())
+
+    @override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_KEEP=2)
+    def test_sampling_keeps_latest(self):
+        for _ in range(3):
+            self.client.get(self.url)
+        self.assertEqual(RequestProfile.objects.count(), 2)
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+        self.assertEqual(RequestProfile.objects.first().trigger, "sample")
+
+    def test_sampler_collapsed_stacks(self):
+        sampler = profiling.Sampler(threading.get_ident(), 0.001)
+        sampler.start()
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        sampler.stop()
+        stack, count = sampler.collapsed().splitlines()[0].rsplit(" ", 1)
+        self.assertIn("test_sampler_collapsed_stacks (posts/tests.py:",
+                      stack.split(";")[-1])
+        self.assertGreater(int(count), 0)
+
+    @override_settings(PROFILING_SAMPLE_RATE=1)
+    def test_admin(self):
+        self.client.get(self.url)
+        profile = RequestProfile.objects.get()
+        admin = User.objects.create_superuser("admin", "a@example.com", "x")
+        self.client.force_login(admin)
+        with override_settings(PROFILING_SAMPLE_RATE=0):
+            page = self.client.get(reverse(
+                "admin:posts_requestprofile_change", args=[profile.pk]))
+            stacks = self.client.get(reverse(
+                "admin:posts_requestprofile_stacks", args=[profile.pk]))
+        self.assertContains(page, "posts_post")
+        self.assertEqual(stacks.status_code, 200)
+
+
+class QueryPlanTest(SeededViewsMixin, TestCase):
+    """Запросы страниц идут по индексам, без полных сканов и сортировок"""
+    BAD_PLAN_RE = re.compile(r"^SCAN (TABLE )?\w+$|USE TEMP B-TREE")
+    # Форма поста выводит все группы списком; поиск сортирует найденное
+    # по bm25, которое считается для каждого совпадения.
+    ALLOWED = {"posts_group", search.TABLE}
+
+    def capture(self, user, name, args):
+        client, url = self.client_for(user, name, args)
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            if sql.lstrip().upper().startswith("SELECT"):
+                queries.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            client.get(url)
+        return queries
+
+    def explain(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_no_scans(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("Планы разбираются в формате SQLite")
+        requests = self.requests(*self.seed(100, 0))
+        for name, (user, args) in requests.items():
+            for sql, params in self.capture(user, name, args):
+                if re.search(r"FROM \"?(%s)\"?(\s|$)" % "|".join(
+                        self.ALLOWED), sql):
+                    continue
+                plan = self.explain(sql, params)
+                bad = [step for step in plan if self.BAD_PLAN_RE.search(step)]
+                with self.subTest(name=name, sql=sql):
+                    self.assertFalse(bad, "\n".join([sql, *plan]))
+
+
+class SQLiteBackendTest(TestCase):
+    """Тесты бэкенда SQLite с WAL и прагмами"""
+    def test_pragmas(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        wrapper = DatabaseWrapper({
+            **connection.settings_dict,
+            "NAME": os.path.join(directory.name, "db.sqlite3"),
+            "OPTIONS": {"pragmas": {"busy_timeout": 1000}},
+        }, alias="wal_test")
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            pragmas = {}
+            for name in ("journal_mode", "synchronous", "busy_timeout",
+                         "foreign_keys"):
+                cursor.execute(f"PRAGMA {name}")
+                pragmas[name] = cursor.fetchone()[0]
+        self.assertEqual(pragmas, {"journal_mode": "wal", "synchronous": 1,
+                                   "busy_timeout": 1000, "foreign_keys": 1})
+        self.assertEqual(wrapper.transaction_mode, "IMMEDIATE")
+
+
+@override_settings(DATABASE_REPLICAS=["default"], REPLICA_CHECK_INTERVAL=0)
+class ReplicaRoutingTest(TestCase):
+    """Тесты чтения лент с реплик"""
+    def setUp(self):
+        cache.clear()
+        replicas._health.clear()
+        replicas.beat()
+        self.user = User.objects.create_user(username="sarah")
+        self.client.force_login(self.user)
+        self.choose = mock.patch.object(replicas, "choose",
+                                        wraps=replicas.choose)
+        self.addCleanup(self.choose.stop)
+        self.chosen = self.choose.start()
+
+    def test_feed_views_read_from_replica(self):
+        self.client.get(reverse("index"))
+        self.client.get(reverse("follow_index"))
+        self.assertEqual(self.chosen.call_count, 2)
+        self.client.get(reverse("new_post"))
+        self.client.get(reverse("search"))
+        self.assertEqual(self.chosen.call_count, 2)
+
+    def test_read_your_writes(self):
+        self.client.post(reverse("new_post"), {"text": "Новый пост"})
+        self.client.get(reverse("index"))
+        self.client.get(reverse("profile", args=[self.user.username]))
+        self.chosen.assert_not_called()
+        with mock.patch("time.time", return_value=time.time() + 3600):
+            self.client.get(reverse("index"))
+        self.chosen.assert_called_once()
+
+    def test_lagging_replica_skipped(self):
+        self.assertEqual(replicas.choose(), "default")
+        ReplicaHeartbeat.objects.update(
+            updated=timezone.now() - timedelta(minutes=5))
+        self.assertIsNone(replicas.choose())
+        with override_settings(REPLICA_CHECK_INTERVAL=60):
+            replicas.beat()
+            self.assertIsNone(replicas.choose())
+
+    def test_router(self):
+        router = replicas.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Post), "default")
+        replicas._local.alias = "replica1"
+        self.addCleanup(setattr, replicas._local, "alias", None)
+        # Внутри транзакции, как и весь TestCase, читаем с основной базы.
+        self.assertEqual(router.db_for_read(Post), "default")
+        with mock.patch.object(connection, "in_atomic_block", False):
+            self.assertEqual(router.db_for_read(Post), "replica1")
+            self.assertEqual(router.db_for_read(Session), "default")
+        self.assertEqual(router.db_for_write(Post), "default")
+        self.assertFalse(router.allow_migrate("replica1", "posts"))
+        # Без отметки реплики неизвестно, что из прочитанного свежее.
+        self.assertFalse(replicas.cacheable([1]))
+
+    def cache_writes(self, client, url):
+        """Ключи страниц и карточек, записанные в кэш при запросе url."""
+        with mock.patch.object(cache, "set", wraps=cache.set) as set_:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [args[0] for args, kwargs in set_.call_args_list
+                if args[0].startswith(("posts:page:", "posts:card:"))]
+
+    def test_pinned_session_bypasses_cache(self):
+        Post.objects.create(text="Пост", author=self.user)
+        # Первый запрос заводит версии, реплика синхронизируется после.
+        self.client.get(reverse("index"))
+        replicas.beat()
+        self.assertTrue(self.cache_writes(self.client, reverse("index")))
+        self.client.post(reverse("new_post"), {"text": "Новый пост"})
+        with mock.patch.object(cache, "get", wraps=cache.get) as get:
+            writes = self.cache_writes(self.client, reverse("index"))
+        self.assertEqual(writes, [])
+        self.assertFalse([args for args, kwargs in get.call_args_list
+                          if args[0].startswith("posts:page:")])
+        self.assertContains(self.client.get(reverse("index")),
+                            "Новый пост")
+
+    def test_stale_replica_render_is_not_cached(self):
+        """HTML с реплики старше версии ключа не кладётся в кэш"""
+        Post.objects.create(text="Пост", author=self.user)
+        ReplicaHeartbeat.objects.update(
+            updated=timezone.now() - timedelta(seconds=10))
+        caching.bump("index")
+        self.assertEqual(self.cache_writes(Client(), reverse("index")), [])
+        replicas.beat()
+        self.assertTrue(self.cache_writes(Client(), reverse("index")))
+
+
+@override_settings(DATABASE_REPLICAS=["replica_test"],
+                   REPLICA_CHECK_INTERVAL=0)
+class ReplicaSyncTest(TransactionTestCase):
+    """Тесты чтения ленты с копии, которую делает sync_replicas"""
+    databases = {"default", "replica_test"}
+
+    def setUp(self):
+        cache.clear()
+        replicas._health.clear()
+        self.user = User.objects.create_user(username="sarah")
+        Post.objects.create(text="Пост до копии", author=self.user)
+
+    def test_feed_reads_synced_replica(self):
+        call_command("sync_replicas", stdout=StringIO())
+        replica = connections["replica_test"]
+        with CaptureQueriesContext(replica) as queries:
+            response = self.client.get(reverse("index"))
+        self.assertContains(response, "Пост до копии")
+        self.assertTrue([query for query in queries
+                         if '"posts_post"' in query["sql"]])
+        # Пост после копии на реплику не попал: лента читается с неё.
+        Post.objects.create(text="Пост после копии", author=self.user)
+        with CaptureQueriesContext(replica) as queries:
+            response = self.client.get(reverse("index"))
+        self.assertNotContains(response, "Пост после копии")
+        self.assertTrue(queries)
+        call_command("sync_replicas", stdout=StringIO())
+        self.assertContains(self.client.get(reverse("index")),
+                            "Пост после копии")
+
+
+class ShardRouterTest(TestCase):
+    """Тесты выбора шарда и плана переноса авторов"""
+    databases = "__all__"
+
+    def setUp(self):
+        cache.clear()
+        self.router = sharding.ShardRouter()
+        self.author = User.objects.create_user(username="sarah")
+        self.reader = User.objects.create_user(username="reader")
+        AuthorShard.objects.filter(pk=self.reader.pk).delete()
+        AuthorShard.objects.update_or_create(pk=self.author.pk,
+                                             defaults={"shard": "shard1"})
+        cache.clear()
+        # Тесты только выбирают базу, схема шарда им не нужна.
+        shards = override_settings(DATABASE_SHARDS=["default", "shard1"])
+        shards.enable()
+        self.addCleanup(shards.disable)
+
+    def test_routes_by_author(self):
+        post = Post(author=self.author, text="Пост")
+        self.assertEqual(self.router.db_for_write(Post, instance=post),
+                         "shard1")
+        self.assertEqual(Post.objects.for_author(self.author.pk).db,
+                         "shard1")
+        self.assertEqual(self.router.db_for_read(Post, instance=self.author),
+                         "shard1")
+        comment = Comment(post=post, author=self.author)
+        self.assertEqual(self.router.db_for_write(Comment, instance=comment),
+                         "shard1")
+        # Комментарии автора разбросаны по шардам чужих постов.
+        self.assertIsNone(self.router.db_for_read(Comment,
+                                                  instance=self.author))
+        self.assertIsNone(self.router.db_for_read(Post))
+        self.assertIsNone(self.router.db_for_read(User, instance=post))
+        self.assertTrue(self.router.allow_migrate("shard1", "auth"))
+        self.assertIsNone(self.router.allow_migrate("default", "posts"))
+
+    def test_unassigned_author_lives_on_default(self):
+        self.assertEqual(sharding.shard_for(self.reader.pk), "default")
+        with self.assertNumQueries(0):
+            sharding.shard_for(self.reader.pk)
+
+    def test_post_ids_are_above_unsharded_posts(self):
+        with override_settings(DATABASE_SHARDS=["default"]):
+            post = Post.objects.create(author=self.author, text="Пост")
+            self.assertIsNone(sharding.next_post_id())
+        first = sharding.next_post_id()
+        self.assertGreater(first, post.pk)
+        self.assertEqual(sharding.next_post_id(), first + 1)
+
+    def test_plan_balances_posts(self):
+        loads = {"default": {1: 50, 2: 30, 3: 10, 4: 5}, "shard1": {},
+                 "shard2": {5: 20}}
+        moves = sharding.plan(loads)
+        totals = {alias: sum(authors.values())
+                  for alias, authors in loads.items()}
+        for author_id, source, target in moves:
+            totals[source] -= loads[source][author_id]
+            totals[target] += loads[source][author_id]
+        # Автор с 50 постами не делится, остальные раскладываются вокруг.
+        self.assertEqual(sorted(totals.values()), [30, 35, 50])
+        self.assertEqual(sharding.plan({"default": {1: 10}, "shard1": {}}),
+                         [])
+
+
+@override_settings(DATABASE_SHARDS=["default", "shard1"])
+class ShardingTest(TestCase):
+    """Тесты ленты и переноса авторов на настоящих шардах"""
+    databases = "__all__"
+
+    def setUp(self):
+        cache.clear()
+        self.other = sharding.shards()[1]
+        self.authors = [User.objects.create_user(username=f"author{i}")
+                        for i in range(4)]
+        for number, author in enumerate(self.authors):
+            sharding.place(author.pk, sharding.shards()[number % 2])
+            for i in range(6):
+                Post.objects.create(author=author, text=f"Пост {i}")
+
+    def test_posts_are_split_between_shards(self):
+        on_shards = [Post.objects.using(alias).count()
+                     for alias in sharding.shards()[:2]]
+        self.assertEqual(on_shards, [12, 12])
+        self.assertTrue(User.objects.using(self.other).filter(
+            username="author0").exists())
+
+    def test_feed_merges_shards(self):
+        expected = [post.pk for post in sorted(
+            [post for alias in sharding.shards()
+             for post in Post.objects.using(alias)],
+            key=lambda post: (post.pub_date, post.pk), reverse=True)]
+        seen, cursor = [], None
+        while True:
+            response = self.client.get(reverse("index"),
+                                       {"cursor": cursor} if cursor else {})
+            page = response.context["page"]
+            seen += [post.pk for post in page]
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, expected)
+
+    def test_post_page_and_comment(self):
+        author = self.authors[1]
+        post = Post.objects.for_author(author.pk).first()
+        self.assertEqual(post._state.db, self.other)
+        self.client.force_login(self.authors[0])
+        self.client.post(reverse("add_comment",
+                                 args=[author.username, post.pk]),
+                         {"text": "Комментарий"})
+        response = self.client.get(reverse("post",
+                                           args=[author.username, post.pk]))
+        self.assertContains(response, "Комментарий")
+        self.assertEqual(post.comments.count(), 1)
+
+    def test_move_author(self):
+        author = self.authors[1]
+        post = Post.objects.for_author(author.pk).first()
+        post.comments.create(author=self.authors[0], text="Комментарий")
+        sharding.move_author(author.pk, self.other, "default")
+        self.assertEqual(sharding.shard_for(author.pk), "default")
+        moved = Post.objects.for_author(author.pk).get(pk=post.pk)
+        self.assertEqual(moved._state.db, "default")
+        self.assertEqual(moved.pub_date, post.pub_date)
+        self.assertEqual(moved.comments.count(), 1)
+        self.assertFalse(Post.objects.using(self.other).filter(
+            author=author).exists())
+        self.assertEqual(list(sharding.strays()), [])
+
+    def test_dump_covers_shards(self):
+        author = self.authors[1]
+        post = Post.objects.for_author(author.pk).first()
+        post.comments.create(author=self.authors[0], text="Комментарий")
+        stream = StringIO()
+        counts = dumps.dump(stream)
+        self.assertEqual(counts["posts.post"], 24)
+        self.assertEqual(counts["posts.comment"], 1)
+        for alias in sharding.shards():
+            Post.objects.using(alias).all().delete()
+        stream.seek(0)
+        dumps.BulkLoader().load(stream)
+        dumps.rebuild_derived()
+        # Загруженные на основную базу посты вернулись на шарды авторов.
+        self.assertEqual([Post.objects.using(alias).count()
+                          for alias in sharding.shards()], [12, 12])
+        loaded = Post.objects.for_author(author.pk).get(pk=post.pk)
+        self.assertEqual(loaded._state.db, self.other)
+        self.assertEqual(loaded.comments.get().text, "Комментарий")
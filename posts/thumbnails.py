@@ -0,0 +1,221 @@
+"""Варианты картинок постов и их генерация в фоне.
+
+Картинка поста выводится кропом 960x339 в нескольких ширинах, в WebP и
+JPEG; браузер выбирает подходящий вариант по srcset/sizes. Ширины больше
+исходной не строятся: растянутая картинка весит больше, а чётче не
+становится.
+
+sorl-thumbnail создаёт миниатюру при первом рендере {% thumbnail %}, и
+за декодирование и кроп платит первый зритель поста. Здесь те же
+миниатюры строятся пулом потоков сразу после коммита транзакции с
+сохранённым постом; sorl находит готовую миниатюру в своём хранилище
+ключей и при рендере только подставляет её адрес. Если пул не успел,
+шаблон по-прежнему построит миниатюру сам.
+
+Готовые адреса вариантов и хэш файла сохраняются в PostImage, и лента
+с select_related("image_meta") рендерит картинку без sorl вовсе. Пока
+PostImage нет, картинка с именем по содержимому ссылается на варианты
+/img/<sha256>/... (posts/resizer.py): хэш есть в имени, и карточке не
+нужны запросы к хранилищу ключей sorl, по одному на вариант.
+"""
+import hashlib
+import json
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, SuspiciousOperation
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.urls import reverse
+from sorl.thumbnail import default, get_thumbnail
+from sorl.thumbnail.images import ImageFile
+
+from .models import ImageReference, Post, PostImage
+from .storage import content_digest, is_content_addressed
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (480, 720, 960)
+ASPECT_RATIO = 339 / 960
+FORMATS = (("WEBP", "image/webp"), ("JPEG", "image/jpeg"))
+EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg"}
+OPTIONS = {"crop": "center", "upscale": True, "quality": 80}
+SIZES = ("(min-width: 1200px) 1110px, (min-width: 992px) 930px, "
+         "(min-width: 768px) 690px, 100vw")
+
+Variant = namedtuple("Variant", ["width", "height", "geometry", "options"])
+Source = namedtuple("Source", ["type", "srcset"])
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.THUMBNAIL_WORKERS,
+            thread_name_prefix="thumbnails")
+    return _executor
+
+
+def widths(post):
+    """Ширины вариантов, не больше исходной (если она известна)."""
+    if not post.image_width:
+        return WIDTHS
+    return [w for w in WIDTHS if w <= post.image_width] or WIDTHS[:1]
+
+
+def variants(post, image_format):
+    for width in widths(post):
+        height = round(width * ASPECT_RATIO)
+        yield Variant(width, height, f"{width}x{height}",
+                      dict(OPTIONS, format=image_format))
+
+
+def dimensions(image):
+    """Размеры картинки или (None, None), если файл не читается."""
+    try:
+        return image.width, image.height
+    except (OSError, ValueError, SuspiciousOperation):
+        return None, None
+
+
+def file_hash(image):
+    digest = hashlib.sha256()
+    image.open("rb")
+    try:
+        for chunk in image.chunks():
+            digest.update(chunk)
+    finally:
+        image.close()
+    return digest.hexdigest()
+
+
+def stored_picture(post):
+    """Сохранённые варианты, если они построены для текущего файла."""
+    try:
+        meta = post.image_meta
+    except ObjectDoesNotExist:
+        return None
+    if meta.source != post.image.name:
+        return None
+    return json.loads(meta.picture)
+
+
+def picture(post):
+    """Источники <picture> и запасной JPEG для картинки поста.
+
+    Берёт готовые адреса из PostImage; пока их нет, ссылается на
+    варианты /img/<sha256>/..., а для старых имён файлов спрашивает
+    sorl и, как тег {% thumbnail %}, при ошибке не роняет страницу, а
+    возвращает пустой контекст и пишет в лог.
+    """
+    data = stored_picture(post)
+    digest = content_digest(post.image.name)
+    if data is None and digest is not None:
+        data = _picture(post, digest)
+    if data is None:
+        try:
+            data = _picture(post)
+        except Exception:
+            logger.exception("Не удалось получить варианты картинки "
+                             "поста %s", post.pk)
+            return {}
+    return dict(data, sources=[Source(*source) for source in data["sources"]],
+                sizes=SIZES)
+
+
+def variant_url(post, variant, digest=None):
+    """Адрес варианта: /img/<sha256>/... по хэшу или миниатюра sorl."""
+    if digest is None:
+        return get_thumbnail(post.image, variant.geometry,
+                             **variant.options).url
+    return reverse("resized_image", args=[
+        digest, variant.width, variant.height,
+        EXTENSIONS[variant.options["format"]]])
+
+
+def _picture(post, digest=None):
+    sources = []
+    for image_format, mime_type in FORMATS:
+        srcset = [(variant_url(post, variant, digest), variant)
+                  for variant in variants(post, image_format)]
+        sources.append([mime_type, ", ".join(
+            f"{url} {variant.width}w" for url, variant in srcset)])
+    fallback_url, fallback = srcset[-1]
+    return {"sources": sources, "src": fallback_url,
+            "width": fallback.width, "height": fallback.height}
+
+
+def generate(post_id, using=DEFAULT_DB_ALIAS):
+    """Строит варианты картинки поста и сохраняет их в PostImage.
+
+    using — шард поста. Ошибки только пишутся в лог.
+    """
+    try:
+        post = Post.objects.using(using).filter(pk=post_id).first()
+        if post is None or not post.image:
+            return
+        PostImage.objects.using(using).update_or_create(post=post, defaults={
+            "source": post.image.name,
+            "sha256": file_hash(post.image),
+            "picture": json.dumps(_picture(post)),
+        })
+    except Exception:
+        logger.exception("Не удалось построить миниатюры поста %s", post_id)
+
+
+def _generate_in_worker(post_id, using):
+    try:
+        generate(post_id, using)
+    finally:
+        # Соединения потока пула иначе останутся открытыми навсегда.
+        connection.close()
+        connections[using].close()
+
+
+def schedule(post):
+    """Ставит построение миниатюр в очередь после коммита транзакции."""
+    if not post.image:
+        return
+    post_id, using = post.pk, post._state.db
+    # Базу SQLite в памяти потоки делят через shared cache, где пишущие
+    # блокируют друг друга без ожидания, поэтому с ней работаем в потоке
+    # запроса.
+    in_memory = (connection.vendor == "sqlite"
+                 and connection.is_in_memory_db())
+    if settings.THUMBNAIL_WORKERS and not in_memory:
+        transaction.on_commit(
+            lambda: executor().submit(_generate_in_worker, post_id, using))
+    else:
+        transaction.on_commit(lambda: generate(post_id, using))
+
+
+def release(name):
+    """Удаляет файл картинки и его миниатюры, если он больше не нужен.
+
+    Файлы с именем по содержимому делят между собой несколько постов,
+    поэтому удаляется только файл, счётчик ссылок которого дошёл до
+    нуля. Проверка и удаление идут в транзакции основной базы: пост с
+    той же картинкой (Post.save) ждёт её блокировку записи и после неё
+    сохраняет файл заново.
+    """
+    if not is_content_addressed(name):
+        return
+    storage = Post._meta.get_field("image").storage
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        unused = ImageReference.objects.filter(pk=name, references=0)
+        if not unused.exists():
+            return
+        unused.delete()
+        try:
+            default.kvstore.delete(ImageFile(name, storage))
+            storage.delete(name)
+        except Exception:
+            logger.exception("Не удалось удалить картинку %s", name)
+
+
+def schedule_release(name):
+    if is_content_addressed(name):
+        transaction.on_commit(lambda: release(name))
@@ -0,0 +1,235 @@
+"""Лента подписок: гибрид push- и pull-модели.
+
+Посты обычных авторов раскладываются в TimelineEntry подписчиков при
+публикации (push). Авторы с флагом UserStats.pulled в ленты не
+раскладываются: их свежие посты читаются при открытии ленты и сливаются
+с push-частью (pull).
+
+Флаг ставится при подписке, когда подписчиков стало не меньше
+settings.FEED_PULL_THRESHOLD (followers_changed), — это один UPDATE.
+Снимается он только в settle(), вне запросов, и только когда
+подписчиков меньше settings.FEED_PUSH_THRESHOLD: автор у порога,
+которого подписывают и отписывают, не раскладывается заново на каждую
+отписку. Разложенные раньше посты pull-автора остаются в лентах до
+settle(); дубликаты отсекаются при слиянии.
+"""
+import heapq
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import sharding
+from .models import Follow, Post, TimelineEntry, UserStats
+from .paginator import keyset_filter, order_by
+
+BATCH_SIZE = 500
+
+FeedItem = namedtuple("FeedItem", ["pub_date", "post_id"])
+
+
+def _insert(entries):
+    TimelineEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE,
+                                      ignore_conflicts=True)
+
+
+def is_pulled(author_id):
+    return UserStats.objects.filter(pk=author_id, pulled=True).exists()
+
+
+def fan_out(post):
+    """Раскладывает новый пост в ленты подписчиков автора."""
+    if is_pulled(post.author_id):
+        return
+    followers = (Follow.objects.filter(author=post.author_id)
+                 .values_list("user", flat=True))
+    _insert([TimelineEntry(user_id=user_id, post_id=post.pk,
+                           author_id=post.author_id, pub_date=post.pub_date)
+             for user_id in followers.iterator() if user_id is not None])
+
+
+def _push(author_id, user_ids):
+    posts = (Post.objects.for_author(author_id).order_by()
+             .values_list("pk", "pub_date"))
+    batch = []
+    for post_id, pub_date in posts.iterator():
+        batch.extend(TimelineEntry(user_id=user_id, post_id=post_id,
+                                   author_id=author_id, pub_date=pub_date)
+                     for user_id in user_ids)
+        if len(batch) >= BATCH_SIZE:
+            _insert(batch)
+            batch = []
+    _insert(batch)
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту пользователя уже опубликованные посты автора."""
+    if not is_pulled(author_id):
+        _push(author_id, [user_id])
+
+
+def followers_changed(author_id):
+    """Переводит автора на pull, если подписчиков стало не меньше порога.
+
+    Вызывается при подписке после сдвига followers_count.
+    """
+    UserStats.objects.filter(
+        pk=author_id, pulled=False,
+        followers_count__gte=settings.FEED_PULL_THRESHOLD,
+    ).update(pulled=True)
+
+
+def settle():
+    """Доводит переводы между push и pull, отложенные из запросов.
+
+    Авторы с подписчиками меньше FEED_PUSH_THRESHOLD раскладываются
+    всем подписчикам и возвращаются на push, а разложенные посты
+    pull-авторов убираются из лент. Возвращает число авторов,
+    вернувшихся на push.
+    """
+    UserStats.objects.filter(
+        pulled=False, followers_count__gte=settings.FEED_PULL_THRESHOLD,
+    ).update(pulled=True)
+    pushed = (UserStats.objects.filter(
+        pulled=True, followers_count__lt=settings.FEED_PUSH_THRESHOLD)
+        .values_list("pk", flat=True))
+    count = 0
+    for author_id in list(pushed):
+        # Флаг снимается в одной транзакции с раскладкой: пост, который
+        # автор опубликует в это время, дождётся её и разложится сам.
+        with transaction.atomic():
+            followers = (Follow.objects.filter(author=author_id)
+                         .exclude(user=None).values_list("user", flat=True))
+            _push(author_id, list(followers))
+            UserStats.objects.filter(pk=author_id).update(pulled=False)
+        count += 1
+    TimelineEntry.objects.filter(author__in=UserStats.objects.filter(
+        pulled=True).values("pk")).delete()
+    return count
+
+
+def prune(user_id, author_id):
+    """Убирает из ленты пользователя посты автора после отписки."""
+    TimelineEntry.objects.filter(user=user_id, author=author_id).delete()
+
+
+def remove_post(post_id):
+    TimelineEntry.objects.filter(post=post_id).delete()
+
+
+def rebuild():
+    """Заново раскладывает все ленты одним INSERT … SELECT.
+
+    Поштучный backfill() стоит запрос на подписку, что на больших
+    наборах данных (stream_load, generate_dataset) занимает часы.
+    """
+    TimelineEntry.objects.all().delete()
+    # Лента собирается заново целиком, так что отложенные переводы
+    # между push и pull применяются сразу.
+    UserStats.objects.filter(
+        followers_count__gte=settings.FEED_PULL_THRESHOLD,
+    ).update(pulled=True)
+    UserStats.objects.filter(
+        followers_count__lt=settings.FEED_PUSH_THRESHOLD,
+    ).update(pulled=False)
+    if sharding.enabled():
+        _rebuild_sharded()
+        return
+    entries = TimelineEntry._meta.db_table
+    follows = Follow._meta.db_table
+    posts = Post._meta.db_table
+    stats = UserStats._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {entries} (user_id, post_id, author_id, pub_date) "
+            f"SELECT DISTINCT f.user_id, p.id, p.author_id, p.pub_date "
+            f"FROM {follows} f JOIN {posts} p ON p.author_id = f.author_id "
+            f"LEFT JOIN {stats} s ON s.user_id = f.author_id "
+            f"WHERE f.user_id IS NOT NULL "
+            f"AND COALESCE(s.pulled, %s) = %s", [False, False])
+
+
+def _rebuild_sharded():
+    """rebuild() для шардов.
+
+    Посты и подписки лежат в разных базах, поэтому подписчики
+    собираются в память, а посты каждого шарда читаются одним проходом.
+    """
+    pulled = set(UserStats.objects.filter(pulled=True)
+                 .values_list("pk", flat=True))
+    followers = defaultdict(set)
+    follows = (Follow.objects.exclude(user=None).exclude(author=None)
+               .values_list("user", "author"))
+    for user_id, author_id in follows.iterator():
+        if author_id not in pulled:
+            followers[author_id].add(user_id)
+    batch = []
+    for alias in sharding.shards():
+        posts = (Post.objects.using(alias).order_by()
+                 .values_list("pk", "author", "pub_date"))
+        for post_id, author_id, pub_date in posts.iterator():
+            for user_id in followers.get(author_id, ()):
+                batch.append(TimelineEntry(
+                    user_id=user_id, post_id=post_id, author_id=author_id,
+                    pub_date=pub_date))
+            if len(batch) >= BATCH_SIZE:
+                _insert(batch)
+                batch = []
+    _insert(batch)
+
+
+def load_posts(items):
+    """Превращает страницу ленты в посты для post_card.html."""
+    ids = [item.post_id for item in items]
+    posts = sharding.in_bulk(Post.objects.for_feed(), ids)
+    return [posts[pk] for pk in ids if pk in posts]
+
+
+class FollowFeed:
+    """Источник для CursorPaginator: push-лента плюс pull-авторы.
+
+    Каждая часть отдаёт не больше limit ключей (pub_date, post_id) после
+    курсора, уже отсортированных по индексу; части сливаются k-way
+    merge'ем, так что страница стоит 1 + k коротких диапазонных
+    запросов, где k — число популярных авторов в подписках. Запросы
+    выполняются параллельно, каждый на шарде своего автора.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    def pulled_authors(self):
+        following = Follow.objects.filter(user=self.user).values("author")
+        return list(UserStats.objects.filter(
+            pk__in=following, pulled=True).values_list("pk", flat=True))
+
+    def _stream(self, queryset, fields, values, backwards, limit):
+        if values is not None:
+            queryset = queryset.filter(
+                keyset_filter(fields, values, backwards))
+        return queryset.order_by(*order_by(fields, backwards))[:limit]
+
+    def fetch(self, fields, values, backwards, limit):
+        entry_fields = [("pub_date", fields[0][1]), ("post_id", fields[1][1])]
+        post_fields = [("pub_date", fields[0][1]), ("id", fields[1][1])]
+        queries = [self._stream(
+            TimelineEntry.objects.filter(user=self.user)
+            .values_list("pub_date", "post_id"),
+            entry_fields, values, backwards, limit)]
+        for author_id in self.pulled_authors():
+            queries.append(self._stream(
+                Post.objects.for_author(author_id)
+                .values_list("pub_date", "id"),
+                post_fields, values, backwards, limit))
+        streams = [[FeedItem(*row) for row in rows]
+                   for rows in sharding.evaluate(queries)]
+
+        descending = fields[0][1] != backwards
+        items = []
+        for item in heapq.merge(*streams, reverse=descending):
+            if items and items[-1] == item:
+                continue
+            items.append(item)
+            if len(items) == limit:
+                break
+        return items
@@ -1,12 +1,30 @@
-from django.urls import path
+from django.urls import path, register_converter
 
 from . import views
 
+
+class Sha256Converter:
+    regex = "[0-9a-f]{64}"
+
+    def to_python(self, value):
+        return value
+
+    def to_url(self, value):
+        return value
+
+
+register_converter(Sha256Converter, "sha256")
+
 urlpatterns = [
     path("", views.index, name="index"),
     path("group/<slug:slug>/", views.group_posts, name="groups"),
     path("new/", views.new_post, name="new_post"),
     path("follow/", views.follow_index, name="follow_index"),
+    path("search/", views.search_posts, name="search"),
+    path("img/<sha256:digest>/<int:width>x<int:height>/",
+         views.resized_image, name="resized_image"),
+    path("img/<sha256:digest>/<int:width>x<int:height>.<str:extension>",
+         views.resized_image, name="resized_image"),
     path("<str:username>/follow/", views.profile_follow,
          name="profile_follow"),
     path("<str:username>/unfollow/", views.profile_unfollow,
@@ -18,3 +36,21 @@ urlpatterns = [
     path("<username>/<int:post_id>/comment", views.add_comment,
          name="add_comment"),
 ]
+
+# Сколько SQL-запросов может сделать страница при холодном кэше, включая
+# чтение сессии и пользователя. Число не должно зависеть от объёма данных;
+# проверяется QueryBudgetTest на наборах разного размера.
+QUERY_BUDGETS = {
+    "index": 3,
+    "groups": 4,
+    "new_post": 5,
+    "follow_index": 5,
+    "search": 4,
+    "resized_image": 2,
+    "profile_follow": 6,
+    "profile_unfollow": 12,
+    "profile": 5,
+    "post": 6,
+    "post_edit": 5,
+    "add_comment": 3,
+}
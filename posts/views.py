@@ -1,28 +1,35 @@
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
+from django.db import transaction
+from django.http import FileResponse, Http404
 from django.shortcuts import get_object_or_404, redirect, render
-from django.views.decorators.cache import cache_page
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
+from . import resizer, search, sharding, timeline
+from .caching import cache_feed
 from .forms import CommentForm, PostForm
-from .models import Comment, Follow, Group, Post, User
+from .models import Follow, Group, Post, User, UserStats
+from .paginator import CursorPaginator
+from .replicas import replica_reads
 
 
-@cache_page(20)
+@replica_reads
+@cache_feed("index", "groups")
 def index(request):
-    post_list = Post.objects.all()
-    paginator = Paginator(post_list, 10)
-    page_number = request.GET.get("page")
-    page = paginator.get_page(page_number)
+    post_list = sharding.feed(Post.objects.for_feed())
+    paginator = CursorPaginator(post_list, 10)
+    page = paginator.get_page(request.GET.get("cursor"))
     return render(request, "index.html", {"page": page,
                                           "paginator": paginator})
 
 
+@replica_reads
+@cache_feed("group:{slug}", "groups")
 def group_posts(request, slug):
     group = get_object_or_404(Group, slug=slug)
-    post_list = group.posts.all()
-    paginator = Paginator(post_list, 10)
-    page_number = request.GET.get("page")
-    page = paginator.get_page(page_number)
+    post_list = sharding.feed(group.posts.for_feed())
+    paginator = CursorPaginator(post_list, 10)
+    page = paginator.get_page(request.GET.get("cursor"))
     return render(request, "group.html", {"group": group, "page": page,
                                           "paginator": paginator})
 
@@ -33,70 +40,69 @@ def new_post(request):
     if form.is_valid():
         post = form.save(commit=False)
         post.author = request.user
-        post.save()
+        with transaction.atomic():
+            post.save()
         return redirect("index")
     return render(request, "new.html", {"form": form})
 
 
+@replica_reads
+@cache_feed("profile:{username}", "groups")
 def profile(request, username):
-    author = get_object_or_404(User, username=username)
-    posts = author.posts.all()
-    paginator = Paginator(posts, 10)
-    page_num = request.GET.get("page")
-    page = paginator.get_page(page_num)
-    posts_count = posts.count()
-    following_count = author.following.count()
-    follower_count = author.follower.count()
-    following = False
-    if request.user.is_authenticated:
-        following = Follow.objects.filter(user=request.user,
-                                          author=author).exists()
+    author = get_object_or_404(User.objects.select_related("stats"),
+                               username=username)
+    posts = author.posts.for_feed()
+    paginator = CursorPaginator(posts, 10)
+    page = paginator.get_page(request.GET.get("cursor"))
+    stats = UserStats.objects.for_user(author)
     return render(request, "profile.html", {"author": author,
                                             "page": page,
-                                            "following": following,
                                             "paginator": paginator,
-                                            "posts_count": posts_count,
-                                            "following_count": following_count,
-                                            "follower_count": follower_count,
+                                            "stats": stats,
                                             })
 
 
+@replica_reads
 def post_view(request, username, post_id):
-    user = get_object_or_404(User, username=username)
-    post = get_object_or_404(Post, id=post_id, author__username=username)
+    user = get_object_or_404(User.objects.select_related("stats"),
+                             username=username)
+    post = get_object_or_404(user.posts.for_feed(), id=post_id)
     form = CommentForm()
-    comments = Comment.objects.filter(post=post_id)
-    following_count = user.following.count()
-    follower_count = user.follower.count()
-    posts_count = Post.objects.filter(author=user).count()
-    following = False
-    if request.user.is_authenticated:
-        following = Follow.objects.filter(user=request.user,
-                                          author=user).exists()
+    comments = post.comments.select_related("author")
+    stats = UserStats.objects.for_user(user)
     return render(request, "post.html", {"post": post,
                                          "author": post.author,
                                          "form": form,
                                          "comments": comments,
-                                         "following_count": following_count,
-                                         "follower_count": follower_count,
-                                         "posts_count": posts_count,
-                                         "following": following, })
+                                         "stats": stats, })
 
 
 @login_required
 def post_edit(request, username, post_id):
-    post = get_object_or_404(Post, id=post_id, author__username=username)
+    post = get_author_post(username, post_id)
     if request.user != post.author:
         return redirect("post", username=username, post_id=post_id)
     form = PostForm(request.POST or None, files=request.FILES or None,
                     instance=post)
     if form.is_valid():
-        form.save()
+        with transaction.atomic():
+            form.save()
         return redirect("post", username=username, post_id=post_id)
     return render(request, "new.html", {"form": form, "post": post,
                                         "is_edit": True})
 
 
+def get_author_post(username, post_id):
+    """Пост по адресу /<username>/<post_id>/ или 404.
+
+    С шардами сначала нужен автор: по нему выбирается шард поста.
+    """
+    if not sharding.enabled():
+        return get_object_or_404(Post, id=post_id, author__username=username)
+    author = get_object_or_404(User, username=username)
+    return get_object_or_404(author.posts, id=post_id)
+
+
 def page_not_found(request, exception):
     return render(request, "misc/404.html", {"path": request.path},
                   status=404)
@@ -108,26 +114,36 @@ def server_error(request):
 
 @login_required
 def add_comment(request, username, post_id):
-    post = get_object_or_404(Post, id=post_id, author__username=username)
+    post = get_author_post(username, post_id)
     form = CommentForm(request.POST or None)
     if form.is_valid():
         comment = form.save(commit=False)
         comment.author = request.user
         comment.post = post
-        comment.save()
+        with transaction.atomic():
+            comment.save()
         return redirect("post", username, post_id)
     return redirect("post", username, post_id)
 
 
+def search_posts(request):
+    query = request.GET.get("q", "").strip()
+    paginator = CursorPaginator(search.SearchResults(query), 10,
+                                ordering=("rank", "-id"),
+                                transform=search.load_posts)
+    page = paginator.get_page(request.GET.get("cursor"))
+    return render(request, "search.html", {"query": query, "page": page,
+                                           "paginator": paginator})
+
+
+@replica_reads
 @login_required
 def follow_index(request):
-    posts = (
-        Post.objects.select_related("author").
-        filter(author__following__user=request.user)
-    )
-    paginator = Paginator(posts, 10)
-    page_number = request.GET.get("page")
-    page = paginator.get_page(page_number)
+    feed = timeline.FollowFeed(request.user)
+    paginator = CursorPaginator(feed, 10,
+                                ordering=("-pub_date", "-post_id"),
+                                transform=timeline.load_posts)
+    page = paginator.get_page(request.GET.get("cursor"))
     return render(request, "follow.html", {"page": page,
                                            "paginator": paginator})
 
@@ -136,14 +152,40 @@ def follow_index(request):
 def profile_follow(request, username):
     author = get_object_or_404(User, username=username)
     if not request.user == author:
-        Follow.objects.get_or_create(user=request.user, author=author)
+        with transaction.atomic():
+            Follow.objects.get_or_create(user=request.user, author=author)
     return redirect("profile", username=username)
 
 
 @login_required
 def profile_unfollow(request, username):
     author = get_object_or_404(User, username=username)
-    following = Follow.objects.filter(user=request.user, author=author)
-    if following.exists():
-        following.delete()
+    with transaction.atomic():
+        following = Follow.objects.filter(user=request.user, author=author)
+        if following.exists():
+            following.delete()
     return redirect("follow_index")
+
+
+def resized_image_etag(request, path, digest, width, height, extension):
+    # Адрес однозначно задаёт содержимое, так что он и есть ETag.
+    return f"{digest}-{width}x{height}.{extension}"
+
+
+@cache_control(public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+def resized_image(request, digest, width, height, extension="jpg"):
+    # Проверки идут до условного запроса: на адрес без варианта
+    # отвечаем 404, даже если ETag совпал.
+    if (extension not in resizer.FORMATS
+            or (width, height) not in resizer.allowed_sizes()):
+        raise Http404
+    path = resizer.get(digest, width, height, extension)
+    if path is None:
+        raise Http404
+    return serve_resized(request, path, digest, width, height, extension)
+
+
+@condition(etag_func=resized_image_etag)
+def serve_resized(request, path, digest, width, height, extension):
+    return FileResponse(open(path, "rb"),
+                        content_type=resizer.FORMATS[extension][1])
@@ -0,0 +1,210 @@
+"""Кэш в файле SQLite, общий для всех процессов на одной машине.
+
+LocMemCache держит отдельную копию в каждом WSGI-процессе: с ростом
+числа процессов падает доля попаданий, а сброс версий страниц
+(posts/caching.py) не доходит до соседей. Этот бэкенд хранит записи в
+одном файле SQLite в режиме WAL, так что читатели не блокируют друг
+друга, и не требует внешнего сервиса.
+
+Целые числа хранятся как INTEGER, поэтому incr() выполняется одним
+UPDATE без гонок между процессами. Остальные значения сериализуются
+pickle. При превышении MAX_ENTRIES вытесняются давно не читанные записи
+(приблизительный LRU: время доступа обновляется не чаще раза в
+ACCESS_RESOLUTION секунд, чтобы чтение не превращалось в запись).
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+"""
+
+# Ограничение SQLite на число параметров в одном запросе.
+CHUNK_SIZE = 500
+
+# Функции observer(hits, misses), которые вызываются после каждого
+# чтения; через них считаются попадания в кэш (posts/metrics.py).
+LOOKUP_OBSERVERS = []
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._path = location
+        self._access_resolution = float(options.get("ACCESS_RESOLUTION", 10))
+        self._cull_check_every = int(options.get("CULL_CHECK_EVERY", 100))
+        self._busy_timeout = float(options.get("BUSY_TIMEOUT", 30))
+        self._local = threading.local()
+        self._writes = 0
+
+    @property
+    def _db(self):
+        # Соединение своё у каждого потока и у каждого процесса после fork.
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self._path, timeout=self._busy_timeout,
+                                 isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._local.db, self._local.pid = db, pid
+        return self._local.db
+
+    @staticmethod
+    def _dump(value):
+        if type(value) is int:
+            return value
+        return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _load(value):
+        if isinstance(value, int):
+            return value
+        return pickle.loads(value)
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _touch_rows(self, rows, now):
+        stale = [(now, key) for key, _, _, accessed in rows
+                 if accessed < now - self._access_resolution]
+        if stale:
+            self._db.executemany(
+                "UPDATE cache SET accessed = ? WHERE key = ?", stale)
+
+    def _select(self, keys, now):
+        found = {}
+        for start in range(0, len(keys), CHUNK_SIZE):
+            chunk = keys[start:start + CHUNK_SIZE]
+            marks = ",".join("?" * len(chunk))
+            rows = self._db.execute(
+                "SELECT key, value, expires, accessed FROM cache "
+                f"WHERE key IN ({marks}) AND "
+                "(expires IS NULL OR expires > ?)", (*chunk, now)).fetchall()
+            self._touch_rows(rows, now)
+            found.update((row[0], self._load(row[1])) for row in rows)
+        for observer in LOOKUP_OBSERVERS:
+            observer(len(found), len(keys) - len(found))
+        return found
+
+    def get(self, key, default=None, version=None):
+        key = self._key(key, version)
+        return self._select([key], time.time()).get(key, default)
+
+    def get_many(self, keys, version=None):
+        keymap = {self._key(key, version): key for key in keys}
+        found = self._select(list(keymap), time.time())
+        return {keymap[key]: value for key, value in found.items()}
+
+    def has_key(self, key, version=None):
+        key = self._key(key, version)
+        row = self._db.execute(
+            "SELECT 1 FROM cache WHERE key = ? AND "
+            "(expires IS NULL OR expires > ?)", (key, time.time())).fetchone()
+        return row is not None
+
+    def _write(self, rows):
+        db = self._db
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires, accessed) "
+                "VALUES (?, ?, ?, ?)", rows)
+        self._writes += len(rows)
+        if self._writes >= self._cull_check_every:
+            self._writes = 0
+            self._cull()
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        self._write([(key, self._dump(value),
+                      self.get_backend_timeout(timeout), time.time())])
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires, now = self.get_backend_timeout(timeout), time.time()
+        self._write([(self._key(key, version), self._dump(value), expires,
+                      now) for key, value in data.items()])
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO cache (key, value, expires, accessed) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+            "value = excluded.value, expires = excluded.expires, "
+            "accessed = excluded.accessed "
+            "WHERE cache.expires IS NOT NULL AND cache.expires <= ?",
+            (key, self._dump(value), self.get_backend_timeout(timeout), now,
+             now))
+        return cursor.rowcount > 0
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        cursor = self._db.execute(
+            "UPDATE cache SET expires = ?, accessed = ? WHERE key = ? AND "
+            "(expires IS NULL OR expires > ?)",
+            (self.get_backend_timeout(timeout), now, key, now))
+        return cursor.rowcount > 0
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        db = self._db
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "UPDATE cache SET value = value + ?, accessed = ? "
+                "WHERE key = ? AND typeof(value) = 'integer' AND "
+                "(expires IS NULL OR expires > ?) RETURNING value",
+                (delta, time.time(), key, time.time())).fetchone()
+        if row is None:
+            raise ValueError(f"Key '{key}' not found")
+        return row[0]
+
+    def delete(self, key, version=None):
+        key = self._key(key, version)
+        self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def delete_many(self, keys, version=None):
+        keys = [(self._key(key, version),) for key in keys]
+        with self._db as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("DELETE FROM cache WHERE key = ?", keys)
+
+    def clear(self):
+        self._db.execute("DELETE FROM cache")
+
+    def _cull(self):
+        db = self._db
+        db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        count = db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self._max_entries:
+            excess = count - self._max_entries
+            if self._cull_frequency:
+                excess += self._max_entries // self._cull_frequency
+            db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                "ORDER BY accessed LIMIT ?)", (excess,))
+
+    def close(self, **kwargs):
+        # Соединения живут всё время работы потока: открывать файл и
+        # выполнять PRAGMA на каждый запрос дороже, чем держать их.
+        pass
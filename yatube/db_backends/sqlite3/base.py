@@ -0,0 +1,43 @@
+"""SQLite с настройками для сайта под нагрузкой.
+
+Стандартный бэкенд открывает файл в режиме журнала DELETE: пишущий
+new_post или add_comment блокирует всех читателей до коммита. Здесь
+каждое соединение переводится в WAL, где читатели работают со снимком
+и не ждут писателя, и получает прагмы из DEFAULT_PRAGMAS (их можно
+переопределить в OPTIONS["pragmas"]).
+
+Транзакции открываются BEGIN IMMEDIATE: в WAL отложенная транзакция,
+которая сначала читает, а потом пишет, получает «database is locked»
+сразу, без ожидания busy_timeout, если другой писатель успел
+закоммитить. IMMEDIATE берёт блокировку записи в начале транзакции и
+ждёт её по busy_timeout. Режим меняется через OPTIONS["transaction_mode"].
+"""
+from django.db.backends.sqlite3 import base
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    # В WAL данные теряются только при падении ОС, не процесса, а
+    # fsync на каждом коммите исчезает.
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pragmas = {**DEFAULT_PRAGMAS, **params.pop("pragmas", {})}
+        self.transaction_mode = params.pop("transaction_mode", "IMMEDIATE")
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f"BEGIN {self.transaction_mode}")
@@ -10,11 +10,18 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
+import atexit
 import os
+import shutil
+import sys
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# manage.py test или pytest: тестам нужны свои файлы вместо рабочих.
+TESTING = sys.argv[1:2] == ['test'] or 'pytest' in sys.modules
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
@@ -53,11 +60,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'posts.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'posts.profiling.ProfilingMiddleware',
+    'posts.replicas.ReplicaMiddleware',
+    'posts.middleware.PageCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -68,7 +79,7 @@ ROOT_URLCONF = 'yatube.urls'
 TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'posts.metrics.TimedTemplates',
         'DIRS': [TEMPLATES_DIR],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -89,13 +100,75 @@ WSGI_APPLICATION = 'yatube.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# Бэкенд с WAL и прагмами для конкурентной нагрузки
+# (yatube/db_backends/sqlite3/base.py). Соединение живёт между запросами
+# потока: открытие файла и прагмы не повторяются на каждом запросе.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'yatube.db_backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 600,
     }
 }
 
+# Реплики для чтения лент (posts/replicas.py). Локально их изображают
+# копии db.sqlite3, которые обновляет sync_replicas:
+# YATUBE_REPLICAS=2 python manage.py sync_replicas --interval 5
+for _number in range(1, int(os.environ.get('YATUBE_REPLICAS', 0)) + 1):
+    DATABASES[f'replica{_number}'] = {
+        **DATABASES['default'],
+        'NAME': os.path.join(BASE_DIR, f'db-replica{_number}.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES
+                     if alias.startswith('replica')]
+# Реплика, отставшая больше REPLICA_MAX_LAG секунд, не используется;
+# после записи сессия REPLICA_PIN_SECONDS читает с основной базы.
+REPLICA_MAX_LAG = 30
+REPLICA_CHECK_INTERVAL = 5
+REPLICA_PIN_SECONDS = 30
+
+# Шарды постов и комментариев по автору (posts/sharding.py). Основная
+# база — нулевой шард; YATUBE_SHARDS=N добавляет db-shard1.sqlite3 и
+# следующие. Новому шарду нужны схема, копии пользователей и групп и
+# его доля авторов:
+# YATUBE_SHARDS=2 python manage.py migrate --database shard1
+# YATUBE_SHARDS=2 python manage.py rebalance_shards
+# Тесты шардов в YATUBE_SHARDS не нуждаются: их шард добавлен ниже.
+_shards = 1 if TESTING else int(os.environ.get('YATUBE_SHARDS', 1))
+for _number in range(1, _shards):
+    DATABASES[f'shard{_number}'] = {
+        **DATABASES['default'],
+        'NAME': os.path.join(BASE_DIR, f'db-shard{_number}.sqlite3'),
+    }
+DATABASE_SHARDS = ['default'] + [alias for alias in DATABASES
+                                 if alias.startswith('shard')]
+DATABASE_ROUTERS = ['posts.sharding.ShardRouter',
+                    'posts.replicas.ReplicaRouter']
+# Потоки, опрашивающие шарды параллельно; 0 — по очереди в потоке
+# запроса.
+SHARD_WORKERS = 4
+
+# Тестовые файлы (кэш, реплика) живут во временном каталоге, а не рядом
+# с базой разработчика.
+if TESTING:
+    _test_dir = tempfile.mkdtemp(prefix='yatube-test-')
+    atexit.register(shutil.rmtree, _test_dir, ignore_errors=True)
+    # Реплика для тестов sync_replicas: файл, в который копируется
+    # тестовая основная база. В DATABASE_REPLICAS она не входит, тесты
+    # включают её через override_settings.
+    DATABASES['replica_test'] = {
+        **DATABASES['default'],
+        'TEST': {'NAME': os.path.join(_test_dir, 'replica.sqlite3')},
+    }
+    # Шард для тестов шардирования; тоже включается через
+    # override_settings, а схему на нём создаёт TestRunner.
+    DATABASES['shard1'] = {
+        **DATABASES['default'],
+        'NAME': os.path.join(_test_dir, 'shard1.sqlite3'),
+    }
+TEST_RUNNER = 'yatube.test_runner.TestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -150,12 +223,69 @@ EMAIL_FILE_PATH = os.path.join(BASE_DIR, "sent_emails")
 
 SITE_ID = 4
 
+# Общий для всех WSGI-процессов кэш в файле SQLite (yatube/cache_backends.py).
+# Тесты чистят кэш, поэтому пишут во временный файл, а не в кэш
+# разработчика.
+if TESTING:
+    _cache_path = os.path.join(_test_dir, 'cache.sqlite3')
+else:
+    _cache_path = os.path.join(BASE_DIR, 'cache.sqlite3')
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'yatube.cache_backends.SQLiteCache',
+        'LOCATION': os.environ.get('YATUBE_CACHE_PATH', _cache_path),
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
     }
 }
 
+# Страницы ленты (posts/middleware.py) сбрасываются сигналами при
+# изменении данных (posts/caching.py), поэтому срок жизни может быть долгим.
+FEED_CACHE_TIMEOUT = 60 * 60
+
 INTERNAL_IPS = [
     "127.0.0.1",
 ]
+
+# Авторы, у которых подписчиков не меньше порога, не раскладываются
+# по лентам подписчиков при публикации, а подмешиваются при чтении.
+# Обратно к раскладке автор возвращается, только когда подписчиков
+# стало меньше FEED_PUSH_THRESHOLD, и не в запросе, а в
+# rebuild_timelines --settle.
+FEED_PULL_THRESHOLD = 1000
+FEED_PUSH_THRESHOLD = 900
+
+# Потоки, которые строят миниатюры после сохранения поста
+# (posts/thumbnails.py); 0 — строить сразу после коммита в том же потоке.
+THUMBNAIL_WORKERS = 2
+
+# Дисковый кэш вариантов картинок для /img/<sha256>/<w>x<h>/
+# (posts/resizer.py). Кроме размеров для srcset разрешены только
+# перечисленные здесь.
+IMAGE_CACHE_DIR = os.path.join(BASE_DIR, 'media', 'resized')
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+IMAGE_RESIZE_SIZES = [
+    (150, 150),
+]
+
+# Метрики запросов (posts/metrics.py): заголовок Server-Timing в ответах и
+# /metrics для Prometheus. /metrics открыт только с этих адресов и только
+# сотрудникам или с токеном (bearer_token в scrape_config Prometheus);
+# без YATUBE_METRICS_TOKEN — только сотрудникам.
+METRICS_SERVER_TIMING = True
+METRICS_ALLOWED_IPS = [
+    "127.0.0.1",
+    "::1",
+]
+METRICS_TOKEN = os.environ.get('YATUBE_METRICS_TOKEN', '')
+
+# Профили отдельных запросов (posts/profiling.py): по токену из команды
+# profile_token или один запрос из PROFILING_SAMPLE_RATE (0 — выборка
+# выключена). Хранятся последние PROFILING_KEEP профилей.
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILING_SAMPLE_RATE = 0
+PROFILING_INTERVAL = 0.005
+PROFILING_TOKEN_MAX_AGE = 24 * 60 * 60
+PROFILING_KEEP = 200
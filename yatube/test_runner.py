@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """Создаёт тестовые базы со схемой на тестовом шарде.
+
+    Шард shard1 из тестовых настроек включается только в тестах
+    шардирования (override_settings), а роутер накатывает схему лишь на
+    базы из DATABASE_SHARDS, поэтому на время создания баз шард включён.
+    """
+
+    def setup_databases(self, **kwargs):
+        shards = ["default"] + [alias for alias in settings.DATABASES
+                                if alias.startswith("shard")]
+        with override_settings(DATABASE_SHARDS=shards):
+            return super().setup_databases(**kwargs)
@@ -5,6 +5,8 @@ from django.contrib import admin
 from django.contrib.flatpages import views
 from django.urls import include, path
 
+from posts import metrics
+
 handler404 = "posts.views.page_not_found" # noqa
 handler500 = "posts.views.server_error" # noqa
 
@@ -24,6 +26,7 @@ urlpatterns += [
     path("about-author/", views.flatpage, {"url": "/about-author/"},
          name="author"),
     path("about-spec/", views.flatpage, {"url": "/about-spec/"}, name="spec"),
+    path("metrics", metrics.export, name="metrics"),
     path("", include("posts.urls")),
 ]
 